@@ -0,0 +1,56 @@
+"""
+Поиск шаблона ответа /ai (CannedReplyIndex.match): задержка на вопрос при
+10 000 примеров и доля вопросов, на которые бот ответил сам, без модели.
+Примеры — canned_replies.json, дополненный синтетическими ситуациями из
+тех же слов; вопросы — размеченные из tests/test_canned_replies.py.
+
+    python benchmarks/canned_replies.py
+"""
+import json
+import os
+import random
+import sys
+
+from common import bot, timed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+from test_canned_replies import LABELLED  # noqa: E402
+
+SITUATIONS_PER_REPLY = 4
+
+
+def entries_with(examples, real, rng):
+    """Настоящие шаблоны плюс синтетические — до examples примеров."""
+    words = sorted({word for entry in real for situation in entry["situations"] for word in situation.split()})
+    entries = list(real)
+    count = sum(len(entry["situations"]) for entry in real)
+    while count < examples:
+        entries.append({
+            "situations": [" ".join(rng.sample(words, rng.randint(3, 7))) for _ in range(SITUATIONS_PER_REPLY)],
+            "reply": f"Синтетический ответ {len(entries)}",
+        })
+        count += SITUATIONS_PER_REPLY
+    return entries
+
+
+def main():
+    rng = random.Random(1)
+    with open(bot.CANNED_REPLIES_PATH, encoding="utf-8") as f:
+        real = json.load(f)
+    questions = [question for question, _ in LABELLED]
+    print(f"{len(questions)} размеченных вопросов; задержка match, мс")
+    print(f"{'примеров':>9} {'медиана':>8} {'p99':>7} {'ответили сами':>14} {'верно':>6}")
+    for examples in (60, 1000, 10_000):
+        index = bot.CannedReplyIndex()
+        index.build(entries_with(examples, real, rng))
+        asked = iter(questions * 20)
+        median, p99 = timed(lambda: index.match(next(asked)), len(questions) * 20)
+        correct = sum(1 for question, expected in LABELLED
+                      if (reply := index.match(question)) is not None and expected and expected in reply)
+        served = index.served / index.lookups
+        print(f"{len(index.example_reply):>9} {median:>8.3f} {p99:>7.3f} {served:>14.0%} "
+              f"{correct:>3}/{sum(1 for _, expected in LABELLED if expected)}")
+
+
+if __name__ == "__main__":
+    main()
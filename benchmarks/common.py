@@ -0,0 +1,25 @@
+"""Общее для бенчмарков: заглушки настроек и импорт bot.py из корня репозитория."""
+import os
+import statistics
+import sys
+import time
+
+# bot.py читает настройки при импорте: ставим заглушки до него
+os.environ.setdefault("BOT_TOKEN", "123:BENCH")
+os.environ.setdefault("SHEET_ID", "bench-sheet")
+os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS_JSON", "{}")
+os.environ.setdefault("STATE_BACKEND", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402,F401
+
+
+def timed(func, repeat):
+    """Время одного вызова func в мс: (медиана, p99)."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.99))]
@@ -0,0 +1,38 @@
+"""
+Выбор водителя с лучшим ETA (DriverLocationIndex.best_eta) среди 10 000
+водителей класса: один векторный проход по массивам NumPy плюс проверка
+занятости у короткого списка. Цель — меньше 1 мс на заказ.
+
+    python benchmarks/dispatch_eta.py [водителей]
+"""
+import random
+import sys
+
+from common import bot, timed
+
+QUERIES = 2000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    rng = random.Random(1)
+    index = bot.DriverLocationIndex(bot.GEO_CELL_DEG)
+    for driver_id in range(1, count + 1):
+        index.update(driver_id, "Business", 55.75 + rng.uniform(-0.3, 0.3), 37.62 + rng.uniform(-0.4, 0.4))
+    points = [(55.75 + rng.uniform(-0.3, 0.3), 37.62 + rng.uniform(-0.4, 0.4)) for _ in range(QUERIES)]
+
+    print(f"best_eta среди {count} водителей, {QUERIES} заказов, мс")
+    print(f"{'заняты':>7} {'медиана':>8} {'p99':>7}")
+    for share in (0, 0.5, 0.9, 0.99):
+        busy = set(rng.sample(range(1, count + 1), int(count * share)))
+        queries = iter(points * 2)
+
+        def one():
+            index.best_eta("Business", *next(queries), available=lambda driver_id: driver_id not in busy)
+
+        median, p99 = timed(one, QUERIES)
+        print(f"{share:>7.0%} {median:>8.3f} {p99:>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
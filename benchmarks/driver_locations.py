@@ -0,0 +1,56 @@
+"""
+DriverLocationIndex: сколько обновлений геолокации в секунду выдерживает
+индекс и сколько стоит поиск k ближайших (nearest) — против прежнего
+полного перебора всех водителей с haversine.
+
+    python benchmarks/driver_locations.py
+"""
+import random
+import time
+
+from common import bot, timed
+
+UPDATES = 200_000
+QUERIES = 2000
+
+
+def updates_per_sec(index, count, rng):
+    # водитель сдвигается на 10–50 м, как между правками живой геолокации
+    moves = [(rng.randint(1, count), rng.uniform(-0.0004, 0.0004), rng.uniform(-0.0004, 0.0004))
+             for _ in range(UPDATES)]
+    started = time.perf_counter()
+    for driver_id, d_lat, d_lon in moves:
+        lat, lon, _ = index.position(driver_id)
+        index.update(driver_id, "Business", lat + d_lat, lon + d_lon)
+    return UPDATES / (time.perf_counter() - started)
+
+
+def main():
+    rng = random.Random(1)
+    print(f"обновлений: {UPDATES}, запросов nearest(k=5, 3 км): {QUERIES}")
+    print(f"{'водителей':>10} {'обновл/с':>10} {'nearest мед':>12} {'p99':>7} {'перебор мед':>12} {'p99':>7}")
+    for count in (100, 1000, 10_000):
+        index = bot.DriverLocationIndex(bot.GEO_CELL_DEG)
+        for driver_id in range(1, count + 1):
+            index.update(driver_id, "Business", 55.75 + rng.uniform(-0.3, 0.3), 37.62 + rng.uniform(-0.4, 0.4))
+        rate = updates_per_sec(index, count, rng)
+        points = iter([(55.75 + rng.uniform(-0.3, 0.3), 37.62 + rng.uniform(-0.4, 0.4))
+                       for _ in range(2 * QUERIES)])
+
+        def scan():
+            lat, lon = next(points)
+            found = []
+            for driver_id in range(1, count + 1):
+                d_lat, d_lon, _ = index.position(driver_id)
+                distance = bot.haversine_km(lat, lon, d_lat, d_lon)
+                if distance <= 3.0:
+                    found.append((distance, driver_id))
+            return sorted(found)[:5]
+
+        knn = timed(lambda: index.nearest("Business", *next(points), k=5, max_km=3.0), QUERIES)
+        full = timed(scan, QUERIES)
+        print(f"{count:>10} {rate:>10.0f} {knn[0]:>12.3f} {knn[1]:>7.3f} {full[0]:>12.3f} {full[1]:>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Память на заказы в ORDERS_CACHE. Байты на заказ (tracemalloc): прежний
+dict против Order со __slots__ и интернированными строками. И RSS процесса
+после 100 000 заказов по часам модели: заказ завершается через 40 минут,
+каждый двадцатый брошен; evict_orders — раз в ORDER_FINISHED_TTL / 4, как
+evict_orders_job. Без вытеснения кэш растёт без предела.
+
+    python benchmarks/order_memory.py
+"""
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+from common import bot
+
+PER_ORDER_SAMPLE = 10_000
+TOTAL = 100_000
+ARRIVAL = 4.0            # сек модели между заказами (~4,6 суток на 100 000)
+RIDE = 40 * 60           # сек от заказа до завершения
+CHECKPOINTS = (10_000, 25_000, 50_000, 100_000)
+
+
+class Clock:
+    """Часы модели вместо time в bot: monotonic() двигает сценарий, остальное — настоящее."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def order_json(n):
+    """Заказ так, как он приходит из SQLite/Redis: свежие строки после json.loads."""
+    return json.dumps({
+        "order_id": f"{1700000000 + n}-{n % 97}", "user_id": 500000 + n % 3000, "username": f"client{n % 3000}",
+        "pickup": f"Тверская, {n % 200}", "destination": "Шереметьево, терминал B",
+        "car_class": ("Business", "S-Class W223", "Maybach W223", "Minivan")[n % 4], "time": "Сейчас",
+        "hours_text": "1 час", "contact": f"+7 900 {n % 1000:03d}-00-00", "approx_price": "≈ 5 000 ₽ за 1 ч.",
+        "created_at": "2024-05-01 12:00:00", "status": "new", "driver_id": 7000 + n % 400,
+        "driver_name": f"Водитель {n % 400}", "arrived_at": None, "pickup_lat": 55.75, "pickup_lon": 37.62,
+        "dest_lat": 55.97, "dest_lon": 37.41, "assign_seconds": 12.5, "urgent": False,
+    }, ensure_ascii=False)
+
+
+def bytes_per_order(make):
+    raw = [order_json(n) for n in range(PER_ORDER_SAMPLE)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    cache = {}
+    for text in raw:
+        order = make(text)
+        cache[id(order)] = order
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / PER_ORDER_SAMPLE
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * 4096 / 2 ** 20
+
+
+def simulate(evict):
+    """Отдельный процесс: строка «заказов кэш RSS» на каждой контрольной точке."""
+    clock = Clock()
+    bot.time = clock
+    finishing = deque()     # (когда завершится, Order)
+    next_evict = 0.0
+    for n in range(1, TOTAL + 1):
+        clock.now = n * ARRIVAL
+        order = bot.Order.from_dict(json.loads(order_json(n)))
+        bot.ORDERS_CACHE[order.order_id] = order
+        if n % 20:
+            finishing.append((clock.now + RIDE, order))
+        while finishing and finishing[0][0] <= clock.now:
+            _, done = finishing.popleft()
+            done.status, done.touched = "finished", clock.now
+        if evict and clock.now >= next_evict:
+            bot.evict_orders()
+            next_evict = clock.now + max(60.0, bot.ORDER_FINISHED_TTL / 4)
+        if n in CHECKPOINTS:
+            print(n, len(bot.ORDERS_CACHE), f"{rss_mb():.1f}", flush=True)
+
+
+def main():
+    as_dict = bytes_per_order(json.loads)
+    as_order = bytes_per_order(lambda text: bot.Order.from_dict(json.loads(text)))
+    print(f"байт на заказ: dict {as_dict:.0f}, Order {as_order:.0f}")
+    print(f"RSS после N заказов (TTL завершённых {bot.ORDER_FINISHED_TTL:.0f} с, брошенных {bot.ORDER_STALE_TTL:.0f} с)")
+    print(f"{'заказов':>8} {'в кэше':>8} {'RSS, МБ':>8} {'без вытеснения: в кэше':>23} {'RSS, МБ':>8}")
+    runs = [subprocess.run([sys.executable, __file__, mode], capture_output=True, text=True, check=True)
+            .stdout.split("\n")[:len(CHECKPOINTS)] for mode in ("evict", "keep")]
+    for with_evict, without in zip(*runs):
+        n, cached, rss = with_evict.split()
+        _, kept, kept_rss = without.split()
+        print(f"{n:>8} {cached:>8} {rss:>8} {kept:>23} {kept_rss:>8}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        simulate(sys.argv[1] == "evict")
+    else:
+        main()
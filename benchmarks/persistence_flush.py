@@ -0,0 +1,71 @@
+"""
+Стоимость одного интервала сохранения диалогов: изменились CHANGED
+пользователей из N активных. AppendLogPersistence дописывает только их,
+PicklePersistence (прежний вариант) переписывает весь файл: при on_flush=False —
+на каждое изменение, при on_flush=True — один раз, но только при остановке.
+
+    python benchmarks/persistence_flush.py
+"""
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from telegram.ext import PicklePersistence
+
+from common import bot
+
+CHANGED = 50
+INTERVALS = 5
+
+
+def draft(user_id, step):
+    return {"order": {"pickup": f"Тверская, {user_id}", "destination": "Шереметьево, терминал B",
+                      "car_class": "Business", "time": "Сейчас", "hours": 2, "step": step,
+                      "pickup_lat": 55.75, "pickup_lon": 37.62}}
+
+
+async def fill(persistence, active):
+    # начальное заполнение — одним сбросом, иначе PicklePersistence переписал бы файл 2N раз
+    on_flush = getattr(persistence, "on_flush", None)
+    if on_flush is not None:
+        persistence.on_flush = True
+    for user_id in range(active):
+        await persistence.update_user_data(user_id, draft(user_id, 0))
+        await persistence.update_conversation("order", (user_id, user_id), bot.DEST)
+    await persistence.flush()
+    if on_flush is not None:
+        persistence.on_flush = on_flush
+
+
+async def interval_ms(persistence, active, step):
+    started = time.perf_counter()
+    for user_id in range(step * CHANGED, step * CHANGED + CHANGED):
+        user_id %= active
+        await persistence.update_user_data(user_id, draft(user_id, step))
+        await persistence.update_conversation("order", (user_id, user_id), bot.CONFIRM if step % 2 else bot.TIME)
+    await persistence.flush()
+    return (time.perf_counter() - started) * 1000
+
+
+async def measure(make, active):
+    persistence = make()
+    await fill(persistence, active)
+    samples = sorted([await interval_ms(persistence, active, step) for step in range(1, INTERVALS + 1)])
+    return samples[len(samples) // 2]
+
+
+async def main():
+    print(f"Интервал сохранения: изменились {CHANGED} пользователей, медиана из {INTERVALS}, мс")
+    print(f"{'активных':>9} {'append-log':>11} {'pickle':>9} {'pickle on_flush':>16}")
+    for active in (100, 1000, 10000):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            append_log = await measure(lambda: bot.AppendLogPersistence(str(tmp / "state.jsonl"), 60), active)
+            pickle = await measure(lambda: PicklePersistence(tmp / "state.pickle"), active)
+            pickle_on_flush = await measure(lambda: PicklePersistence(tmp / "flush.pickle", on_flush=True), active)
+        print(f"{active:>9} {append_log:>11.2f} {pickle:>9.2f} {pickle_on_flush:>16.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+"""
+Задержка хендлеров, когда одновременно приходят N заказов и каждый пишет
+строку в Google Sheets (запрос ~SHEETS_RTT). «До» — вызов gspread прямо в
+хендлере: цикл событий стоит, пока идёт запрос. «После» — через
+SheetsGateway (пул потоков). Между заказами приходят лёгкие апдейты
+(«📌 Статус» из кэша) — их задержка показывает, стоит ли бот для всех.
+
+    python benchmarks/sheets_gateway.py [RTT_мс]
+"""
+import asyncio
+import sys
+import time
+
+from common import bot
+
+LIGHT_PER_ORDER = 3
+GAP = 0.002  # сек между апдейтами
+
+
+class SlowWorksheet:
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.rows = []
+
+    def append_row(self, row):
+        time.sleep(self.rtt)  # блокирующий HTTP-запрос gspread
+        self.rows.append(row)
+
+
+def pct(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+async def measure(orders, rtt, gateway):
+    """Апдейты приходят по расписанию (раз в GAP), задержка — от момента прихода до конца хендлера."""
+    loop = asyncio.get_running_loop()
+    ws = SlowWorksheet(rtt)
+    order_ms, light_ms, tasks = [], [], []
+
+    async def order_handler(n, arrived):
+        row = [f"o{n}", "Тверская, 1", "Шереметьево", "Business", "new"]
+        if gateway is None:
+            ws.append_row(row)
+        else:
+            await gateway.call(ws.append_row, row, retry=False)
+        order_ms.append((loop.time() - arrived) * 1000)
+
+    async def light_handler(arrived):
+        await asyncio.sleep(0)  # ответ из кэша, без запросов к таблице
+        light_ms.append((loop.time() - arrived) * 1000)
+
+    def arrive(handler, *args):
+        tasks.append(asyncio.create_task(handler(*args)))
+
+    start = loop.time() + 0.05
+    for n in range(orders * (LIGHT_PER_ORDER + 1)):
+        at = start + n * GAP
+        if n % (LIGHT_PER_ORDER + 1):
+            loop.call_at(at, arrive, light_handler, at)
+        else:
+            loop.call_at(at, arrive, order_handler, n, at)
+    while len(order_ms) + len(light_ms) < orders * (LIGHT_PER_ORDER + 1):
+        await asyncio.sleep(0.01)
+    await asyncio.gather(*tasks)
+    assert len(ws.rows) == orders
+    return order_ms, light_ms
+
+
+async def main():
+    rtt = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.2
+    print(f"запрос к Sheets {rtt * 1000:.0f} мс, пул {bot.SHEETS_MAX_WORKERS} потоков; p99 задержки хендлера, мс")
+    print(f"{'заказов':>8} {'до: заказ':>10} {'статус':>8} {'после: заказ':>13} {'статус':>8}")
+    for orders in (1, 10, 50):
+        before = await measure(orders, rtt, None)
+        gateway = bot.SheetsGateway(bot.SHEETS_MAX_WORKERS, timeout=60)
+        after = await measure(orders, rtt, gateway)
+        gateway.shutdown()
+        print(f"{orders:>8} {pct(before[0], 0.99):>10.0f} {pct(before[1], 0.99):>8.0f} "
+              f"{pct(after[0], 0.99):>13.0f} {pct(after[1], 0.99):>8.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+"""
+Старт бота: сколько занимает import bot (по `python -X importtime`, самые
+тяжёлые модули) и через сколько после запуска процесса уходит первый
+getUpdates — то есть polling начался. Бот запускается отдельным процессом
+против локального Bot API (FakeBotApi из update_latency.py); Google Sheets
+недоступны (пустые учётные данные) — подключение к ним идёт в фоне и
+старт ждать не должен. Цель — polling меньше чем за 1 с.
+
+    python benchmarks/startup.py [запусков]
+"""
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import bot
+from update_latency import FakeBotApi
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOP = 8
+
+# дочерний процесс: как `python bot.py`, но Application ходит в локальный Bot API
+CHILD = """
+import sys
+from telegram.ext import Application, ApplicationBuilder
+Application.builder = staticmethod(lambda: ApplicationBuilder().base_url(sys.argv[1]))
+import bot
+bot.build_app().run_polling(close_loop=False)
+"""
+
+
+def child_env(tmp):
+    env = dict(os.environ)
+    env.update(BOT_TOKEN="123:BENCH", SHEET_ID="bench-sheet", GOOGLE_APPLICATION_CREDENTIALS_JSON="{}",
+               STATE_BACKEND="sqlite", ORDERS_DB_PATH=os.path.join(tmp, "orders.db"),
+               PERSISTENCE_PATH=os.path.join(tmp, "state.jsonl"), PYTHONPATH=ROOT)
+    return env
+
+
+def import_times(tmp):
+    """(мс на import bot целиком, [(мс, модуль)] самых тяжёлых модулей, которые импортирует bot.py)."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import bot"], cwd=tmp,
+                            env=child_env(tmp), capture_output=True, text=True, check=True)
+    children = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = len(name) - len(name.lstrip())
+        if depth == 1:  # модуль верхнего уровня; его импорты напечатаны перед ним с отступом 3
+            if name.strip() == "bot":
+                return int(cumulative) / 1000, sorted(children, reverse=True)[:TOP]
+            children = []
+        elif depth == 3:
+            children.append((int(cumulative) / 1000, name.strip()))
+    raise RuntimeError("bot не найден в выводе -X importtime")
+
+
+async def time_to_polling(tmp):
+    """Секунды от запуска процесса до первого getUpdates."""
+    api = FakeBotApi(0)
+    polled = asyncio.Event()
+
+    async def handle(method, path, headers, body):
+        if path.endswith("/getUpdates"):
+            polled.set()
+        return await api.handle(method, path, headers, body)
+
+    server = bot.HttpServer(handle, "127.0.0.1", 0)
+    await server.start()
+    port = server._server.sockets[0].getsockname()[1]
+    started = time.perf_counter()
+    child = subprocess.Popen([sys.executable, "-c", CHILD, f"http://127.0.0.1:{port}/bot"], cwd=tmp,
+                             env=child_env(tmp), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await asyncio.wait_for(polled.wait(), 30)
+        return time.perf_counter() - started
+    finally:
+        child.kill()
+        child.wait()
+        api.close()
+        await asyncio.sleep(0.1)  # висящий getUpdates убитого процесса успевает ответить
+        await server.stop()
+
+
+async def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        total, heaviest = import_times(tmp)
+        print(f"import bot: {total:.0f} мс (python -X importtime), тяжелее всего:")
+        for ms, name in heaviest:
+            print(f"  {ms:>7.0f} мс  {name}")
+        samples = [await time_to_polling(tmp) for _ in range(runs)]
+    print(f"от запуска процесса до первого getUpdates: медиана {statistics.median(samples):.2f} с, "
+          f"max {max(samples):.2f} с ({runs} запусков)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
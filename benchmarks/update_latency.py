@@ -0,0 +1,159 @@
+"""
+Задержка апдейта до хендлера: long polling против вебхука.
+
+Вместо Telegram — локальный Bot API (getMe, getUpdates с long polling):
+в режиме polling апдейт кладётся в него, и Application забирает его
+через getUpdates; в режиме webhook тот же апдейт POST-ом уходит в
+webhook_handler на HttpServer, как его шлёт Telegram. Замер — от момента
+появления апдейта у «Telegram» до входа в хендлер.
+Сеть до Telegram имитируется задержкой в одну сторону RTT/2: у запроса
+getUpdates, у его ответа и у POST вебхука.
+
+    python benchmarks/update_latency.py [апдейтов] [интервал_мс] [RTT_мс]
+"""
+import asyncio
+import json
+import sys
+import time
+from contextlib import suppress
+from urllib.parse import parse_qs
+
+import httpx
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from common import bot
+
+TOKEN = "123:BENCH"
+
+
+def recorded_updates(count):
+    """Апдейты в том виде, в каком их присылает Telegram: сообщения из разных чатов."""
+    texts = ["/start", "🚖 Заказать", "Тверская, 1", "Шереметьево", "Business", "Сейчас", "✅ Подтвердить"]
+    return [{
+        "update_id": 1000 + n,
+        "message": {
+            "message_id": 10 + n,
+            "date": 1700000000 + n,
+            "chat": {"id": 5000 + n % 40, "type": "private", "first_name": "Клиент"},
+            "from": {"id": 5000 + n % 40, "is_bot": False, "first_name": "Клиент"},
+            "text": texts[n % len(texts)],
+        },
+    } for n in range(count)]
+
+
+class FakeBotApi:
+    """Ровно то, что нужно Application для polling: getMe, deleteWebhook, getUpdates."""
+
+    def __init__(self, one_way):
+        self.one_way = one_way
+        self.pending = []
+        self.arrived = asyncio.Event()
+        self.closed = False
+
+    def publish(self, update):
+        self.pending.append(update)
+        self.arrived.set()
+
+    def close(self):
+        """Висящие и новые getUpdates отвечают сразу — чтобы остановить polling."""
+        self.closed = True
+        self.arrived.set()
+
+    async def handle(self, method, path, headers, body):
+        name = path.rsplit("/", 1)[-1]
+        params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        if name == "getMe":
+            result = {"id": 123, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif name == "getUpdates":
+            await asyncio.sleep(self.one_way)  # запрос идёт до Telegram
+            offset = int(params.get("offset") or 0)
+            self.pending = [update for update in self.pending if update["update_id"] >= offset]
+            if not self.pending and not self.closed:
+                self.arrived.clear()
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.arrived.wait(), float(params.get("timeout") or 0))
+            result = self.pending[:100]
+            await asyncio.sleep(self.one_way)  # ответ идёт обратно
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+async def measure(mode, updates, gap, rtt):
+    api = FakeBotApi(rtt / 2)
+    api_server = bot.HttpServer(api.handle, "127.0.0.1", 0)
+    await api_server.start()
+    api_port = api_server._server.sockets[0].getsockname()[1]
+
+    sent, handled = {}, {}
+    done = asyncio.Event()
+
+    async def record(update, context):
+        handled[update.update_id] = time.perf_counter()
+        if len(handled) == len(updates):
+            done.set()
+
+    app = (Application.builder().token(TOKEN).base_url(f"http://127.0.0.1:{api_port}/bot")
+           .concurrent_updates(bot.CONCURRENT_UPDATES).build())
+    app.add_handler(TypeHandler(Update, record))
+    await app.initialize()
+    await app.start()
+
+    client = httpx.AsyncClient()
+    webhook_server = None
+    if mode == "polling":
+        await app.updater.start_polling()
+
+        async def deliver(update):
+            sent[update["update_id"]] = time.perf_counter()
+            api.publish(update)
+    else:
+        webhook_server = bot.HttpServer(bot.webhook_handler(app), "127.0.0.1", 0)
+        await webhook_server.start()
+        url = f"http://127.0.0.1:{webhook_server._server.sockets[0].getsockname()[1]}{bot.WEBHOOK_PATH}"
+        headers = {"Content-Type": "application/json", bot.SECRET_HEADER: bot.WEBHOOK_SECRET}
+
+        async def deliver(update):
+            sent[update["update_id"]] = time.perf_counter()
+            await asyncio.sleep(rtt / 2)
+            await client.post(url, content=json.dumps(update), headers=headers)
+
+    tasks = []
+    for update in updates:
+        tasks.append(asyncio.create_task(deliver(update)))
+        await asyncio.sleep(gap)
+    await asyncio.gather(*tasks)
+    await asyncio.wait_for(done.wait(), 30)
+
+    if mode == "polling":
+        api.close()
+        await app.updater.stop()
+    else:
+        await webhook_server.stop()
+    await app.stop()
+    await app.shutdown()
+    await client.aclose()
+    await api_server.stop()
+    return sorted((handled[update_id] - sent[update_id]) * 1000 for update_id in sent)
+
+
+def pct(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    gap = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.005
+    rtt = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.05
+    updates = recorded_updates(count)
+    print(f"{count} апдейтов, интервал {gap * 1000:.0f} мс, RTT {rtt * 1000:.0f} мс; задержка до хендлера, мс")
+    print(f"{'режим':>8} {'p50':>7} {'p95':>7} {'p99':>7} {'max':>7}")
+    for mode in ("polling", "webhook"):
+        samples = await measure(mode, updates, gap, rtt)
+        print(f"{mode:>8} {pct(samples, 0.5):>7.2f} {pct(samples, 0.95):>7.2f} "
+              f"{pct(samples, 0.99):>7.2f} {samples[-1]:>7.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,13 +2,34 @@
 # VIP Taxi Bot — заказы, водители, Google Sheets, чат клиент-водитель
 
 import os
+import argparse
 import json
 import logging
 import re
+import signal
+import sys
+import sqlite3
+import asyncio
+import functools
+import hashlib
+import heapq
+import hmac
+import itertools
+import math
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional
+from http import HTTPStatus
+from typing import Dict, Any, AsyncIterator, Awaitable, List, Optional, Callable, Iterable, Tuple, Deque, Set
 
+STARTED_AT = time.monotonic()  # до импорта тяжёлых библиотек — для замера старта
+
+import numpy as np
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -18,19 +39,22 @@ from telegram import (
     BotCommand,
 )
 from telegram.constants import ParseMode, ChatType
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseRateLimiter,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     CallbackQueryHandler,
     ContextTypes,
+    PersistenceInput,
+    TypeHandler,
     filters,
 )
 
-import requests
-from google.oauth2.service_account import Credentials
-import gspread
+import httpx  # зависимость python-telegram-bot
 
 # ---------- ЛОГИ ----------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
@@ -46,6 +70,8 @@ SHEET_ID = os.environ.get("SHEET_ID")
 
 assert BOT_TOKEN, "BOT_TOKEN is required"
 assert SHEET_ID, "SHEET_ID is required"
+assert os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON"), \
+    "GOOGLE_APPLICATION_CREDENTIALS_JSON is required"
 
 # тарифы (почасовые, минимум 1 час)
 PRICES: Dict[str, int] = {
@@ -64,23 +90,725 @@ AIRPORT_KEYWORDS: Dict[str, List[str]] = {
     "vnukovo": ["внуково", "vko"],
 }
 
-# кэш заказов в памяти
-ORDERS_CACHE: Dict[str, Dict[str, Any]] = {}  # order_id -> dict
+# ---------- ЗАКАЗ ----------
+
+ORDER_FIELDS = (
+    "order_id", "user_id", "username", "pickup", "destination", "car_class", "time",
+    "hours_text", "contact", "approx_price", "created_at", "status",
+    "driver_id", "driver_name", "arrived_at",
+    "pickup_lat", "pickup_lon", "dest_lat", "dest_lon", "assign_seconds", "urgent",
+)
+
+
+class Order:
+    """
+    Заказ в памяти. __slots__ вместо dict заметно экономит память на заказ,
+    повторяющиеся строки (статус, класс авто) интернируются.
+    touched — время последнего изменения (для вытеснения из памяти).
+    """
+
+    __slots__ = ORDER_FIELDS + ("touched",)
+
+    def __init__(self, **fields: Any) -> None:
+        for name in ORDER_FIELDS:
+            setattr(self, name, fields.get(name))
+        self.touched = time.monotonic()
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Order":
+        order = cls(**{name: data.get(name) for name in ORDER_FIELDS})
+        if order.status:
+            order.status = sys.intern(order.status)
+        if order.car_class:
+            order.car_class = sys.intern(order.car_class)
+        if isinstance(order.arrived_at, str):
+            order.arrived_at = datetime.fromisoformat(order.arrived_at)
+        return order
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in ORDER_FIELDS}
+
+
+# заказы и чаты в памяти (основная копия — в SQLite, см. OrderStore)
+ORDERS_CACHE: Dict[str, Order] = {}           # order_id -> Order
 ACTIVE_CHATS: Dict[int, str] = {}            # user_id -> order_id
 
+# последние заказы пользователя (клиента или водителя), новые в конце;
+# наличие ключа значит, что история пользователя уже известна
+USER_ORDERS_LIMIT = int(os.environ.get("USER_ORDERS_LIMIT", "5"))
+USER_ORDERS: Dict[int, Deque[str]] = {}      # user_id -> order_id...
+
+
+def remember_user_order(user_id: Any, order_id: Optional[str]) -> None:
+    orders = USER_ORDERS.setdefault(int(user_id), deque(maxlen=USER_ORDERS_LIMIT))
+    if not order_id:
+        return
+    if order_id in orders:
+        orders.remove(order_id)
+    orders.append(order_id)
+
+
+def last_user_order(user_id: Any) -> Tuple[bool, Optional[str]]:
+    """(известна ли история пользователя, его последний order_id)."""
+    orders = USER_ORDERS.get(int(user_id))
+    if orders is None:
+        return False, None
+    return True, orders[-1] if orders else None
+
+
+# ---------- ХРАНИЛИЩЕ СОСТОЯНИЯ ----------
+# STATE_BACKEND: sqlite (по умолчанию), memory или redis (REDIS_URL).
+# Несколько реплик бота должны смотреть в одно общее хранилище (STATE_SHARED=1,
+# для redis — по умолчанию): тогда заказы и чаты читаются из него, а память — лишь кэш.
+
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite").lower()
+STATE_SHARED = os.environ.get("STATE_SHARED", "1" if STATE_BACKEND == "redis" else "0") == "1"
+ORDERS_DB_PATH = os.environ.get("ORDERS_DB_PATH", "vip_taxi.db")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.environ.get("REDIS_PREFIX", "vip_taxi:")
+REPLICA_ID = int(os.environ.get("REPLICA_ID", "0"))
+STORE_WORKERS = int(os.environ.get("STORE_WORKERS", "8"))
+
+assert STATE_BACKEND in ("sqlite", "memory", "redis"), "STATE_BACKEND must be sqlite, memory or redis"
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _order_from_json(raw: str) -> Order:
+    return Order.from_dict(json.loads(raw))
+
+
+def _order_matches(order: Order, expect: Dict[str, Tuple[Any, ...]]) -> bool:
+    return all(getattr(order, field) in allowed for field, allowed in expect.items())
+
+
+# (driver_id, класс, lat, lon, time() точки, time() окончания последнего заказа)
+LocationRow = Tuple[int, str, float, float, float, float]
+
+
+class StateStore:
+    """
+    Интерфейс хранилища: save_order / get_order / load_active_orders /
+    transition_order, save_driver / get_driver, link_chat / unlink_chat /
+    get_chat / load_chats, очередь зеркала outbox_put / outbox_done / outbox_load
+    и геолокация водителей для других реплик save_locations / load_locations.
+
+    transition_order(order_id, expect, changes) — атомарная смена состояния:
+    changes применяются, только если каждое поле из expect имеет одно из
+    допустимых значений; иначе возвращается None.
+
+    blocking — вызов может ждать сеть или чужую блокировку (Redis, общий
+    файл SQLite): такие вызовы хендлеры делают через store_call, в пуле потоков.
+
+    load_locations(since) отдаёт строки геолокации (LocationRow),
+    записанные не раньше since.
+    """
+
+    shared = False
+    blocking = False
+
+
+class MemoryStore(StateStore):
+    """Всё в памяти процесса — для локальной отладки, после рестарта пусто."""
+
+    def __init__(self) -> None:
+        self._orders: Dict[str, Order] = {}
+        self._drivers: Dict[str, Dict[str, Any]] = {}
+        self._chats: Dict[int, str] = {}
+        self._outbox: Dict[str, Dict[str, Dict[int, Any]]] = {}
+        self._locations: Dict[int, Tuple[LocationRow, float]] = {}
+
+    def save_order(self, order: Order) -> None:
+        self._orders[order.order_id] = order
+
+    def get_order(self, order_id: str) -> Optional[Order]:
+        return self._orders.get(order_id)
+
+    def load_active_orders(self) -> Dict[str, Order]:
+        return {order_id: order for order_id, order in self._orders.items() if order.status != "finished"}
+
+    def transition_order(self, order_id: str, expect: Dict[str, Tuple[Any, ...]],
+                         changes: Dict[str, Any]) -> Optional[Order]:
+        order = self._orders.get(order_id)
+        if order is None or not _order_matches(order, expect):
+            return None
+        for name, value in changes.items():
+            setattr(order, name, value)
+        return order
+
+    def save_driver(self, info: Dict[str, Any]) -> None:
+        self._drivers[str(info["driver_id"])] = dict(info)
+
+    def get_driver(self, driver_id: Any) -> Optional[Dict[str, Any]]:
+        return self._drivers.get(str(driver_id))
+
+    def link_chat(self, user_id: int, order_id: str) -> None:
+        self._chats[user_id] = order_id
+
+    def unlink_chat(self, user_id: int) -> None:
+        self._chats.pop(user_id, None)
+
+    def get_chat(self, user_id: int) -> Optional[str]:
+        return self._chats.get(user_id)
+
+    def load_chats(self) -> Dict[int, str]:
+        return dict(self._chats)
+
+    def outbox_put(self, sheet: str, key: str, cells: Dict[int, Any]) -> None:
+        self._outbox.setdefault(sheet, {}).setdefault(key, {}).update(cells)
+
+    def outbox_done(self, sheet: str, changes: Dict[str, Dict[int, Any]]) -> None:
+        pending = self._outbox.get(sheet, {})
+        for key, cells in changes.items():
+            stored = pending.get(key, {})
+            for col, value in cells.items():
+                if stored.get(col) == value:
+                    del stored[col]
+            if not stored:
+                pending.pop(key, None)
+
+    def outbox_load(self, sheet: str) -> Dict[str, Dict[int, Any]]:
+        return {key: dict(cells) for key, cells in self._outbox.get(sheet, {}).items()}
+
+    def save_locations(self, rows: List[LocationRow]) -> None:
+        now = time.time()
+        for row in rows:
+            self._locations[row[0]] = (tuple(row), now)
+
+    def load_locations(self, since: float) -> List[LocationRow]:
+        return [row for row, updated_at in self._locations.values() if updated_at >= since]
+
+
+class OrderStore(StateStore):
+    """
+    Основное хранилище заказов, водителей и активных чатов — SQLite в режиме WAL.
+    Запись локальная и занимает микросекунды, поэтому хендлеры пишут сюда
+    синхронно. Google Sheets — только зеркало для отчётов (см. SheetWriter),
+    очередь зеркала (sheet_outbox) тоже хранится здесь и переживает рестарт.
+    Файл можно делить между процессами на одной машине (STATE_SHARED=1):
+    тогда BEGIN IMMEDIATE может ждать чужую запись, и вызовы идут из пула
+    потоков (blocking). У каждого потока своё соединение — транзакции
+    разных потоков на одном соединении перемешались бы.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._local = threading.local()
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS orders (
+                order_id   TEXT PRIMARY KEY,
+                status     TEXT,
+                data       TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS drivers (
+                driver_id TEXT PRIMARY KEY,
+                data      TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS active_chats (
+                user_id  INTEGER PRIMARY KEY,
+                order_id TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sheet_outbox (
+                sheet TEXT NOT NULL,
+                key   TEXT NOT NULL,
+                col   INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (sheet, key, col)
+            );
+            CREATE TABLE IF NOT EXISTS driver_locations (
+                driver_id  INTEGER PRIMARY KEY,
+                car_class  TEXT NOT NULL,
+                lat        REAL NOT NULL,
+                lon        REAL NOT NULL,
+                ts         REAL NOT NULL,
+                idle_since REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS driver_locations_updated ON driver_locations (updated_at);
+            """
+        )
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self._path, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    # заказы
+    def save_order(self, order: Order) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO orders VALUES (?, ?, ?, ?)",
+            (order.order_id, order.status,
+             json.dumps(order.to_dict(), default=_json_default, ensure_ascii=False), time.time()),
+        )
+
+    def get_order(self, order_id: str) -> Optional[Order]:
+        row = self._db.execute("SELECT data FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        return _order_from_json(row[0]) if row else None
+
+    def load_active_orders(self) -> Dict[str, Order]:
+        rows = self._db.execute(
+            "SELECT order_id, data FROM orders WHERE COALESCE(status, '') != 'finished'"
+        )
+        return {order_id: _order_from_json(data) for order_id, data in rows}
+
+    def transition_order(self, order_id: str, expect: Dict[str, Tuple[Any, ...]],
+                         changes: Dict[str, Any]) -> Optional[Order]:
+        # BEGIN IMMEDIATE берёт блокировку записи сразу — другой процесс ждёт
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            order = self.get_order(order_id)
+            if order is not None and _order_matches(order, expect):
+                for name, value in changes.items():
+                    setattr(order, name, value)
+                self.save_order(order)
+            else:
+                order = None
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        return order
+
+    # водители
+    def save_driver(self, info: Dict[str, Any]) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO drivers VALUES (?, ?)",
+            (str(info["driver_id"]), json.dumps(info, ensure_ascii=False)),
+        )
+
+    def get_driver(self, driver_id: Any) -> Optional[Dict[str, Any]]:
+        row = self._db.execute("SELECT data FROM drivers WHERE driver_id = ?", (str(driver_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # чат клиент ↔ водитель
+    def link_chat(self, user_id: int, order_id: str) -> None:
+        self._db.execute("INSERT OR REPLACE INTO active_chats VALUES (?, ?)", (user_id, order_id))
+
+    def unlink_chat(self, user_id: int) -> None:
+        self._db.execute("DELETE FROM active_chats WHERE user_id = ?", (user_id,))
+
+    def get_chat(self, user_id: int) -> Optional[str]:
+        row = self._db.execute("SELECT order_id FROM active_chats WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def load_chats(self) -> Dict[int, str]:
+        return dict(self._db.execute("SELECT user_id, order_id FROM active_chats"))
+
+    # очередь записи в Google Sheets
+    def outbox_put(self, sheet: str, key: str, cells: Dict[int, Any]) -> None:
+        self._db.executemany(
+            "INSERT OR REPLACE INTO sheet_outbox VALUES (?, ?, ?, ?)",
+            [(sheet, key, col, json.dumps(value, ensure_ascii=False)) for col, value in cells.items()],
+        )
+
+    def outbox_done(self, sheet: str, changes: Dict[str, Dict[int, Any]]) -> None:
+        """Удалить записанное; ячейки, изменённые после снимка, остаются в очереди."""
+        self._db.executemany(
+            "DELETE FROM sheet_outbox WHERE sheet = ? AND key = ? AND col = ? AND value = ?",
+            [(sheet, key, col, json.dumps(value, ensure_ascii=False))
+             for key, cells in changes.items() for col, value in cells.items()],
+        )
+
+    def outbox_load(self, sheet: str) -> Dict[str, Dict[int, Any]]:
+        pending: Dict[str, Dict[int, Any]] = {}
+        for key, col, value in self._db.execute(
+            "SELECT key, col, value FROM sheet_outbox WHERE sheet = ?", (sheet,)
+        ):
+            pending.setdefault(key, {})[col] = json.loads(value)
+        return pending
+
+    # геолокация водителей
+    def save_locations(self, rows: List[LocationRow]) -> None:
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO driver_locations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(*row, now) for row in rows],
+            )
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def load_locations(self, since: float) -> List[LocationRow]:
+        return [tuple(row) for row in self._db.execute(
+            "SELECT driver_id, car_class, lat, lon, ts, idle_since FROM driver_locations WHERE updated_at >= ?",
+            (since,),
+        )]
+
+
+class RedisStore(StateStore):
+    """
+    Общее хранилище для нескольких реплик — любой сервер с протоколом Redis
+    (Redis, Valkey, KeyDB; локально: redis-server). Нужна библиотека redis.
+    Смена статуса — Lua-скрипт, то есть атомарна на сервере.
+    Очередь зеркала у каждой реплики своя (REPLICA_ID), чтобы новые строки
+    не дописывались в таблицу дважды.
+    Клиент синхронный, поэтому хранилище blocking: хендлеры ходят в Redis
+    через store_call, из пула потоков (пул соединений redis-py потокобезопасен).
+    """
+
+    blocking = True
+
+    TRANSITION = """
+    local raw = redis.call('GET', KEYS[1])
+    if not raw then return false end
+    local order = cjson.decode(raw)
+    for field, allowed in pairs(cjson.decode(ARGV[1])) do
+        local ok = false
+        for _, value in ipairs(allowed) do
+            if order[field] == value then ok = true end
+        end
+        if not ok then return false end
+    end
+    for field, value in pairs(cjson.decode(ARGV[2])) do
+        order[field] = value
+    end
+    raw = cjson.encode(order)
+    redis.call('SET', KEYS[1], raw)
+    if order['status'] == 'finished' then
+        redis.call('SREM', KEYS[2], order['order_id'])
+    else
+        redis.call('SADD', KEYS[2], order['order_id'])
+    end
+    return raw
+    """
+
+    OUTBOX_DONE = """
+    for i = 1, #ARGV, 2 do
+        if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+            redis.call('HDEL', KEYS[1], ARGV[i])
+        end
+    end
+    """
+
+    def __init__(self, url: str, prefix: str, replica_id: int) -> None:
+        import redis  # опциональная зависимость — только для STATE_BACKEND=redis
+
+        # соединение открывается при первой команде
+        self._r = redis.Redis.from_url(url, decode_responses=True, socket_timeout=2)
+        self._prefix = prefix
+        self._active = f"{prefix}orders:active"
+        self._drivers = f"{prefix}drivers"
+        self._chats = f"{prefix}chats"
+        self._outbox = f"{prefix}outbox:{replica_id}:"
+        self._locations = f"{prefix}locations"
+        self._locations_updated = f"{prefix}locations:updated"
+        self._transition = self._r.register_script(self.TRANSITION)
+        self._outbox_done = self._r.register_script(self.OUTBOX_DONE)
+
+    def _order_key(self, order_id: str) -> str:
+        return f"{self._prefix}order:{order_id}"
+
+    def save_order(self, order: Order) -> None:
+        pipe = self._r.pipeline()
+        pipe.set(self._order_key(order.order_id),
+                 json.dumps(order.to_dict(), default=_json_default, ensure_ascii=False))
+        if order.status == "finished":
+            pipe.srem(self._active, order.order_id)
+        else:
+            pipe.sadd(self._active, order.order_id)
+        pipe.execute()
+
+    def get_order(self, order_id: str) -> Optional[Order]:
+        raw = self._r.get(self._order_key(order_id))
+        return _order_from_json(raw) if raw else None
+
+    def load_active_orders(self) -> Dict[str, Order]:
+        order_ids = sorted(self._r.smembers(self._active))
+        if not order_ids:
+            return {}
+        raws = self._r.mget([self._order_key(order_id) for order_id in order_ids])
+        return {order_id: _order_from_json(raw) for order_id, raw in zip(order_ids, raws) if raw}
+
+    def transition_order(self, order_id: str, expect: Dict[str, Tuple[Any, ...]],
+                         changes: Dict[str, Any]) -> Optional[Order]:
+        raw = self._transition(
+            keys=[self._order_key(order_id), self._active],
+            args=[json.dumps({field: list(allowed) for field, allowed in expect.items()}),
+                  json.dumps(changes, default=_json_default, ensure_ascii=False)],
+        )
+        return _order_from_json(raw) if raw else None
+
+    def save_driver(self, info: Dict[str, Any]) -> None:
+        self._r.hset(self._drivers, str(info["driver_id"]), json.dumps(info, ensure_ascii=False))
+
+    def get_driver(self, driver_id: Any) -> Optional[Dict[str, Any]]:
+        raw = self._r.hget(self._drivers, str(driver_id))
+        return json.loads(raw) if raw else None
+
+    def link_chat(self, user_id: int, order_id: str) -> None:
+        self._r.hset(self._chats, str(user_id), order_id)
+
+    def unlink_chat(self, user_id: int) -> None:
+        self._r.hdel(self._chats, str(user_id))
+
+    def get_chat(self, user_id: int) -> Optional[str]:
+        return self._r.hget(self._chats, str(user_id))
+
+    def load_chats(self) -> Dict[int, str]:
+        return {int(user_id): order_id for user_id, order_id in self._r.hgetall(self._chats).items()}
+
+    @staticmethod
+    def _outbox_field(key: str, col: int) -> str:
+        return json.dumps([key, col], ensure_ascii=False)
+
+    def outbox_put(self, sheet: str, key: str, cells: Dict[int, Any]) -> None:
+        self._r.hset(self._outbox + sheet, mapping={
+            self._outbox_field(key, col): json.dumps(value, ensure_ascii=False) for col, value in cells.items()
+        })
+
+    def outbox_done(self, sheet: str, changes: Dict[str, Dict[int, Any]]) -> None:
+        args: List[str] = []
+        for key, cells in changes.items():
+            for col, value in cells.items():
+                args += [self._outbox_field(key, col), json.dumps(value, ensure_ascii=False)]
+        if args:
+            self._outbox_done(keys=[self._outbox + sheet], args=args)
+
+    def outbox_load(self, sheet: str) -> Dict[str, Dict[int, Any]]:
+        pending: Dict[str, Dict[int, Any]] = {}
+        for field, value in self._r.hgetall(self._outbox + sheet).items():
+            key, col = json.loads(field)
+            pending.setdefault(key, {})[col] = json.loads(value)
+        return pending
+
+    def save_locations(self, rows: List[LocationRow]) -> None:
+        if not rows:
+            return
+        now = time.time()
+        pipe = self._r.pipeline(transaction=False)
+        pipe.hset(self._locations, mapping={str(row[0]): json.dumps(row) for row in rows})
+        pipe.zadd(self._locations_updated, {str(row[0]): now for row in rows})
+        pipe.execute()
+
+    def load_locations(self, since: float) -> List[LocationRow]:
+        driver_ids = self._r.zrangebyscore(self._locations_updated, since, "+inf")
+        if not driver_ids:
+            return []
+        return [tuple(json.loads(raw)) for raw in self._r.hmget(self._locations, driver_ids) if raw]
+
+
+def open_store() -> StateStore:
+    if STATE_BACKEND == "memory":
+        store: StateStore = MemoryStore()
+    elif STATE_BACKEND == "redis":
+        store = RedisStore(REDIS_URL, REDIS_PREFIX, REPLICA_ID)
+    else:
+        store = OrderStore(ORDERS_DB_PATH)
+    store.shared = STATE_SHARED
+    store.blocking = store.blocking or (STATE_SHARED and STATE_BACKEND == "sqlite")
+    return store
+
+
+STORE = open_store()
+STORE_EXECUTOR = ThreadPoolExecutor(max_workers=STORE_WORKERS, thread_name_prefix="store")
+# очередь зеркала пишется одним потоком: put и done одной ячейки не должны переставляться
+STORE_OUTBOX_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="store-outbox")
+
+
+async def store_call(func: Callable[..., Any], *args: Any, ordered: bool = False) -> Any:
+    """Вызвать метод STORE; если хранилище blocking — в пуле потоков, не держа цикл событий."""
+    if not STORE.blocking:
+        return func(*args)
+    executor = STORE_OUTBOX_EXECUTOR if ordered else STORE_EXECUTOR
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args))
+
+
+def _log_store_error(future: Any) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        log.error("Хранилище %s: ошибка фоновой записи: %s", STATE_BACKEND, future.exception())
+
+
+def store_submit(func: Callable[..., Any], *args: Any) -> None:
+    """Запись из синхронного кода без ожидания, в порядке вызовов (см. store_call(ordered=True))."""
+    if not STORE.blocking:
+        func(*args)
+        return
+    STORE_OUTBOX_EXECUTOR.submit(func, *args).add_done_callback(_log_store_error)
+
+
+async def get_order(order_id: str) -> Optional[Order]:
+    # общее хранилище могли изменить другие реплики — читаем из него
+    order = None if STORE.shared else ORDERS_CACHE.get(order_id)
+    if order is None:
+        order = await store_call(STORE.get_order, order_id)
+        if order is not None:
+            ORDERS_CACHE[order_id] = order
+    return order
+
+
+async def save_order(order: Order) -> None:
+    order.touched = time.monotonic()
+    ORDERS_CACHE[order.order_id] = order
+    await store_call(STORE.save_order, order)
+
+
+async def transition_order(order_id: str, expect: Dict[str, Tuple[Any, ...]], **changes: Any) -> Optional[Order]:
+    """
+    Атомарно сменить состояние заказа, если его поля совпадают с expect
+    (например, {"status": ("new",)}). Вернёт обновлённый заказ или None.
+    """
+    order = await store_call(STORE.transition_order, order_id, expect, changes)
+    if order is not None:
+        order.touched = time.monotonic()
+        ORDERS_CACHE[order_id] = order
+    return order
+
+
+async def chat_order(user_id: int) -> Optional[str]:
+    if STORE.shared:
+        return await store_call(STORE.get_chat, user_id)
+    return ACTIVE_CHATS.get(user_id)
+
+
+async def busy_users() -> Set[int]:
+    """Все, у кого сейчас активный чат (одним запросом) — для отбора свободных водителей."""
+    if STORE.shared:
+        return set(await store_call(STORE.load_chats))
+    return set(ACTIVE_CHATS)
+
+
+async def link_chat(user_id: Any, order_id: str) -> None:
+    ACTIVE_CHATS[int(user_id)] = order_id
+    await store_call(STORE.link_chat, int(user_id), order_id)
+
+
+async def unlink_chat(user_id: Any) -> None:
+    ACTIVE_CHATS.pop(int(user_id), None)
+    await store_call(STORE.unlink_chat, int(user_id))
+
+
+def restore_state() -> None:
+    """После рестарта поднять из SQLite незавершённые заказы и активные чаты."""
+    ORDERS_CACHE.update(STORE.load_active_orders())
+    for order in ORDERS_CACHE.values():
+        for user_id in (order.user_id, order.driver_id):
+            if user_id:
+                remember_user_order(user_id, order.order_id)
+    ACTIVE_CHATS.update(STORE.load_chats())
+    log.info("Восстановлено из хранилища %s: заказов %d, чатов %d",
+             STATE_BACKEND, len(ORDERS_CACHE), len(ACTIVE_CHATS))
+
+
+ORDER_FINISHED_TTL = float(os.environ.get("ORDER_FINISHED_TTL", "3600"))
+ORDER_STALE_TTL = float(os.environ.get("ORDER_STALE_TTL", "86400"))
+
+
+def evict_orders() -> int:
+    """
+    Убрать из памяти завершённые заказы старше ORDER_FINISHED_TTL
+    и любые заказы без изменений дольше ORDER_STALE_TTL.
+    В SQLite они остаются, get_order при необходимости поднимет их снова.
+    """
+    now = time.monotonic()
+    stale = [
+        order_id for order_id, order in ORDERS_CACHE.items()
+        if now - order.touched > (ORDER_FINISHED_TTL if order.status == "finished" else ORDER_STALE_TTL)
+    ]
+    for order_id in stale:
+        del ORDERS_CACHE[order_id]
+    return len(stale)
+
+
+async def evict_orders_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая чистка ORDERS_CACHE (JobQueue)."""
+    evicted = evict_orders()
+    if evicted:
+        log.info("Из памяти убрано заказов: %d (осталось %d)", evicted, len(ORDERS_CACHE))
+
+
 # ---------- GOOGLE SHEETS ----------
-credentials_info = json.loads(os.environ["GOOGLE_APPLICATION_CREDENTIALS_JSON"])
-credentials = Credentials.from_service_account_info(
-    credentials_info,
-    scopes=[
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ],
-)
-gc = gspread.authorize(credentials)
-spreadsheet = gc.open_by_key(SHEET_ID)
-ORDERS_SHEET = spreadsheet.worksheet("Лист1")
-DRIVERS_SHEET = spreadsheet.worksheet("drivers")
+# Авторизация и открытие таблицы — сетевые вызовы, поэтому делаем их
+# не при импорте, а при первом обращении (в потоке SheetsGateway).
+# После старта бота подключение прогревается в фоне (warm_up_sheets).
+
+class SheetsConnection:
+    def __init__(self, sheet_id: str) -> None:
+        self.sheet_id = sheet_id
+        self._spreadsheet: Any = None
+        self._worksheets: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def spreadsheet(self) -> Any:
+        with self._lock:
+            if self._spreadsheet is None:
+                import gspread
+                from google.oauth2.service_account import Credentials
+
+                credentials = Credentials.from_service_account_info(
+                    json.loads(os.environ["GOOGLE_APPLICATION_CREDENTIALS_JSON"]),
+                    scopes=[
+                        "https://www.googleapis.com/auth/spreadsheets",
+                        "https://www.googleapis.com/auth/drive",
+                    ],
+                )
+                client = gspread.authorize(credentials, http_client=throttled_http_client())
+                client.set_timeout(SHEETS_CALL_TIMEOUT)  # поток пула не висит дольше таймаута вызова
+                self._spreadsheet = client.open_by_key(self.sheet_id)
+            return self._spreadsheet
+
+    def worksheet(self, title: str) -> Any:
+        ws = self._worksheets.get(title)
+        if ws is None:
+            ws = self.spreadsheet().worksheet(title)
+            self._worksheets[title] = ws
+        return ws
+
+    def worksheet_or_none(self, title: str) -> Any:
+        from gspread.exceptions import WorksheetNotFound
+
+        try:
+            return self.worksheet(title)
+        except WorksheetNotFound:
+            return None
+
+    def ensure_worksheet(self, title: str, header: List[str]) -> Any:
+        """Открыть лист, а если его нет — создать с заголовком."""
+        ws = self.worksheet_or_none(title)
+        if ws is None:
+            ws = self.spreadsheet().add_worksheet(title, rows=1, cols=max(len(header), 1))
+            ws.append_row(header, value_input_option="USER_ENTERED")
+            self._worksheets[title] = ws
+        return ws
+
+
+def throttled_http_client() -> Any:
+    """HTTP-клиент gspread, каждый запрос которого проходит через SHEETS.request (квота, 429)."""
+    from gspread.http_client import HTTPClient
+
+    class ThrottledHTTPClient(HTTPClient):
+        def request(self, *args: Any, **kwargs: Any) -> Any:
+            return SHEETS.request(super().request, *args, **kwargs)
+
+    return ThrottledHTTPClient
+
+
+class LazyWorksheet:
+    """Лист, который открывается при первом вызове любого метода."""
+
+    def __init__(self, conn: SheetsConnection, title: str) -> None:
+        self._conn = conn
+        self.title = title
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn.worksheet(self.title), name)
+
+
+SHEETS_CONN = SheetsConnection(SHEET_ID)
+ORDERS_SHEET = LazyWorksheet(SHEETS_CONN, "Лист1")
+DRIVERS_SHEET = LazyWorksheet(SHEETS_CONN, "drivers")
 
 
 # ---------- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДАТЫ/ВРЕМЕНИ ----------
@@ -166,174 +894,1356 @@ def normalize_time_text(text: str) -> str:
         return text
 
 
-def detect_airport(text: Optional[str]) -> Optional[str]:
-    """Понимаем, упомянут ли аэропорт в строке."""
-    if not text:
-        return None
-    t = text.lower()
-    for code, words in AIRPORT_KEYWORDS.items():
-        for w in words:
-            if w in t:
-                return code
-    return None
+def detect_airport(text: Optional[str]) -> Optional[str]:
+    """Понимаем, упомянут ли аэропорт в строке."""
+    if not text:
+        return None
+    t = text.lower()
+    for code, words in AIRPORT_KEYWORDS.items():
+        for w in words:
+            if w in t:
+                return code
+    return None
+
+
+# ---------- КЭШ ----------
+
+class TTLCache:
+    """
+    Ограниченный кэш: записи живут ttl секунд, при переполнении
+    вытесняется давно не использованная (LRU). Потокобезопасный.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Any) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[1] if item else None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def items(self) -> List[Tuple[Any, Any, float]]:
+        """Живые записи (ключ, значение, сколько секунд осталось) — от старых к новым."""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value, expires - now) for key, (expires, value) in self._data.items() if expires > now]
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0.0
+        return f"{self.hits} попаданий / {self.misses} промахов ({ratio:.0f}%), записей {len(self)}"
+
+
+DRIVER_CACHE_SIZE = int(os.environ.get("DRIVER_CACHE_SIZE", "1000"))
+DRIVER_CACHE_TTL = float(os.environ.get("DRIVER_CACHE_TTL", "900"))
+DRIVER_CACHE = TTLCache(DRIVER_CACHE_SIZE, DRIVER_CACHE_TTL)  # driver_id (str) -> профиль
+
+
+def percentiles(values: Any) -> Tuple[float, float, float]:
+    """(p50, p95, max) непустой выборки — для /stats."""
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2], ordered[int(len(ordered) * 0.95)], ordered[-1]
+
+
+# ---------- ИНДЕКС СТРОК ТАБЛИЦ ----------
+
+SHEET_INDEX_MIN_REBUILD = float(os.environ.get("SHEET_INDEX_MIN_REBUILD", "30"))
+
+
+class SheetRowIndex:
+    """
+    Значение колонки A -> номер строки.
+    Строится одним чтением колонки, дальше дополняется по ответам append.
+    Если ключ не найден или строка из append не совпала с ожидаемой
+    (таблицу правили вручную) — индекс перестраивается,
+    но не чаще, чем раз в SHEET_INDEX_MIN_REBUILD секунд для промахов.
+    Вызывается из потоков SheetsGateway, поэтому всё под замком.
+    """
+
+    def __init__(self, name: str, read_keys: Callable[[], List[str]]) -> None:
+        self.name = name
+        self._read_keys = read_keys
+        self._rows: Dict[str, int] = {}
+        self._last_row = 0
+        self._built_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def rebuild(self, keys: Optional[List[str]] = None) -> None:
+        if keys is None:
+            keys = self._read_keys()
+        rows: Dict[str, int] = {}
+        for idx, v in enumerate(keys, start=1):
+            if v:
+                rows.setdefault(str(v), idx)
+        with self._lock:
+            self._rows = rows
+            self._last_row = len(keys)
+            self._built_at = time.monotonic()
+        log.info("Индекс листа %s перестроен: %d строк", self.name, len(keys))
+
+    @property
+    def last_row(self) -> int:
+        return self._last_row
+
+    def find(self, key: Any, refresh: bool = True) -> Optional[int]:
+        key = str(key)
+        with self._lock:
+            row = self._rows.get(key)
+            built_at = self._built_at
+        if row or (built_at is not None and (
+                not refresh or time.monotonic() - built_at < SHEET_INDEX_MIN_REBUILD)):
+            return row
+        self.rebuild()
+        with self._lock:
+            return self._rows.get(key)
+
+    def add(self, key: Any, row: int) -> None:
+        with self._lock:
+            if self._built_at is None:
+                return  # построится целиком при первом поиске
+            expected = self._last_row + 1
+            if row == expected:
+                self._rows.setdefault(str(key), row)
+                self._last_row = row
+                return
+        log.warning("Лист %s изменён вне бота (строка %d, ожидали %d) — перестраиваем индекс",
+                    self.name, row, expected)
+        self.rebuild()
+        with self._lock:
+            self._last_row = max(self._last_row, row)
+
+
+def appended_row(response: Any) -> Optional[int]:
+    """Номер первой строки из ответа append ('Лист1'!A5:Q5 -> 5)."""
+    try:
+        rng = response["updates"]["updatedRange"]
+    except (TypeError, KeyError):
+        return None
+    m = re.search(r"!\$?[A-Z]+\$?(\d+)", rng)
+    return int(m.group(1)) if m else None
+
+
+ORDERS_INDEX = SheetRowIndex("Лист1", lambda: ORDERS_SHEET.col_values(1))
+DRIVERS_INDEX = SheetRowIndex("drivers", lambda: DRIVERS_SHEET.col_values(1))
+
+
+# ---------- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ GOOGLE SHEETS ----------
+# Записи в таблицу не блокируют хендлеры: они ставятся в очередь SheetWriter.
+# Остальные функции блокирующие и вызываются через SHEETS (SheetsGateway).
+# Ошибки API они не глушат: повторы, квоты и логирование — забота шлюза.
+
+def save_order_to_sheet(order: Order) -> None:
+    """Поставить новый заказ в очередь на запись в Лист1."""
+    values = [
+        order.order_id,
+        order.user_id,
+        order.username,
+        order.pickup,
+        order.destination or "",
+        order.car_class,
+        order.time,
+        order.hours_text,
+        order.contact,
+        order.approx_price,
+        order.created_at or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        order.status or "new",
+        order.driver_id or "",
+        order.driver_name or "",
+        "",  # arrived_at
+        "",  # finished_at
+        "",  # duration_min
+    ]
+    ORDER_WRITER.set_cells(order.order_id, dict(enumerate(values, start=1)), priority=PRIO_ORDER)
+
+
+def find_order_row(order_id: str) -> Optional[int]:
+    """Найти номер строки заказа по order_id."""
+    return ORDERS_INDEX.find(order_id)
+
+
+def update_order_driver_and_status(order_id: str, status: str,
+                                   driver_id: Optional[int] = None,
+                                   driver_name: Optional[str] = None) -> None:
+    """Обновить статус и водителя (L, M, N)."""
+    ORDER_WRITER.set_cells(order_id, {
+        12: status,
+        13: str(driver_id) if driver_id else "",
+        14: driver_name or "",
+    })
+
+
+def update_order_arrived(order_id: str, arrived_at: datetime) -> None:
+    ORDER_WRITER.set_cells(order_id, {15: arrived_at.strftime("%Y-%m-%d %H:%M:%S")})
+
+
+def update_order_finished(order_id: str,
+                          arrived_at: Optional[datetime],
+                          finished_at: datetime) -> None:
+    cells: Dict[int, Any] = {12: "finished", 16: finished_at.strftime("%Y-%m-%d %H:%M:%S")}
+    if arrived_at:
+        cells[17] = int((finished_at - arrived_at).total_seconds() // 60)
+    ORDER_WRITER.set_cells(order_id, cells)
+
+
+def write_sheet_cells(ws: Any, index: "SheetRowIndex",
+                      changes: Dict[str, Dict[int, Any]], refresh_new: bool,
+                      recheck: Optional[Set[str]] = None) -> Set[str]:
+    """
+    Записать накопленные изменения: существующие строки — одним batch_update,
+    новые (в изменениях есть колонка A) — одним append_rows.
+    changes: ключ (колонка A) -> {номер колонки: значение}.
+    recheck: новые строки, чей прошлый append мог пройти, — перед записью
+    индекс перечитывается, найденные обновляются, а не дописываются заново.
+    Возвращает ключи обновлений, чьих строк на листе пока нет (строку
+    дописывает другая реплика) — они не записаны.
+    """
+    from gspread.utils import rowcol_to_a1
+
+    if recheck:
+        index.rebuild()
+    updates = []
+    new_rows = []
+    missed: Set[str] = set()
+    for key, cells in changes.items():
+        row = index.find(key, refresh=(refresh_new or 1 not in cells) and not recheck)
+        if row:
+            for col, value in sorted(cells.items()):
+                updates.append({"range": rowcol_to_a1(row, col), "values": [[value]]})
+        elif 1 in cells:
+            new_rows.append((key, [cells.get(col, "") for col in range(1, max(cells) + 1)]))
+        else:
+            missed.add(key)
+
+    if updates:
+        ws.batch_update(updates, value_input_option="USER_ENTERED")
+    if new_rows:
+        resp = ws.append_rows([values for _, values in new_rows], value_input_option="USER_ENTERED")
+        first = appended_row(resp)
+        if first:
+            for offset, (key, _) in enumerate(new_rows):
+                index.add(key, first + offset)
+    return missed
+
+
+def find_driver_row(driver_id: int) -> Optional[int]:
+    """Найти строку водителя по driver_id в листе drivers."""
+    return DRIVERS_INDEX.find(driver_id)
+
+
+def get_driver_info(driver_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Формат строки в drivers:
+    A: driver_id
+    B: driver_name
+    C: car_class
+    D: plate
+    E: car_photo_file_ids (через |)
+    F: rating
+    G: last_lat
+    H: last_lon
+    I: last_update
+    """
+    row = find_driver_row(driver_id)
+    if not row:
+        return None
+    values = DRIVERS_SHEET.row_values(row)
+    while len(values) < 9:
+        values.append("")
+    photos_raw = values[4] or ""
+    car_photos = [p for p in photos_raw.split("|") if p.strip()]
+    info = {
+        "driver_id": values[0],
+        "driver_name": values[1],
+        "car_class": values[2],
+        "plate": values[3],
+        "car_photos": car_photos,
+        "rating": values[5],
+        "last_lat": values[6],
+        "last_lon": values[7],
+        "last_update": values[8],
+    }
+    DRIVER_CACHE.set(str(driver_id), info)
+    return info
+
+
+def upsert_driver(driver_id: int,
+                  driver_name: str,
+                  car_class: str,
+                  plate: str,
+                  photo_file_ids: List[str]) -> None:
+    """Создать/обновить запись водителя (фото храним 'id1|id2|id3')."""
+    photos_str = "|".join(photo_file_ids) if photo_file_ids else ""
+    DRIVER_WRITER.set_cells(str(driver_id), {
+        1: str(driver_id),
+        2: driver_name,
+        3: car_class,
+        4: plate,
+        5: photos_str,
+    })
+
+
+def find_last_order_of_user(user_id: int) -> Optional[str]:
+    """Последний заказ клиента в Лист1 (поиск с конца таблицы), затем в архиве."""
+    col_user = ORDERS_SHEET.col_values(2)  # user_id
+    col_order = ORDERS_SHEET.col_values(1)
+    for idx in range(min(len(col_user), len(col_order)) - 1, 0, -1):
+        if col_user[idx] and str(col_user[idx]) == str(user_id):
+            return col_order[idx]
+    return ARCHIVE_INDEX.last_order_of(user_id)
+
+
+def _int_or_none(value: str) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_recent_orders(hours: float, tail_rows: int) -> List[Dict[str, Any]]:
+    """
+    Незавершённые заказы за последние hours часов из хвоста Лист1
+    (последние tail_rows строк, одним batch_get). Индекс строк уже построен.
+    """
+    last = ORDERS_INDEX.last_row
+    first = max(2, last - tail_rows + 1)
+    if last < first:
+        return []
+    rows = ORDERS_SHEET.batch_get([f"A{first}:Q{last}"])[0]
+    since = datetime.now() - timedelta(hours=hours)
+    orders = []
+    for values in rows:
+        values = list(values) + [""] * (17 - len(values))
+        if not values[0] or values[11] not in ("new", "assigned", "on_place"):
+            continue
+        try:
+            created = datetime.strptime(values[10], "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            continue
+        if created < since:
+            continue
+        arrived_at = None
+        if values[14]:
+            with suppress(ValueError):
+                arrived_at = datetime.strptime(values[14], "%Y-%m-%d %H:%M:%S")
+        orders.append({
+            "order_id": values[0],
+            "user_id": _int_or_none(values[1]),
+            "username": values[2],
+            "pickup": values[3],
+            "destination": values[4],
+            "car_class": values[5],
+            "time": values[6],
+            "hours_text": values[7],
+            "contact": values[8],
+            "approx_price": values[9],
+            "created_at": values[10],
+            "status": values[11],
+            "driver_id": _int_or_none(values[12]),
+            "driver_name": values[13] or None,
+            "arrived_at": arrived_at,
+        })
+    return orders
+
+
+def get_order_driver_id(order_id: str) -> Optional[int]:
+    """driver_id из строки заказа (колонка M) или None. Старые заказы ищем в архиве."""
+    ws = ORDERS_SHEET
+    row = find_order_row(order_id)
+    if not row:
+        archive = ARCHIVE_INDEX.sheet_of(order_id)
+        if not archive:
+            return None
+        ws = SHEETS_CONN.worksheet(archive)
+        col = ws.col_values(1)
+        if order_id not in col:
+            return None
+        row = col.index(order_id) + 1
+    row_vals = ws.row_values(row)
+    if len(row_vals) >= 13 and row_vals[12]:
+        return int(row_vals[12])
+    return None
+
+
+# ---------- ОГРАНИЧЕНИЕ СКОРОСТИ ----------
+
+class PriorityTokenBucket:
+    """
+    Token bucket: rate токенов в секунду, в запасе не больше capacity.
+    Если токенов нет, ожидающие получают их по приоритету
+    (меньшее число — важнее), при равном приоритете — по очереди.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        if rate <= 0 or capacity < 1:
+            raise ValueError(f"token bucket needs rate > 0 and capacity >= 1, got {rate}, {capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def waiting(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    def idle(self) -> bool:
+        """Полон и никто не ждёт — можно выбросить."""
+        self._refill()
+        return not self._waiters and self._tokens >= self.capacity
+
+    async def acquire(self, priority: int = 0) -> bool:
+        """Дождаться токена. True — если пришлось ждать."""
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return False
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self._schedule()
+        await fut
+        return True
+
+    def _dispatch(self) -> None:
+        self._timer = None
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():  # ожидание отменили
+                continue
+            self._tokens -= 1
+            fut.set_result(None)
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self._timer is not None or not self._waiters:
+            return
+        delay = max(0.0, (1 - self._tokens) / self.rate)
+        self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+
+# ---------- ИСХОДЯЩИЕ СООБЩЕНИЯ TELEGRAM ----------
+# Лимиты Telegram: ~30 сообщений/с на бота, ~20 в минуту в группу,
+# в личку — не чаще ~1 в секунду. Все запросы бота с chat_id проходят через
+# OutboundRateLimiter: сначала корзина чата, затем общая; при нехватке
+# токенов первыми идут более важные (rate_limit_args — приоритет, меньше — важнее).
+
+OUT_GLOBAL_PER_SEC = float(os.environ.get("OUT_GLOBAL_PER_SEC", "30"))
+OUT_GROUP_PER_MIN = float(os.environ.get("OUT_GROUP_PER_MIN", "20"))
+OUT_GROUP_BURST = 3
+OUT_CHAT_PER_SEC = float(os.environ.get("OUT_CHAT_PER_SEC", "1"))
+OUT_CHAT_BURST = 3
+OUT_MAX_RETRIES = int(os.environ.get("OUT_MAX_RETRIES", "3"))
+OUT_MAX_BUCKETS = 10000
+
+# корзина группы пополняется на (OUT_GROUP_PER_MIN - OUT_GROUP_BURST) в минуту
+assert OUT_GROUP_PER_MIN > OUT_GROUP_BURST, f"OUT_GROUP_PER_MIN must be greater than {OUT_GROUP_BURST}"
+assert OUT_GLOBAL_PER_SEC > 0 and OUT_CHAT_PER_SEC > 0, "OUT_GLOBAL_PER_SEC and OUT_CHAT_PER_SEC must be positive"
+
+# приоритеты: срочные заказы → уведомления в личку → публикации в группе
+OUT_PRIO_URGENT, OUT_PRIO_NOTICE, OUT_PRIO_GROUP = range(3)
+
+
+class OutboundRateLimiter(BaseRateLimiter[int]):
+    """
+    Планировщик исходящих запросов для Application.builder().rate_limiter(...).
+    На RetryAfter ждёт, сколько просит Telegram, и повторяет (до OUT_MAX_RETRIES раз).
+    """
+
+    def __init__(self) -> None:
+        self._global = PriorityTokenBucket(OUT_GLOBAL_PER_SEC, OUT_GLOBAL_PER_SEC)
+        self._chats: Dict[Any, PriorityTokenBucket] = {}
+        self.metrics = {"sent": 0, "waited": 0, "retry_after": 0, "dropped": 0, "in_flight": 0}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: Any) -> PriorityTokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= OUT_MAX_BUCKETS:
+                for idle_id in [key for key, value in self._chats.items() if value.idle()]:
+                    del self._chats[idle_id]
+            if str(chat_id).startswith("-"):
+                bucket = PriorityTokenBucket((OUT_GROUP_PER_MIN - OUT_GROUP_BURST) / 60, OUT_GROUP_BURST)
+            else:
+                bucket = PriorityTokenBucket(OUT_CHAT_PER_SEC, OUT_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def queue_depth(self) -> int:
+        return self._global.waiting() + sum(bucket.waiting() for bucket in self._chats.values())
+
+    def stats(self) -> str:
+        m = self.metrics
+        return (f"отправлено {m['sent']}, ждали лимита {m['waited']}, RetryAfter {m['retry_after']}, "
+                f"потеряно {m['dropped']}, в очереди {self.queue_depth()}")
+
+    async def process_request(self, callback: Callable[..., Any], args: Any, kwargs: Dict[str, Any],
+                              endpoint: str, data: Dict[str, Any], rate_limit_args: Optional[int]) -> Any:
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)  # answerCallbackQuery, getMe и т.п.
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        else:
+            priority = OUT_PRIO_GROUP if str(chat_id).startswith("-") else OUT_PRIO_NOTICE
+        self.metrics["in_flight"] += 1
+        try:
+            for attempt in itertools.count():
+                waited = await self._chat_bucket(chat_id).acquire(priority)
+                waited = await self._global.acquire(priority) or waited
+                self.metrics["waited"] += waited
+                try:
+                    result = await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    self.metrics["retry_after"] += 1
+                    if attempt >= OUT_MAX_RETRIES:
+                        self.metrics["dropped"] += 1
+                        raise
+                    log.warning("Telegram RetryAfter %s с (%s, чат %s), повтор %d",
+                                e.retry_after, endpoint, chat_id, attempt + 1)
+                    await asyncio.sleep(float(e.retry_after))
+                    continue
+                self.metrics["sent"] += 1
+                return result
+        finally:
+            self.metrics["in_flight"] -= 1
+
+
+OUTBOUND = OutboundRateLimiter()
+
+
+# ---------- АСИНХРОННЫЙ ШЛЮЗ GOOGLE SHEETS ----------
+
+SHEETS_MAX_WORKERS = int(os.environ.get("SHEETS_MAX_WORKERS", "4"))
+SHEETS_CALL_TIMEOUT = float(os.environ.get("SHEETS_CALL_TIMEOUT", "15"))
+# квота Sheets API на запросы в минуту и допустимый всплеск
+SHEETS_QUOTA_PER_MIN = float(os.environ.get("SHEETS_QUOTA_PER_MIN", "60"))
+SHEETS_BURST = float(os.environ.get("SHEETS_BURST", "5"))
+assert SHEETS_QUOTA_PER_MIN > 0 and SHEETS_BURST >= 1, "SHEETS_QUOTA_PER_MIN must be positive, SHEETS_BURST at least 1"
+SHEETS_MAX_RETRIES = int(os.environ.get("SHEETS_MAX_RETRIES", "4"))
+SHEETS_BACKOFF_BASE = float(os.environ.get("SHEETS_BACKOFF_BASE", "1"))
+SHEETS_BACKOFF_MAX = float(os.environ.get("SHEETS_BACKOFF_MAX", "16"))
+SHEETS_RETRY_STATUSES = (429, 500, 502, 503, 504)
+SHEETS_TOKEN_WAIT = 60.0  # дольше поток пула квоту не ждёт
+
+# приоритеты запросов: создание заказа > смена статуса > геопозиция
+PRIO_ORDER, PRIO_STATUS, PRIO_LOCATION = range(3)
+
+
+def sheets_error_status(e: Exception) -> Optional[int]:
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+
+def is_retryable_sheets_error(e: Exception) -> bool:
+    """429/5xx от API или сетевая ошибка (таймаут шлюза не повторяем)."""
+    status = sheets_error_status(e)
+    if status is not None:
+        return status in SHEETS_RETRY_STATUSES
+    return isinstance(e, OSError) and not isinstance(e, asyncio.TimeoutError)
+
+
+class SheetsGateway:
+    """
+    gspread делает блокирующие HTTP-запросы, поэтому все вызовы выполняем
+    в отдельном пуле потоков: цикл событий бота в это время обрабатывает
+    другие апдейты. Семафор не даёт копиться очереди в пуле: слот
+    освобождается, когда поток действительно закончил, а не по таймауту
+    ожидающего (поток по таймауту не прервать).
+    Квота Sheets API считается по HTTP-запросам, а не по вызовам: один вызов
+    (запись с перестройкой индекса, архивация) делает несколько запросов.
+    Поэтому токен из бакета берёт каждый запрос gspread (request, из потока
+    пула, с приоритетом своего вызова), и 429 повторяется там же — только
+    этот запрос. Вызов целиком повторяется на 5xx и сетевые ошибки,
+    если он идемпотентен (retry=True). Задержки — экспонента с джиттером.
+    """
+
+    def __init__(self, max_workers: int, timeout: float) -> None:
+        self.timeout = timeout
+        self.metrics = {"calls": 0, "throttled": 0, "retried": 0, "failed": 0, "timeouts": 0}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets")
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._bucket = PriorityTokenBucket(SHEETS_QUOTA_PER_MIN / 60, SHEETS_BURST)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._local = threading.local()  # приоритет вызова, который выполняет поток
+        self._metrics_lock = threading.Lock()  # счётчики меняют и цикл, и потоки пула
+
+    def _count(self, name: str) -> None:
+        with self._metrics_lock:
+            self.metrics[name] += 1
+
+    def _run(self, priority: int, func: Callable[..., Any], args: Any, kwargs: Any) -> Any:
+        self._local.priority = priority
+        return func(*args, **kwargs)
+
+    def _take_token(self) -> None:
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass  # поток пула: цикла в нём нет, ждём токен у цикла бота
+        else:
+            return  # не из потока пула — ждать цикл отсюда нельзя
+        waiter = asyncio.run_coroutine_threadsafe(
+            self._bucket.acquire(getattr(self._local, "priority", PRIO_STATUS)), loop)
+        try:
+            if waiter.result(timeout=SHEETS_TOKEN_WAIT):
+                self._count("throttled")
+        except Exception:
+            waiter.cancel()
+            raise
+
+    def request(self, send: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Один HTTP-запрос к API (из потока пула): токен квоты, на 429 — повтор запроса."""
+        attempt = 0
+        while True:
+            self._take_token()
+            try:
+                return send(*args, **kwargs)
+            except Exception as e:
+                if attempt >= SHEETS_MAX_RETRIES or sheets_error_status(e) != 429:
+                    raise
+                delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** attempt))
+                attempt += 1
+                self._count("retried")
+                log.warning("Google Sheets: 429, повтор запроса %d через %.1f с", attempt, delay)
+                time.sleep(delay)
+
+    async def call(self, func: Callable[..., Any], *args: Any,
+                   priority: int = PRIO_STATUS, timeout: Optional[float] = None,
+                   default: Any = None, retry: bool = True, wait: bool = False, **kwargs: Any) -> Any:
+        """
+        Выполнить func(*args, **kwargs) в пуле. Если не удалось — default.
+        retry=False — не повторять func целиком (она не идемпотентна: повтор
+        после частичного успеха задвоит строки).
+        wait=True — по таймауту не бросать поток, а дождаться его исхода:
+        для записей, где «не знаю, записалось ли» хуже ожидания.
+        """
+        loop = self._loop = asyncio.get_running_loop()
+        self._count("calls")
+        attempt = 0
+        while True:
+            await self._semaphore.acquire()
+            future = loop.run_in_executor(self._executor, self._run, priority, func, args, kwargs)
+            future.add_done_callback(lambda _: self._semaphore.release())
+            try:
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+                except asyncio.TimeoutError:
+                    self._count("timeouts")
+                    if not wait:
+                        raise
+                    log.warning("Google Sheets: %s дольше %.0f с — ждём завершения",
+                                func.__name__, timeout or self.timeout)
+                    return await future
+            except Exception as e:
+                if retry and attempt < SHEETS_MAX_RETRIES and is_retryable_sheets_error(e):
+                    delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** attempt))
+                    attempt += 1
+                    self._count("retried")
+                    log.warning("Google Sheets: %s — ошибка %s, повтор %d через %.1f с",
+                                func.__name__, e, attempt, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                self._count("failed")
+                if isinstance(e, asyncio.TimeoutError):
+                    log.error("Google Sheets: таймаут вызова %s", func.__name__)
+                else:
+                    log.error("Google Sheets: ошибка вызова %s: %s", func.__name__, e)
+                return default
+
+    def stats(self) -> str:
+        with self._metrics_lock:
+            m = dict(self.metrics)
+        return (f"{m['calls']} вызовов, ждали квоту {m['throttled']}, "
+                f"повторов {m['retried']}, таймаутов {m['timeouts']}, ошибок {m['failed']}")
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+SHEETS = SheetsGateway(SHEETS_MAX_WORKERS, SHEETS_CALL_TIMEOUT)
+
+
+async def load_driver_info(driver_id: int) -> Optional[Dict[str, Any]]:
+    """Профиль водителя: кэш -> SQLite -> лист drivers (водители, заведённые вручную)."""
+    info = DRIVER_CACHE.get(str(driver_id))
+    if info is None:
+        info = await store_call(STORE.get_driver, driver_id)
+        if info is None:
+            info = await SHEETS.call(get_driver_info, driver_id)
+            if info is not None:
+                await store_call(STORE.save_driver, info)
+        if info is not None:
+            DRIVER_CACHE.set(str(driver_id), info)
+    return info
+
+
+async def register_driver(driver_id: int, driver_name: str, car_class: str,
+                          plate: str, photo_file_ids: List[str]) -> None:
+    """Сохранить профиль водителя локально и поставить запись в лист drivers."""
+    known = DRIVER_CACHE.get(str(driver_id)) or await store_call(STORE.get_driver, driver_id) or {
+        "rating": "", "last_lat": "", "last_lon": "", "last_update": "",
+    }
+    info = {
+        **known,
+        "driver_id": str(driver_id),
+        "driver_name": driver_name,
+        "car_class": car_class,
+        "plate": plate,
+        "car_photos": list(photo_file_ids or []),
+    }
+    await store_call(STORE.save_driver, info)
+    DRIVER_CACHE.set(str(driver_id), info)
+    upsert_driver(driver_id, driver_name, car_class, plate, photo_file_ids)
+
+
+# ---------- ЗЕРКАЛО В GOOGLE SHEETS ----------
+
+SHEET_FLUSH_INTERVAL = float(os.environ.get("SHEET_FLUSH_INTERVAL", "0.5"))
+# сколько ждать строку, которую дописывает другая реплика, прежде чем бросить обновление
+SHEET_MISSING_TTL = float(os.environ.get("SHEET_MISSING_TTL", "600"))
+
+
+class SheetWriter:
+    """
+    Write-behind очередь изменений одного листа.
+    Изменения копятся по ключу строки (повторная запись той же ячейки
+    заменяет предыдущую) и раз в interval секунд уходят одним batch_update
+    (+ append_rows для новых строк). Очередь дублируется в SQLite,
+    поэтому доставка at-least-once переживает и ошибки API, и рестарт.
+    Запись не повторяется целиком и по таймауту не бросается: исход append
+    нужно знать точно. Новые строки из неудавшейся записи перед повтором
+    ищутся в свежем индексе — append мог пройти до ошибки.
+    Обновление строки, которой ещё нет в индексе (её дописывает другая
+    реплика), остаётся в очереди до перестройки индекса; дольше
+    SHEET_MISSING_TTL — бросается с ошибкой в логе.
+    """
+
+    def __init__(self, name: str, worksheet: Callable[[], Any], index: SheetRowIndex,
+                 interval: float, refresh_new: bool = False) -> None:
+        self.name = name
+        self.interval = interval
+        self._worksheet = worksheet
+        self._index = index
+        self._refresh_new = refresh_new
+        self._pending: Dict[str, Dict[int, Any]] = {}
+        self._unsure: Set[str] = set()  # новые строки, чей append мог пройти
+        self._missing: Dict[str, float] = {}  # ключ -> когда строку впервые не нашли
+        self._priority = PRIO_LOCATION
+        self.lock = asyncio.Lock()
+        self._stop = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def set_cells(self, key: str, cells: Dict[int, Any], priority: int = PRIO_STATUS) -> None:
+        self._pending.setdefault(key, {}).update(cells)
+        self._priority = min(self._priority, priority)
+        store_submit(STORE.outbox_put, self.name, key, cells)
+
+    def load(self) -> None:
+        """Поднять из SQLite то, что не успели записать до рестарта."""
+        for key, cells in STORE.outbox_load(self.name).items():
+            self._pending[key] = {**cells, **self._pending.get(key, {})}
+        if self._pending:
+            self._priority = PRIO_ORDER
+            log.info("Лист %s: в очереди %d строк с прошлого запуска", self.name, len(self._pending))
+
+    async def flush(self) -> None:
+        async with self.lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            priority, self._priority = self._priority, PRIO_LOCATION
+            recheck = self._unsure & batch.keys()
+            missed = await SHEETS.call(write_sheet_cells, self._worksheet(), self._index, batch,
+                                       self._refresh_new, recheck, priority=priority, default=None,
+                                       retry=False, wait=True)
+            if missed is None:
+                # возвращаем в очередь, не затирая более свежие значения
+                for key, cells in batch.items():
+                    self._requeue(key, cells)
+                    if 1 in cells:
+                        self._unsure.add(key)
+                self._priority = min(self._priority, priority)
+                return
+            self._unsure -= batch.keys()
+            now = time.monotonic()
+            for key in list(missed):
+                first = self._missing.setdefault(key, now)
+                if now - first < SHEET_MISSING_TTL:
+                    self._requeue(key, batch.pop(key))
+                    continue
+                log.error("Строка %s не найдена на листе %s за %.0f с, изменения пропущены",
+                          key, self._index.name, now - first)
+                del self._missing[key]
+            for key in batch:
+                self._missing.pop(key, None)
+            if batch:
+                await store_call(STORE.outbox_done, self.name, batch, ordered=True)
+
+    def _requeue(self, key: str, cells: Dict[int, Any]) -> None:
+        self._pending[key] = {**cells, **self._pending.get(key, {})}
+
+    async def _run(self) -> None:
+        # пока таблица не подключена, изменения только копятся
+        waiters = [asyncio.ensure_future(SHEETS_READY.wait()), asyncio.ensure_future(self._stop.wait())]
+        _, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+        while not self._stop.is_set():
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._stop.wait(), self.interval)
+            await self.flush()
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            await self._task
+            self._task = None
+        if SHEETS_READY.is_set():
+            await self.flush()
+        if self._pending:
+            log.error("Лист %s: %d строк не записано, допишем после рестарта",
+                      self.name, len(self._pending))
+
+
+SHEETS_READY = asyncio.Event()  # таблица подключена, индексы строк построены
+SHEETS_WARMUP_RETRY = float(os.environ.get("SHEETS_WARMUP_RETRY", "10"))
+
+
+async def warm_up_sheets() -> None:
+    """Фоновое подключение к таблице после старта; до успеха — повторы."""
+    started = time.monotonic()
+    while True:
+        ok = await SHEETS.call(ORDERS_INDEX.rebuild, default=False) is not False
+        ok = ok and await SHEETS.call(DRIVERS_INDEX.rebuild, default=False) is not False
+        if ok:
+            break
+        log.warning("Google Sheets недоступны, повтор через %.0f с", SHEETS_WARMUP_RETRY)
+        await asyncio.sleep(SHEETS_WARMUP_RETRY)
+    SHEETS_READY.set()
+    log.info("Google Sheets подключены за %.2f с", time.monotonic() - started)
+    await restore_from_sheet()
+
+
+RESTORE_HOURS = float(os.environ.get("RESTORE_HOURS", "24"))
+RESTORE_TAIL_ROWS = int(os.environ.get("RESTORE_TAIL_ROWS", "500"))
+
+
+async def restore_from_sheet() -> None:
+    """
+    Тёплый рестарт: незавершённые заказы из Лист1, которых нет в SQLite
+    (например, после редеплоя без постоянного диска), возвращаем в работу
+    вместе со связками чата клиент ↔ водитель.
+    """
+    started = time.monotonic()
+    orders = await SHEETS.call(load_recent_orders, RESTORE_HOURS, RESTORE_TAIL_ROWS, default=[])
+    restored = 0
+    for data in orders:
+        if await get_order(data["order_id"]) is not None:
+            continue  # локальная копия свежее таблицы
+        order = Order.from_dict(data)
+        await save_order(order)
+        restored += 1
+        for user_id in (order.user_id, order.driver_id):
+            if not user_id:
+                continue
+            remember_user_order(user_id, order.order_id)
+            if order.status in ("assigned", "on_place") and order.driver_id:
+                await link_chat(user_id, order.order_id)
+    log.info("Из таблицы восстановлено заказов: %d (просмотрено %d) за %.2f с",
+             restored, len(orders), time.monotonic() - started)
+
+
+# ---------- АРХИВ ЗАКАЗОВ ----------
+# Завершённые заказы старше ARCHIVE_AFTER_DAYS переносятся из Лист1
+# в помесячные листы orders_YYYY_MM, чтобы рабочий лист оставался маленьким.
+# В archive_manifest пишется, какой заказ в каком листе лежит.
+
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", "7"))
+ARCHIVE_MAX_ROWS = int(os.environ.get("ARCHIVE_MAX_ROWS", "5000"))  # предел размера Лист1
+ARCHIVE_INTERVAL_HOURS = float(os.environ.get("ARCHIVE_INTERVAL_HOURS", "6"))
+ARCHIVE_MANIFEST = "archive_manifest"
+ARCHIVE_MANIFEST_HEADER = ["order_id", "user_id", "sheet", "archived_at"]
+
+ARCHIVE_STATS: Dict[str, Any] = {"runs": 0, "moved": 0, "last_run": None, "last_moved": 0}
+
+
+class ArchiveIndex:
+    """
+    order_id -> лист архива и user_id -> последний архивный заказ.
+    Манифест читается только при первом поиске заказа, которого нет в Лист1.
+    """
+
+    def __init__(self) -> None:
+        self._orders: Optional[Dict[str, str]] = None
+        self._users: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _loaded(self) -> Dict[str, str]:
+        with self._lock:
+            if self._orders is None:
+                ws = SHEETS_CONN.worksheet_or_none(ARCHIVE_MANIFEST)
+                self._orders, self._users = {}, {}
+                for values in (ws.get_all_values()[1:] if ws else []):
+                    self._add(values)
+            return self._orders
 
+    def _add(self, values: List[str]) -> None:
+        values = list(values) + [""] * (3 - len(values))
+        order_id, user_id, sheet = values[:3]
+        if order_id and sheet:
+            self._orders[order_id] = sheet
+            if user_id:
+                self._users[str(user_id)] = order_id
 
-# ---------- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ GOOGLE SHEETS ----------
+    def add(self, entries: List[List[str]]) -> None:
+        with self._lock:
+            if self._orders is not None:
+                for values in entries:
+                    self._add(values)
 
-def save_order_to_sheet(order: Dict[str, Any]) -> None:
-    """Записать новый заказ в Лист1."""
-    try:
-        ORDERS_SHEET.append_row(
-            [
-                order.get("order_id"),
-                order.get("user_id"),
-                order.get("username"),
-                order.get("pickup"),
-                order.get("destination", ""),
-                order.get("car_class"),
-                order.get("time"),
-                order.get("hours_text"),
-                order.get("contact"),
-                order.get("approx_price"),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                order.get("status", "new"),
-                order.get("driver_id") or "",
-                order.get("driver_name") or "",
-                "",  # arrived_at
-                "",  # finished_at
-                "",  # duration_min
-            ],
-            value_input_option="USER_ENTERED",
-        )
-        log.info("Заказ записан в Google Sheets")
-    except Exception as e:
-        log.error("Ошибка записи заказа в таблицу: %s", e)
+    def sheet_of(self, order_id: str) -> Optional[str]:
+        return self._loaded().get(order_id)
 
+    def last_order_of(self, user_id: Any) -> Optional[str]:
+        self._loaded()
+        return self._users.get(str(user_id))
 
-def find_order_row(order_id: str) -> Optional[int]:
-    """Найти номер строки заказа по order_id."""
-    try:
-        col = ORDERS_SHEET.col_values(1)
-        for idx, v in enumerate(col, start=1):
-            if v == order_id:
-                return idx
-    except Exception as e:
-        log.error("Ошибка поиска заказа: %s", e)
-    return None
 
+ARCHIVE_INDEX = ArchiveIndex()
 
-def update_order_driver_and_status(order_id: str, status: str,
-                                   driver_id: Optional[int] = None,
-                                   driver_name: Optional[str] = None) -> None:
-    """Обновить статус и водителя."""
-    row = find_order_row(order_id)
-    if not row:
-        return
+
+def _parse_sheet_time(value: str) -> Optional[datetime]:
     try:
-        ORDERS_SHEET.update_cell(row, 12, status)
-        ORDERS_SHEET.update_cell(row, 13, str(driver_id) if driver_id else "")
-        ORDERS_SHEET.update_cell(row, 14, driver_name or "")
-    except Exception as e:
-        log.error("Ошибка обновления статуса заказа: %s", e)
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
 
 
-def update_order_arrived(order_id: str, arrived_at: datetime) -> None:
-    row = find_order_row(order_id)
-    if not row:
+def archive_finished_orders(after_days: float, max_rows: int) -> Dict[str, int]:
+    """
+    Перенести завершённые заказы из Лист1 в помесячные листы.
+    Берём заказы, завершённые раньше after_days дней назад, а если Лист1
+    всё равно длиннее max_rows — ещё и самые старые из остальных завершённых.
+    Возвращает {лист архива: перенесено строк}.
+    Прогон можно повторить после сбоя на любом шаге: заказы, которые уже
+    есть в листе месяца или в манифесте, туда второй раз не дописываются,
+    а из Лист1 удаляются как обычно.
+    """
+    rows = ORDERS_SHEET.get_all_values()
+    if len(rows) < 2:
+        return {}
+    cutoff = datetime.now() - timedelta(days=after_days)
+
+    finished = []  # индексы строк (с 0) в порядке добавления
+    for idx, values in enumerate(rows[1:], start=1):
+        values += [""] * (17 - len(values))
+        if values[0] and values[11] == "finished":
+            finished.append(idx)
+    selected = [idx for idx in finished
+                if (_parse_sheet_time(rows[idx][15]) or datetime.now()) < cutoff]
+    excess = len(rows) - 1 - len(selected) - max_rows
+    if excess > 0:
+        chosen = set(selected)
+        selected += [idx for idx in finished if idx not in chosen][:excess]
+        selected.sort()
+    if not selected:
+        return {}
+
+    by_sheet: Dict[str, List[int]] = {}
+    for idx in selected:
+        created = _parse_sheet_time(rows[idx][10]) or _parse_sheet_time(rows[idx][15]) or datetime.now()
+        by_sheet.setdefault(created.strftime("orders_%Y_%m"), []).append(idx)
+
+    archived_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    manifest_ws = SHEETS_CONN.ensure_worksheet(ARCHIVE_MANIFEST, ARCHIVE_MANIFEST_HEADER)
+    in_manifest = set(manifest_ws.col_values(1)[1:])
+    manifest = []
+    for title, indexes in by_sheet.items():
+        ws = SHEETS_CONN.ensure_worksheet(title, rows[0])
+        in_sheet = set(ws.col_values(1)[1:])
+        fresh = [rows[idx] for idx in indexes if rows[idx][0] not in in_sheet]
+        if fresh:
+            ws.append_rows(fresh, value_input_option="USER_ENTERED")
+        manifest += [[rows[idx][0], rows[idx][1], title, archived_at]
+                     for idx in indexes if rows[idx][0] not in in_manifest]
+    if manifest:
+        manifest_ws.append_rows(manifest, value_input_option="USER_ENTERED")
+        ARCHIVE_INDEX.add(manifest)
+
+    # удаляем одним batch_update, непрерывными диапазонами снизу вверх
+    ranges: List[List[int]] = []
+    for idx in selected:
+        if ranges and ranges[-1][1] == idx:
+            ranges[-1][1] = idx + 1
+        else:
+            ranges.append([idx, idx + 1])
+    sheet_id = ORDERS_SHEET.id
+    SHEETS_CONN.spreadsheet().batch_update({"requests": [
+        {"deleteDimension": {"range": {
+            "sheetId": sheet_id, "dimension": "ROWS", "startIndex": start, "endIndex": end,
+        }}}
+        for start, end in reversed(ranges)
+    ]})
+
+    moved = set(selected)
+    ORDERS_INDEX.rebuild([values[0] for idx, values in enumerate(rows) if idx not in moved])
+    return {title: len(indexes) for title, indexes in by_sheet.items()}
+
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая архивация (JobQueue)."""
+    if not SHEETS_READY.is_set():
         return
-    try:
-        ORDERS_SHEET.update_cell(row, 15, arrived_at.strftime("%Y-%m-%d %H:%M:%S"))
-    except Exception as e:
-        log.error("Ошибка записи arrived_at: %s", e)
+    # перед переносом дописываем очередь, и пока строки сдвигаются — не пишем.
+    # Замок держим до конца потока (wait=True), целиком не повторяем (retry=False):
+    # незаконченный перенос доделает следующий прогон.
+    await ORDER_WRITER.flush()
+    async with ORDER_WRITER.lock:
+        moved = await SHEETS.call(archive_finished_orders, ARCHIVE_AFTER_DAYS, ARCHIVE_MAX_ROWS,
+                                  timeout=SHEETS_CALL_TIMEOUT * 4, retry=False, wait=True)
+    if moved is None:
+        return
+    total = sum(moved.values())
+    ARCHIVE_STATS["runs"] += 1
+    ARCHIVE_STATS["moved"] += total
+    ARCHIVE_STATS["last_run"] = datetime.now().strftime("%d.%m %H:%M")
+    ARCHIVE_STATS["last_moved"] = total
+    log.info("Архивация: перенесено %d строк %s", total, moved or "")
 
 
-def update_order_finished(order_id: str,
-                          arrived_at: Optional[datetime],
-                          finished_at: datetime) -> None:
-    row = find_order_row(order_id)
-    if not row:
-        return
-    try:
-        ORDERS_SHEET.update_cell(row, 16, finished_at.strftime("%Y-%m-%d %H:%M:%S"))
-        if arrived_at:
-            duration_min = int((finished_at - arrived_at).total_seconds() // 60)
-            ORDERS_SHEET.update_cell(row, 17, duration_min)
-    except Exception as e:
-        log.error("Ошибка записи finished_at/duration: %s", e)
+ORDER_WRITER = SheetWriter("Лист1", lambda: ORDERS_SHEET, ORDERS_INDEX, SHEET_FLUSH_INTERVAL)
+DRIVER_WRITER = SheetWriter("drivers", lambda: DRIVERS_SHEET, DRIVERS_INDEX, SHEET_FLUSH_INTERVAL,
+                            refresh_new=True)
+SHEET_WRITERS = (ORDER_WRITER, DRIVER_WRITER)
 
 
-def find_driver_row(driver_id: int) -> Optional[int]:
-    """Найти строку водителя по driver_id в листе drivers."""
-    try:
-        col = DRIVERS_SHEET.col_values(1)
-        for idx, v in enumerate(col, start=1):
-            if v and str(v) == str(driver_id):
-                return idx
-    except Exception as e:
-        log.error("Ошибка поиска водителя: %s", e)
-    return None
+# ---------- ГЕОЛОКАЦИЯ ВОДИТЕЛЕЙ ----------
+# Водители делятся живой геолокацией в личке с ботом; Telegram присылает
+# сообщение и потом его правки (edited_message) каждые несколько секунд.
+# Координаты живут в памяти процесса; в лист drivers (G/H/I) раз в
+# LOCATION_SHEET_INTERVAL уходит только последняя точка каждого водителя.
+# Апдейты водителя приходят в одну реплику (по chat_id), а распределяет
+# заказ реплика клиента, поэтому при общем хранилище реплики раз в
+# LOCATION_SYNC_INTERVAL обмениваются свежими точками через него.
 
+GEO_CELL_DEG = float(os.environ.get("GEO_CELL_DEG", "0.01"))  # ~1.1 км по широте
+LOCATION_MAX_AGE = float(os.environ.get("LOCATION_MAX_AGE", "900"))  # сек, старше — водитель не на линии
+LOCATION_SHEET_INTERVAL = float(os.environ.get("LOCATION_SHEET_INTERVAL", "60"))
+LOCATION_SYNC_INTERVAL = float(os.environ.get("LOCATION_SYNC_INTERVAL", "1"))
+LOCATION_SYNC_OVERLAP = 5.0  # сек: забираем с запасом на расхождение часов и долгие записи
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEG_LAT = 110.57
+KM_PER_DEG_LON = 111.32  # на экваторе, дальше × cos(широты)
 
-def get_driver_info(driver_id: int) -> Optional[Dict[str, Any]]:
+# модель ETA: прямая × коэффициент извилистости дорог / средняя скорость + подготовка
+ETA_SPEED_KMH = float(os.environ.get("ETA_SPEED_KMH", "30"))
+ETA_ROAD_FACTOR = float(os.environ.get("ETA_ROAD_FACTOR", "1.4"))
+ETA_BASE_MIN = float(os.environ.get("ETA_BASE_MIN", "3"))
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def eta_minutes(distance_km: Any) -> Any:
+    """Минуты до подачи по расстоянию (число или массив NumPy)."""
+    return ETA_BASE_MIN + distance_km * ETA_ROAD_FACTOR / ETA_SPEED_KMH * 60
+
+
+class DriverArrays:
     """
-    Формат строки в drivers:
-    A: driver_id
-    B: driver_name
-    C: car_class
-    D: plate
-    E: car_photo_file_ids (через |)
-    F: rating
-    G: last_lat
-    H: last_lon
-    I: last_update
+    Координаты водителей одного класса в массивах NumPy (в радианах, с готовым
+    cos широты), чтобы считать расстояния до всех водителей одной векторной операцией.
+    Слоты уехавших водителей переиспользуются; пустой слот — ts = -inf.
     """
-    row = find_driver_row(driver_id)
-    if not row:
-        return None
-    try:
-        values = DRIVERS_SHEET.row_values(row)
-        while len(values) < 9:
-            values.append("")
-        photos_raw = values[4] or ""
-        car_photos = [p for p in photos_raw.split("|") if p.strip()]
-        return {
-            "driver_id": values[0],
-            "driver_name": values[1],
-            "car_class": values[2],
-            "plate": values[3],
-            "car_photos": car_photos,
-            "rating": values[5],
-            "last_lat": values[6],
-            "last_lon": values[7],
-            "last_update": values[8],
-        }
-    except Exception as e:
-        log.error("Ошибка чтения данных водителя: %s", e)
-        return None
 
+    def __init__(self, capacity: int = 64) -> None:
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.lat = np.zeros(capacity)
+        self.lon = np.zeros(capacity)
+        self.cos_lat = np.zeros(capacity)
+        self.ts = np.full(capacity, -np.inf)
+        self.size = 0
+        self._slots: Dict[int, int] = {}
+        self._free: List[int] = []
+
+    def _grow(self) -> None:
+        capacity = len(self.ts)
+        self.ids = np.concatenate([self.ids, np.zeros(capacity, dtype=np.int64)])
+        self.lat = np.concatenate([self.lat, np.zeros(capacity)])
+        self.lon = np.concatenate([self.lon, np.zeros(capacity)])
+        self.cos_lat = np.concatenate([self.cos_lat, np.zeros(capacity)])
+        self.ts = np.concatenate([self.ts, np.full(capacity, -np.inf)])
+
+    def set(self, driver_id: int, lat: float, lon: float, ts: float) -> None:
+        slot = self._slots.get(driver_id)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                if self.size == len(self.ts):
+                    self._grow()
+                slot = self.size
+                self.size += 1
+            self._slots[driver_id] = slot
+            self.ids[slot] = driver_id
+        lat_rad = math.radians(lat)
+        self.lat[slot] = lat_rad
+        self.lon[slot] = math.radians(lon)
+        self.cos_lat[slot] = math.cos(lat_rad)
+        self.ts[slot] = ts
+
+    def discard(self, driver_id: int) -> None:
+        slot = self._slots.pop(driver_id, None)
+        if slot is not None:
+            self.ts[slot] = -np.inf
+            self._free.append(slot)
+
+    def distances_km(self, lat: float, lon: float) -> np.ndarray:
+        """Расстояния от точки до всех слотов (haversine, векторно)."""
+        n = self.size
+        lat_rad = math.radians(lat)
+        a = (np.sin((self.lat[:n] - lat_rad) / 2) ** 2
+             + math.cos(lat_rad) * self.cos_lat[:n] * np.sin((self.lon[:n] - math.radians(lon)) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class DriverLocationIndex:
+    """
+    Последние координаты водителей в сетке cell_deg × cell_deg, отдельно по классам авто.
+    Обновление — O(1): перекладываем водителя между ячейками.
+    k ближайших — обход колец ячеек вокруг точки, пока следующее кольцо
+    заведомо дальше k-го найденного; на редкой сетке — просто все занятые ячейки.
+    """
 
-def upsert_driver(driver_id: int,
-                  driver_name: str,
-                  car_class: str,
-                  plate: str,
-                  photo_file_ids: List[str]) -> None:
-    """Создать/обновить запись водителя (фото храним 'id1|id2|id3')."""
-    photos_str = "|".join(photo_file_ids) if photo_file_ids else ""
-    row = find_driver_row(driver_id)
-    try:
-        if row:
-            DRIVERS_SHEET.update(
-                f"A{row}:E{row}",
-                [[str(driver_id), driver_name, car_class, plate, photos_str]],
-            )
+    def __init__(self, cell_deg: float) -> None:
+        self.cell_deg = cell_deg
+        self._cells: Dict[str, Dict[Tuple[int, int], Set[int]]] = {}
+        self._arrays: Dict[str, DriverArrays] = {}
+        self._positions: Dict[int, Tuple[float, float, str, float]] = {}  # id -> lat, lon, класс, time()
+        self.dirty: Set[int] = set()  # ещё не записаны в таблицу
+        self.unshared: Set[int] = set()  # ещё не отданы другим репликам
+        self.synced_at = 0.0  # time(), с которого забирать точки других реплик
+        self.updates = 0
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def _discard(self, driver_id: int, lat: float, lon: float, car_class: str) -> None:
+        self._arrays[car_class].discard(driver_id)
+        cells = self._cells[car_class]
+        key = self._cell(lat, lon)
+        cells[key].discard(driver_id)
+        if not cells[key]:
+            del cells[key]
+
+    def update(self, driver_id: int, car_class: str, lat: float, lon: float,
+               ts: Optional[float] = None, own: bool = True) -> None:
+        """own=False — точка от другой реплики: её в таблицу и обратно в хранилище не пишем."""
+        old = self._positions.get(driver_id)
+        key = self._cell(lat, lon)
+        if old is None or old[2] != car_class or self._cell(old[0], old[1]) != key:
+            if old is not None:
+                self._discard(driver_id, old[0], old[1], old[2])
+            self._cells.setdefault(car_class, {}).setdefault(key, set()).add(driver_id)
+        ts = ts or time.time()
+        self._positions[driver_id] = (lat, lon, car_class, ts)
+        arrays = self._arrays.get(car_class)
+        if arrays is None:
+            arrays = self._arrays[car_class] = DriverArrays()
+        arrays.set(driver_id, lat, lon, ts)
+        if own:
+            self.dirty.add(driver_id)
+            self.unshared.add(driver_id)
+        self.updates += 1
+
+    def remove(self, driver_id: int) -> None:
+        old = self._positions.pop(driver_id, None)
+        if old is not None:
+            self._discard(driver_id, old[0], old[1], old[2])
+
+    def position(self, driver_id: int) -> Optional[Tuple[float, float, float]]:
+        """(lat, lon, time()) последней точки."""
+        known = self._positions.get(driver_id)
+        return (known[0], known[1], known[3]) if known else None
+
+    def export(self, driver_ids: Iterable[int]) -> List[Tuple[int, str, float, float, float]]:
+        """(driver_id, класс, lat, lon, time()) известных из driver_ids."""
+        rows = []
+        for driver_id in driver_ids:
+            known = self._positions.get(driver_id)
+            if known is not None:
+                rows.append((driver_id, known[2], known[0], known[1], known[3]))
+        return rows
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def online(self, car_class: str) -> List[int]:
+        """Водители класса со свежей геолокацией."""
+        fresh_since = time.time() - LOCATION_MAX_AGE
+        return [driver_id for driver_ids in self._cells.get(car_class, {}).values()
+                for driver_id in driver_ids if self._positions[driver_id][3] >= fresh_since]
+
+    def best_eta(self, car_class: str, lat: float, lon: float,
+                 available: Optional[Callable[[int], bool]] = None,
+                 shortlist: int = 16) -> Optional[Tuple[int, float]]:
+        """
+        (driver_id, минут до подачи) лучшего свободного водителя класса.
+        ETA всех водителей класса — один векторный проход; available проверяем
+        только у shortlist лучших, и лишь если все они заняты — у остальных.
+        """
+        arrays = self._arrays.get(car_class)
+        if arrays is None or not arrays.size:
+            return None
+        eta = eta_minutes(arrays.distances_km(lat, lon))
+        eta[arrays.ts[:arrays.size] < time.time() - LOCATION_MAX_AGE] = np.inf
+        if eta.size > shortlist:
+            best = np.argpartition(eta, shortlist)[:shortlist]
+            passes = (best[np.argsort(eta[best])], np.argsort(eta))
         else:
-            DRIVERS_SHEET.append_row(
-                [str(driver_id), driver_name, car_class, plate, photos_str, "", "", "", ""],
-                value_input_option="USER_ENTERED",
-            )
-        log.info("Водитель %s обновлён/добавлен", driver_id)
-    except Exception as e:
-        log.error("Ошибка записи водителя: %s", e)
+            passes = (np.argsort(eta),)
+        for slots in passes:
+            for slot in slots:
+                if not np.isfinite(eta[slot]):
+                    break
+                driver_id = int(arrays.ids[slot])
+                if available is None or available(driver_id):
+                    return driver_id, float(eta[slot])
+        return None
+
+    def driver_eta(self, driver_id: int, lat: float, lon: float) -> Optional[float]:
+        """Минуты до подачи для конкретного водителя (None — нет свежей геолокации)."""
+        known = self._positions.get(driver_id)
+        if known is None or known[3] < time.time() - LOCATION_MAX_AGE:
+            return None
+        return eta_minutes(haversine_km(lat, lon, known[0], known[1]))
+
+    def nearest(self, car_class: str, lat: float, lon: float, k: int = 5,
+                max_km: Optional[float] = None,
+                available: Optional[Callable[[int], bool]] = None) -> List[Tuple[float, int]]:
+        """До k пар (расстояние в км, driver_id) по возрастанию расстояния."""
+        cells = self._cells.get(car_class)
+        if not cells:
+            return []
+        fresh_since = time.time() - LOCATION_MAX_AGE
+        found: List[Tuple[float, int]] = []
+
+        def consider(driver_ids: Set[int]) -> None:
+            for driver_id in driver_ids:
+                d_lat, d_lon, _, ts = self._positions[driver_id]
+                if ts < fresh_since or (available is not None and not available(driver_id)):
+                    continue
+                distance = haversine_km(lat, lon, d_lat, d_lon)
+                if max_km is None or distance <= max_km:
+                    found.append((distance, driver_id))
+
+        ci, cj = self._cell(lat, lon)
+        # меньшая сторона ячейки в км — нижняя оценка расстояния до кольца
+        cell_km = self.cell_deg * min(KM_PER_DEG_LAT, KM_PER_DEG_LON * max(math.cos(math.radians(lat)), 0.01))
+        max_ring = math.ceil(max_km / cell_km) + 1 if max_km is not None else None
+        visited = 0
+        ring = 0
+        while True:
+            if 8 * ring > len(cells) - visited:
+                # кольцо больше, чем осталось занятых ячеек — дешевле пройти их все
+                for (i, j), driver_ids in cells.items():
+                    if max(abs(i - ci), abs(j - cj)) >= ring:
+                        consider(driver_ids)
+                break
+            if ring == 0:
+                ring_keys = [(ci, cj)]
+            else:
+                ring_keys = [(ci + d, cj - ring) for d in range(-ring, ring + 1)]
+                ring_keys += [(ci + d, cj + ring) for d in range(-ring, ring + 1)]
+                ring_keys += [(ci - ring, cj + d) for d in range(-ring + 1, ring)]
+                ring_keys += [(ci + ring, cj + d) for d in range(-ring + 1, ring)]
+            for ring_key in ring_keys:
+                driver_ids = cells.get(ring_key)
+                if driver_ids:
+                    visited += 1
+                    consider(driver_ids)
+            if len(found) >= k:
+                found.sort()
+                if found[k - 1][0] <= ring * cell_km:
+                    break
+            if visited >= len(cells) or (max_ring is not None and ring >= max_ring):
+                break
+            ring += 1
+        found.sort()
+        return found[:k]
+
+
+DRIVER_LOCATIONS = DriverLocationIndex(GEO_CELL_DEG)
+
+
+def flush_driver_locations() -> int:
+    """Поставить последние точки изменившихся водителей в очередь листа drivers."""
+    dirty, DRIVER_LOCATIONS.dirty = DRIVER_LOCATIONS.dirty, set()
+    for driver_id in dirty:
+        position = DRIVER_LOCATIONS.position(driver_id)
+        if position is None:
+            continue
+        lat, lon, ts = position
+        DRIVER_WRITER.set_cells(str(driver_id), {
+            7: round(lat, 6),
+            8: round(lon, 6),
+            9: datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S"),
+        }, priority=PRIO_LOCATION)
+    return len(dirty)
+
+
+async def driver_locations_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодическая запись координат в таблицу (JobQueue)."""
+    flush_driver_locations()
 
 
 # ---------- КОНСТАНТЫ СОСТОЯНИЙ ----------
@@ -391,21 +2301,24 @@ def format_price(car_class: str, hours: int) -> str:
 # ---------- КОМАНДЫ ОБЩИЕ ----------
 
 async def set_commands(app: Application) -> None:
-    await app.bot.set_my_commands(
-        [
-            BotCommand("start", "Запустить бота"),
-            BotCommand("menu", "Показать меню"),
-            BotCommand("order", "Сделать заказ"),
-            BotCommand("urgent", "Срочный заказ"),
-            BotCommand("price", "Тарифы"),
-            BotCommand("status", "Статус заказа"),
-            BotCommand("contact", "Связаться с диспетчером"),
-            BotCommand("carphoto", "Фото назначенной машины"),
-            BotCommand("cancel", "Отмена"),
-            BotCommand("ai", "AI-чат для диспетчера"),
-            BotCommand("setdriver", "Регистрация/обновление водителя"),
-        ]
-    )
+    try:
+        await app.bot.set_my_commands(
+            [
+                BotCommand("start", "Запустить бота"),
+                BotCommand("menu", "Показать меню"),
+                BotCommand("order", "Сделать заказ"),
+                BotCommand("urgent", "Срочный заказ"),
+                BotCommand("price", "Тарифы"),
+                BotCommand("status", "Статус заказа"),
+                BotCommand("contact", "Связаться с диспетчером"),
+                BotCommand("carphoto", "Фото назначенной машины"),
+                BotCommand("cancel", "Отмена"),
+                BotCommand("ai", "AI-чат для диспетчера"),
+                BotCommand("setdriver", "Регистрация/обновление водителя"),
+            ]
+        )
+    except Exception as e:
+        log.error("Не удалось обновить список команд: %s", e)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -450,9 +2363,412 @@ async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return ConversationHandler.END
 
 
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Служебная статистика — только в группе водителей/диспетчеров."""
+    if not ADMIN_CHAT_ID or str(update.effective_chat.id) != str(ADMIN_CHAT_ID):
+        return
+    lines = [
+        "<b>Статистика бота</b>",
+        f"• Заказов в памяти: {len(ORDERS_CACHE)}, чатов: {len(ACTIVE_CHATS)}",
+        f"• Кэш водителей: {DRIVER_CACHE.stats()}",
+        f"• Геолокация: водителей {len(DRIVER_LOCATIONS)}, обновлений {DRIVER_LOCATIONS.updates}",
+        f"• Время до назначения: {assign_time_stats()}, распределяется сейчас: {len(DISPATCHES)}",
+        f"• Google Sheets: {SHEETS.stats()}",
+        f"• Отправка в Telegram: {OUTBOUND.stats()}",
+        f"• Рассылка при смене статуса: {transition_latency_stats()}",
+        f"• Чат клиент ↔ водитель: {relay_latency_stats()}",
+        f"• AI /ai: {LLM.stats()}; кэш ответов {AI_CACHE.stats()}; шаблоны {CANNED_REPLIES.stats()}",
+        f"• Задержка апдейтов: {update_latency_stats()}",
+        f"• Архив: последний запуск {ARCHIVE_STATS['last_run'] or '—'}, "
+        f"перенесено {ARCHIVE_STATS['last_moved']} (всего {ARCHIVE_STATS['moved']})",
+    ]
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
 # ---------- AI /ai ----------
+# Асинхронный клиент с пулом keep-alive соединений: медленный ответ модели
+# не держит остальные апдейты, TLS не устанавливается заново на каждый запрос.
+# Ответ приходит потоком (SSE), сообщение в Telegram дописывается по мере
+# генерации — не чаще раза в AI_EDIT_INTERVAL секунд.
+
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+MODEL_NAME = os.environ.get("MODEL_NAME", "gpt-4.1-mini")
+AI_MAX_CONCURRENT = int(os.environ.get("AI_MAX_CONCURRENT", "4"))
+AI_TIMEOUT = float(os.environ.get("AI_TIMEOUT", "20"))
+AI_EDIT_INTERVAL = float(os.environ.get("AI_EDIT_INTERVAL", "1.0"))
+AI_MAX_TOKENS = 250
+AI_BREAKER_FAILURES = int(os.environ.get("AI_BREAKER_FAILURES", "3"))
+AI_BREAKER_RESET = float(os.environ.get("AI_BREAKER_RESET", "30"))
+AI_UNAVAILABLE_TEXT = "AI-диспетчер временно недоступен. Попробуйте чуть позже."
+
+
+class CircuitOpenError(Exception):
+    """Запрос не отправлен: выключатель разомкнут."""
+
+
+class CircuitBreaker:
+    """
+    Выключатель перед внешним API. closed: запросы идут, max_failures ошибок
+    подряд — open: запросы сразу отклоняются. Через reset_timeout — half-open:
+    пропускается один пробный запрос; успех замыкает, ошибка снова размыкает.
+    Повиснувшая проба не блокирует навсегда — следующая через reset_timeout.
+    """
+
+    def __init__(self, max_failures: int, reset_timeout: float) -> None:
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_at: Optional[float] = None
+        self.opened = 0     # сколько раз размыкался
+        self.rejected = 0   # сколько запросов отклонено без обращения к API
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        now = time.monotonic()
+        if state == "half-open" and (self.probe_at is None or now - self.probe_at >= self.reset_timeout):
+            self.probe_at = now
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def failure(self) -> None:
+        self.failures += 1
+        state = self.state
+        if state == "half-open" or (state == "closed" and self.failures >= self.max_failures):
+            self.opened += 1
+            self.opened_at = time.monotonic()
+            self.probe_at = None
+            log.warning("AI API: выключатель разомкнут на %.0f с (ошибок подряд: %d)",
+                        self.reset_timeout, self.failures)
+
+
+class LLMClient:
+    """
+    OpenAI-совместимый chat/completions в режиме stream. Не больше
+    max_concurrent запросов сразу, при отказах API — CircuitBreaker.
+    """
+
+    def __init__(self, base_url: str, api_key: Optional[str], model: str, max_concurrent: int) -> None:
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.max_concurrent = max_concurrent
+        self._client: Optional[httpx.AsyncClient] = None
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self.breaker = CircuitBreaker(AI_BREAKER_FAILURES, AI_BREAKER_RESET)
+        self.requests = 0
+        self.errors = 0
+        self.first_token: Deque[float] = deque(maxlen=500)  # секунды до первого фрагмента
+        self.latency: Deque[float] = deque(maxlen=500)      # секунды на весь ответ
+
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=httpx.Timeout(AI_TIMEOUT, connect=5.0),
+                limits=httpx.Limits(max_connections=self.max_concurrent,
+                                    max_keepalive_connections=self.max_concurrent),
+            )
+        return self._client
+
+    async def stream(self, messages: List[Dict[str, str]], max_tokens: int = AI_MAX_TOKENS) -> AsyncIterator[str]:
+        """
+        Фрагменты ответа по мере генерации. Ошибки сети и API — httpx.HTTPError,
+        разомкнутый выключатель — CircuitOpenError.
+        """
+        payload = {"model": self.model, "messages": messages, "max_tokens": max_tokens, "stream": True}
+        async with self._slots:
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"AI API недоступен, повтор через {self.breaker.reset_timeout:.0f} с")
+            self.requests += 1
+            started = time.monotonic()
+            first = True
+            try:
+                async with self.client().stream("POST", "/chat/completions", json=payload) as resp:
+                    resp.raise_for_status()
+                    async for line in resp.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            continue  # дочитываем тело, чтобы соединение вернулось в пул
+                        choices = json.loads(data).get("choices") or [{}]
+                        chunk = (choices[0].get("delta") or {}).get("content")
+                        if chunk:
+                            if first:
+                                self.first_token.append(time.monotonic() - started)
+                                first = False
+                            yield chunk
+            except (httpx.HTTPError, ValueError):
+                self.errors += 1
+                self.breaker.failure()
+                raise
+            self.breaker.success()
+            self.latency.append(time.monotonic() - started)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> str:
+        error_rate = self.errors / self.requests * 100 if self.requests else 0.0
+        line = f"запросов {self.requests}, ошибок {self.errors} ({error_rate:.0f}%)"
+        if self.first_token:
+            p50, p95, _ = percentiles(self.first_token)
+            line += f", первый фрагмент p50 {p50:.1f} с, p95 {p95:.1f} с"
+        if self.latency:
+            p50, p95, _ = percentiles(self.latency)
+            line += f", ответ p50 {p50:.1f} с, p95 {p95:.1f} с"
+        line += (f", выключатель {self.breaker.state} (размыкался {self.breaker.opened}, "
+                 f"отклонено {self.breaker.rejected}), объединено запросов {AI_COALESCED}")
+        return line
+
+
+LLM = LLMClient(OPENAI_BASE_URL, OPENAI_API_KEY, MODEL_NAME, AI_MAX_CONCURRENT)
+
+# одинаковые (после нормализации) вопросы, пока первый ещё генерируется,
+# ждут его ответа, а не идут в API сами
+AI_INFLIGHT: Dict[Tuple[str, str, str], "asyncio.Future[Optional[str]]"] = {}
+AI_COALESCED = 0
+
+AI_SYSTEM_PROMPT = (
+    "Ты — живой диспетчер премиум-такси. "
+    "На вход получаешь описание ситуации, на выход даёшь ГОТОВОЕ письмо клиенту.\n"
+    "1) Всегда обращайся на ВЫ.\n"
+    "2) 1–3 коротких предложения.\n"
+    "3) Не придумывай точные цены.\n"
+    "4) Не упоминай, что ты ИИ.\n"
+    "5) Будь спокойным и уверенным.\n"
+)
+
+
+# Кэш ответов: диспетчеры спрашивают одно и то же («машина задерживается
+# на 10 минут»). Ключ — модель, версия промпта и нормализованный вопрос:
+# регистр, ё/е, пробелы и знаки не важны. Числа остаются как есть — модель
+# видит точный вопрос, и ответ про 7 минут не должен уйти на вопрос про 10.
+# AI_CACHE_PATH — сохранять кэш между перезапусками.
+
+AI_CACHE_SIZE = int(os.environ.get("AI_CACHE_SIZE", "500"))
+AI_CACHE_TTL = float(os.environ.get("AI_CACHE_TTL", str(7 * 24 * 3600)))
+AI_CACHE_PATH = os.environ.get("AI_CACHE_PATH", "")
+AI_CACHE_SAVE_INTERVAL = 300
+AI_PROMPT_VERSION = hashlib.sha1(AI_SYSTEM_PROMPT.encode()).hexdigest()[:8]  # меняется вместе с промптом
+
+AI_CACHE = TTLCache(AI_CACHE_SIZE, AI_CACHE_TTL)  # (модель, версия промпта, вопрос) -> ответ
+AI_CACHE_DIRTY = False
+
+_AI_NOISE_RE = re.compile(r"[^\w]+")
+
+
+def normalize_question(text: str) -> str:
+    text = text.lower().replace("ё", "е")
+    return " ".join(_AI_NOISE_RE.sub(" ", text).split())
+
+
+def ai_cache_key(question: str) -> Tuple[str, str, str]:
+    return MODEL_NAME, AI_PROMPT_VERSION, normalize_question(question)
+
+
+def load_ai_cache() -> None:
+    if not AI_CACHE_PATH or not os.path.exists(AI_CACHE_PATH):
+        return
+    try:
+        with open(AI_CACHE_PATH, encoding="utf-8") as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        log.error("Не удалось прочитать кэш AI %s: %s", AI_CACHE_PATH, e)
+        return
+    now = time.time()
+    for key, answer, expires in entries:
+        if expires > now:
+            AI_CACHE.set(tuple(key), answer, ttl=expires - now)
+    log.info("Кэш AI: загружено %d ответов", len(AI_CACHE))
+
+
+def save_ai_cache() -> None:
+    global AI_CACHE_DIRTY
+    if not AI_CACHE_PATH or not AI_CACHE_DIRTY:
+        return
+    now = time.time()
+    entries = [[list(key), answer, now + left] for key, answer, left in AI_CACHE.items()]
+    tmp_path = AI_CACHE_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, AI_CACHE_PATH)
+        AI_CACHE_DIRTY = False
+    except OSError as e:
+        log.error("Не удалось сохранить кэш AI %s: %s", AI_CACHE_PATH, e)
+
+
+async def ai_cache_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    save_ai_cache()
+
+
+# Шаблоны: canned_replies.json — одобренные ответы на частые ситуации
+# (задержка, скидка, детское кресло…) с примерами формулировок. Вопрос
+# сравнивается с примерами по символьным триграммам (TF-IDF, косинус) через
+# инвертированный индекс. Триграммы не понимают смысла («хочет изменить заказ»
+# близко к «хочет отменить заказ»), поэтому шаблоном отвечаем только на
+# почти дословные примеры: похожесть не ниже CANNED_THRESHOLD, отрыв от
+# лучшего примера другого ответа не меньше CANNED_MARGIN, и отрицание
+# («не хочет») либо есть и в вопросе, и в примере, либо нет ни там, ни там.
+# Остальное — модели. Пороги подобраны по размеченным вопросам из
+# tests/test_canned_replies.py. В шаблонах нет ответов «мы уже сделали»:
+# шаблон не знает, сделано ли.
+
+CANNED_REPLIES_PATH = os.environ.get(
+    "CANNED_REPLIES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "canned_replies.json")
+)
+CANNED_THRESHOLD = float(os.environ.get("CANNED_THRESHOLD", "0.8"))
+CANNED_MARGIN = float(os.environ.get("CANNED_MARGIN", "0.15"))
+CANNED_NGRAM = 3
+CANNED_NEGATIONS = frozenset(("не", "нет", "ни"))
+
+
+def is_negated(normalized: str) -> bool:
+    return not CANNED_NEGATIONS.isdisjoint(normalized.split())
+
+
+def char_ngrams(text: str, n: int = CANNED_NGRAM) -> Dict[str, int]:
+    padded = f" {text} "
+    counts: Dict[str, int] = {}
+    for i in range(len(padded) - n + 1):
+        gram = padded[i:i + n]
+        counts[gram] = counts.get(gram, 0) + 1
+    return counts
+
+
+class CannedReplyIndex:
+    """
+    TF-IDF по символьным n-граммам нормализованного текста.
+    postings: n-грамма -> (номера примеров, веса) в массивах NumPy —
+    запрос складывает только строки своих n-грамм.
+    """
+
+    def __init__(self) -> None:
+        self.replies: List[str] = []
+        self.example_reply = np.zeros(0, dtype=np.int32)  # пример -> номер ответа
+        self.example_negated = np.zeros(0, dtype=bool)
+        self.idf: Dict[str, float] = {}
+        self.unknown_idf = 1.0
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self.lookups = 0
+        self.served = 0
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.build(json.load(f))
+        except (OSError, ValueError, KeyError) as e:
+            log.warning("Шаблоны ответов %s не загружены: %s", path, e)
+            return
+        log.info("Шаблоны ответов: %d, примеров %d", len(self.replies), len(self.example_reply))
+
+    def build(self, entries: List[Dict[str, Any]]) -> None:
+        replies: List[str] = []
+        examples: List[Tuple[int, Dict[str, int]]] = []
+        negated: List[bool] = []
+        for entry in entries:
+            for situation in entry["situations"]:
+                normalized = normalize_question(situation)
+                examples.append((len(replies), char_ngrams(normalized)))
+                negated.append(is_negated(normalized))
+            replies.append(entry["reply"])
+
+        df: Dict[str, int] = {}
+        for _, grams in examples:
+            for gram in grams:
+                df[gram] = df.get(gram, 0) + 1
+        total = len(examples)
+        idf = {gram: math.log((1 + total) / (1 + count)) + 1 for gram, count in df.items()}
+
+        rows: Dict[str, Tuple[List[int], List[float]]] = {}
+        for example_id, (_, grams) in enumerate(examples):
+            weights = {gram: (1 + math.log(tf)) * idf[gram] for gram, tf in grams.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            for gram, weight in weights.items():
+                ids, values = rows.setdefault(gram, ([], []))
+                ids.append(example_id)
+                values.append(weight / norm)
+
+        self.replies = replies
+        self.example_reply = np.array([reply_id for reply_id, _ in examples], dtype=np.int32)
+        self.example_negated = np.array(negated, dtype=bool)
+        self.idf = idf
+        self.unknown_idf = math.log(1 + total) + 1  # n-грамма, которой нет ни в одном примере
+        self.postings = {
+            gram: (np.array(ids, dtype=np.int32), np.array(values, dtype=np.float32))
+            for gram, (ids, values) in rows.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.replies)
+
+    def best(self, question: str) -> Tuple[float, float, Optional[str]]:
+        """
+        (похожесть лучшего примера, похожесть лучшего примера с другим ответом, ответ);
+        (0, 0, None), если похожих нет. Примеры с другим отрицанием, чем у вопроса, не считаются.
+        """
+        normalized = normalize_question(question)
+        grams = char_ngrams(normalized)
+        scores = np.zeros(len(self.example_reply), dtype=np.float32)
+        norm = 0.0
+        for gram, tf in grams.items():
+            weight = (1 + math.log(tf)) * self.idf.get(gram, self.unknown_idf)
+            norm += weight * weight
+            row = self.postings.get(gram)
+            if row is not None:
+                scores[row[0]] += weight * row[1]
+        if not len(scores) or not norm:
+            return 0.0, 0.0, None
+        scores /= math.sqrt(norm)
+        scores[self.example_negated != is_negated(normalized)] = 0.0
+        example_id = int(scores.argmax())
+        score = float(scores[example_id])
+        if score <= 0:
+            return 0.0, 0.0, None
+        reply_id = self.example_reply[example_id]
+        others = scores[self.example_reply != reply_id]
+        return score, float(others.max()) if len(others) else 0.0, self.replies[reply_id]
+
+    def match(self, question: str) -> Optional[str]:
+        """Шаблон, если вопрос почти дословно совпал с примером (см. CANNED_THRESHOLD, CANNED_MARGIN)."""
+        self.lookups += 1
+        score, runner_up, reply = self.best(question)
+        if reply is None or score < CANNED_THRESHOLD or score - runner_up < CANNED_MARGIN:
+            return None
+        self.served += 1
+        return reply
+
+    def stats(self) -> str:
+        share = self.served / self.lookups * 100 if self.lookups else 0.0
+        return f"{len(self)} шабл., ответили сами {self.served} из {self.lookups} ({share:.0f}%)"
+
+
+CANNED_REPLIES = CannedReplyIndex()
+
 
 async def ai_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    global AI_COALESCED
     question = " ".join(context.args).strip()
     if not question:
         await update.message.reply_text(
@@ -465,46 +2781,81 @@ async def ai_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
+    key = ai_cache_key(question)
+    cached = AI_CACHE.get(key) or CANNED_REPLIES.match(question)
+    if cached:
+        await update.message.reply_text(cached)
+        return
+
     if not OPENAI_API_KEY:
         await update.message.reply_text(
             "AI-чат пока не настроен. Добавьте OPENAI_API_KEY в переменные Railway."
         )
         return
 
-    system_prompt = (
-        "Ты — живой диспетчер премиум-такси. "
-        "На вход получаешь описание ситуации, на выход даёшь ГОТОВОЕ письмо клиенту.\n"
-        "1) Всегда обращайся на ВЫ.\n"
-        "2) 1–3 коротких предложения.\n"
-        "3) Не придумывай точные цены.\n"
-        "4) Не упоминай, что ты ИИ.\n"
-        "5) Будь спокойным и уверенным.\n"
-    )
+    pending = AI_INFLIGHT.get(key)
+    if pending is not None:
+        AI_COALESCED += 1
+        reply = await update.message.reply_text("✍️ Пишу ответ…")
+        answer = await asyncio.shield(pending)
+        try:
+            await reply.edit_text(answer or "Не удалось получить ответ от AI-диспетчера.")
+        except Exception as e:
+            log.error("Не удалось показать ответ AI: %s", e)
+        return
 
+    if LLM.breaker.state == "open":
+        LLM.breaker.rejected += 1
+        await update.message.reply_text(AI_UNAVAILABLE_TEXT)
+        return
+
+    done: "asyncio.Future[Optional[str]]" = asyncio.get_running_loop().create_future()
+    AI_INFLIGHT[key] = done
     try:
-        resp = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": "gpt-4.1-mini",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": question},
-                ],
-                "max_tokens": 250,
-            },
-            timeout=20,
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        answer = data["choices"][0]["message"]["content"].strip()
-        await update.message.reply_text(answer)
+        await ai_stream_reply(update, key, question, done)
+    finally:
+        AI_INFLIGHT.pop(key, None)
+        if not done.done():
+            done.set_result(None)
+
+
+async def ai_stream_reply(update: Update, key: Tuple[str, str, str], question: str,
+                          done: "asyncio.Future[Optional[str]]") -> None:
+    """Запрос к модели с дописыванием ответа в сообщение; итог — в done для объединённых запросов."""
+    global AI_CACHE_DIRTY
+    reply = await update.message.reply_text("✍️ Пишу ответ…")
+    messages = [
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "user", "content": question},
+    ]
+    answer = ""
+    shown = ""
+    last_edit = time.monotonic()
+    try:
+        async for chunk in LLM.stream(messages):
+            answer += chunk
+            if time.monotonic() - last_edit >= AI_EDIT_INTERVAL and answer.strip() != shown:
+                shown = answer.strip()
+                last_edit = time.monotonic()
+                try:
+                    await reply.edit_text(shown + " ▌")
+                except Exception:
+                    pass  # «message is not modified» и т.п. — допишем в конце
+    except CircuitOpenError:
+        answer = answer or AI_UNAVAILABLE_TEXT
+    except Exception as e:
+        log.error("Ошибка AI-чата: %s: %s", type(e).__name__, e)
+        if not answer.strip():
+            answer = "Не удалось получить ответ от AI-диспетчера."
+    else:
+        if answer.strip():
+            AI_CACHE.set(key, answer.strip())
+            AI_CACHE_DIRTY = True
+    done.set_result(answer.strip() or None)
+    try:
+        await reply.edit_text(answer.strip() or "Не удалось получить ответ от AI-диспетчера.")
     except Exception as e:
-        log.error("Ошибка AI-чата: %s", e)
-        await update.message.reply_text("Не удалось получить ответ от AI-диспетчера.")
+        log.error("Не удалось показать ответ AI: %s", e)
 
 
 # ---------- РЕГИСТРАЦИЯ ВОДИТЕЛЯ (/setdriver) ----------
@@ -566,7 +2917,7 @@ async def finish_driver_registration(update: Update, context: ContextTypes.DEFAU
         await update.message.reply_text("Отправьте хотя бы одно фото.")
         return DRV_PHOTO
 
-    upsert_driver(
+    await register_driver(
         driver_id=d["driver_id"],
         driver_name=d["driver_name"],
         car_class=d["car_class"],
@@ -642,6 +2993,8 @@ async def pickup_location(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     loc = update.message.location
     link = to_ymaps_link(loc.latitude, loc.longitude)
     context.user_data["order"]["pickup"] = link
+    context.user_data["order"]["pickup_lat"] = loc.latitude
+    context.user_data["order"]["pickup_lon"] = loc.longitude
     await update.message.reply_text(
         "Укажите адрес назначения.",
         reply_markup=ReplyKeyboardMarkup([["❌ Отмена"]], resize_keyboard=True),
@@ -661,6 +3014,8 @@ async def text_pickup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 async def dest_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     loc = update.message.location
     context.user_data["order"]["destination"] = to_ymaps_link(loc.latitude, loc.longitude)
+    context.user_data["order"]["dest_lat"] = loc.latitude
+    context.user_data["order"]["dest_lon"] = loc.longitude
     await update.message.reply_text("Выберите класс авто.", reply_markup=cars_kb())
     return CAR
 
@@ -773,6 +3128,15 @@ async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
     o["approx_price"] = approx
 
+    # ближайшая свободная машина нужного класса (если подача задана геолокацией)
+    eta_line = ""
+    if o.get("pickup_lat") is not None:
+        busy = await busy_users()
+        best = DRIVER_LOCATIONS.best_eta(o["car_class"], o["pickup_lat"], o["pickup_lon"],
+                                         available=lambda driver_id: driver_id not in busy)
+        if best:
+            eta_line = f"• Ближайшая машина: ≈ {best[1]:.0f} мин\n"
+
     text = (
         "<b>Проверьте заказ:</b>\n"
         f"• Подача: {o.get('pickup')}\n"
@@ -781,7 +3145,8 @@ async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         f"• Время подачи: {o.get('time')}\n"
         f"• Аренда: {o.get('hours_text')}\n"
         f"• Контакт: {o.get('contact')}\n"
-        f"• Ориентировочно: {o.get('approx_price')}\n\n"
+        f"• Ориентировочно: {o.get('approx_price')}\n"
+        f"{eta_line}\n"
         "Если всё верно — нажмите «Подтверждаю». Для отмены — «Отмена»."
     )
     kb = InlineKeyboardMarkup(
@@ -809,74 +3174,299 @@ async def confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     order["status"] = "new"
     order["driver_id"] = None
     order["driver_name"] = None
+    order["created_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    record = Order.from_dict(order)
+    await save_order(record)
+    save_order_to_sheet(record)
+    remember_user_order(order["user_id"], order["order_id"])
+
+    await q.edit_message_text("Заказ принят. Как только назначим водителя — бот пришлёт уведомление.")
+
+    # предлагаем ближайшим водителям, при неудаче — в группу
+    await start_dispatch(context, record, "🆕 Новый заказ")
+
+    context.user_data.clear()
+    return ConversationHandler.END
+
+
+# ---------- СРОЧНЫЙ ЗАКАЗ ----------
+
+async def urgent_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    o = {
+        "order_id": uuid4().hex[:8],
+        "user_id": update.effective_user.id,
+        "username": f"@{update.effective_user.username}"
+        if update.effective_user.username
+        else update.effective_user.full_name,
+        "urgent": True,
+    }
+    context.user_data["order"] = o
+    kb = ReplyKeyboardMarkup(
+        [[KeyboardButton("Отправить мою геолокацию", request_location=True)], ["❌ Отмена"]],
+        resize_keyboard=True,
+        one_time_keyboard=True,
+    )
+    await update.message.reply_text(
+        "Срочный заказ.\nОтправьте геолокацию точки подачи или введите адрес.",
+        reply_markup=kb,
+    )
+    return PICKUP
+
+
+# ---------- РАССЫЛКА ПРИ СМЕНЕ СТАТУСА ----------
+# Смена статуса заказа — это несколько независимых запросов к Telegram
+# (водителю, клиенту, сообщение в группе). Отправляем их одновременно:
+# водитель получает подтверждение за один round-trip, а не за три-четыре,
+# и ошибка одного запроса не мешает остальным. Таблица не ждёт — запись
+# в Sheets и так идёт через ORDER_WRITER.
+
+TRANSITION_LATENCY: Dict[str, Deque[float]] = {}  # переход -> время рассылки, мс
+
+
+async def fan_out(transition: str, calls: List[Tuple[str, Awaitable]]) -> List[Any]:
+    """
+    Выполнить calls [(описание, корутина)] параллельно. Ошибки логируются
+    по отдельности, на их месте в результате — None.
+    """
+    started = time.perf_counter()
+    results = await asyncio.gather(*(call for _, call in calls), return_exceptions=True)
+    for (what, _), result in zip(calls, results):
+        if isinstance(result, Exception):
+            log.warning("%s: не удалось — %s: %s", transition, what, result)
+    TRANSITION_LATENCY.setdefault(transition, deque(maxlen=1000)).append(
+        (time.perf_counter() - started) * 1000
+    )
+    return [None if isinstance(result, Exception) else result for result in results]
+
+
+def transition_latency_stats() -> str:
+    if not TRANSITION_LATENCY:
+        return "нет данных"
+    parts = []
+    for transition, samples in sorted(TRANSITION_LATENCY.items()):
+        p50, p95, _ = percentiles(samples)
+        parts.append(f"{transition} p50 {p50:.0f} мс, p95 {p95:.0f} мс")
+    return "; ".join(parts)
+
+
+# ---------- РАСПРЕДЕЛЕНИЕ ЗАКАЗОВ ----------
+# Новый заказ сначала уходит в личку ближайшим свободным водителям нужного
+# класса (по DRIVER_LOCATIONS; без координат подачи — тем, кто дольше всех
+# без заказа). Никто не взял за DISPATCH_OFFER_TIMEOUT — радиус растёт,
+# после DISPATCH_ROUNDS раундов заказ уходит в группу, как раньше.
+# Кнопка в предложении — тот же drv_take, гонки решает transition_order.
+# Раунды и таймеры живут в памяти реплики, которая распределяет заказ, поэтому
+# кнопки предложения несут её номер (drv_take:<id>:<REPLICA_ID>) и роутер
+# отдаёт нажатия ей (см. update_replica). Координаты водителей общие
+# (sync_driver_locations), время без заказа — тоже.
+
+DISPATCH_ENABLED = os.environ.get("DISPATCH_ENABLED", "1") == "1"
+DISPATCH_BATCH = int(os.environ.get("DISPATCH_BATCH", "3"))
+DISPATCH_OFFER_TIMEOUT = float(os.environ.get("DISPATCH_OFFER_TIMEOUT", "45"))
+DISPATCH_RADIUS_KM = float(os.environ.get("DISPATCH_RADIUS_KM", "5"))
+DISPATCH_RADIUS_FACTOR = 2.0
+DISPATCH_ROUNDS = int(os.environ.get("DISPATCH_ROUNDS", "3"))
+
+DRIVER_IDLE_SINCE: Dict[int, float] = {}         # driver_id -> time() окончания последнего заказа
+ASSIGN_TIMES: Deque[float] = deque(maxlen=1000)  # секунды от создания заказа до назначения
+
+
+class Dispatch:
+    """Распределение одного заказа: раунд, радиус, кому отправлены предложения."""
+
+    __slots__ = ("order_id", "title", "round", "radius_km", "offered", "waiting", "messages")
+
+    def __init__(self, order_id: str, title: str, exclude: Tuple[int, ...] = ()) -> None:
+        self.order_id = order_id
+        self.title = title
+        self.round = 0
+        self.radius_km = DISPATCH_RADIUS_KM
+        self.offered: Set[int] = set(exclude)   # кому уже предлагали (и кого исключили)
+        self.waiting: Set[int] = set()          # кто ещё не ответил в текущем раунде
+        self.messages: List[Tuple[int, int]] = []  # (chat_id, message_id) активных предложений
+
+
+DISPATCHES: Dict[str, Dispatch] = {}
+
+
+def mark_idle(driver_id: int) -> None:
+    """Водитель освободился: первым в очереди станет тот, кто дольше ждёт."""
+    DRIVER_IDLE_SINCE[driver_id] = time.time()
+    DRIVER_LOCATIONS.unshared.add(driver_id)
+
+
+def admin_chat_id() -> Any:
+    try:
+        return int(ADMIN_CHAT_ID) if ADMIN_CHAT_ID else None
+    except ValueError:
+        return ADMIN_CHAT_ID
+
+
+def order_card(order: Order, title: str) -> str:
+    return (
+        f"{title} #{order.order_id}\n"
+        f"📍 Откуда: {order.pickup}\n"
+        f"🏁 Куда: {order.destination or 'Не указано (срочный)'}\n"
+        f"🚘 Класс: {order.car_class}\n"
+        f"⏰ Время подачи: {order.time}\n"
+        f"⏳ Аренда: {order.hours_text}\n"
+        f"💰 {order.approx_price}\n\n"
+        "Личные данные клиента скрыты."
+    )
+
+
+async def post_order_to_group(bot: Any, order: Order, title: str) -> None:
+    admin_id = admin_chat_id()
+    if not admin_id:
+        return
+    keyboard = InlineKeyboardMarkup(
+        [[InlineKeyboardButton("🟢 Взять заказ", callback_data=f"drv_take:{order.order_id}")]]
+    )
+    try:
+        await bot.send_message(chat_id=admin_id, text=order_card(order, title), reply_markup=keyboard,
+                               rate_limit_args=OUT_PRIO_URGENT if order.urgent else None)
+    except Exception as e:
+        log.error("Не удалось отправить заказ в группу водителей: %s", e)
+
+
+def seconds_since(created_at: Optional[str]) -> Optional[float]:
+    try:
+        return (datetime.now() - datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S")).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+def dispatch_candidates(order: Order, dispatch: Dispatch,
+                        busy: Set[int]) -> List[Tuple[int, Optional[float]]]:
+    """До DISPATCH_BATCH пар (driver_id, км до подачи или None), лучшие первыми; busy — занятые чатом."""
+
+    def available(driver_id: int) -> bool:
+        return driver_id not in dispatch.offered and driver_id not in busy
+
+    if order.pickup_lat is not None and order.pickup_lon is not None:
+        ranked = DRIVER_LOCATIONS.nearest(order.car_class, order.pickup_lat, order.pickup_lon,
+                                          k=DISPATCH_BATCH, max_km=dispatch.radius_km, available=available)
+        return [(driver_id, distance) for distance, driver_id in ranked]
+    idle = sorted((driver_id for driver_id in DRIVER_LOCATIONS.online(order.car_class) if available(driver_id)),
+                  key=lambda driver_id: DRIVER_IDLE_SINCE.get(driver_id, 0.0))
+    return [(driver_id, None) for driver_id in idle[:DISPATCH_BATCH]]
+
 
-    save_order_to_sheet(order)
+async def start_dispatch(context: ContextTypes.DEFAULT_TYPE, order: Order, title: str,
+                         exclude: Tuple[int, ...] = ()) -> None:
+    if not DISPATCH_ENABLED or context.job_queue is None:
+        await post_order_to_group(context.bot, order, title)
+        return
+    DISPATCHES[order.order_id] = Dispatch(order.order_id, title, exclude)
+    await dispatch_round(context, order)
+
+
+async def dispatch_round(context: ContextTypes.DEFAULT_TYPE, order: Order) -> None:
+    """Следующий раунд предложений; кандидатов нет и в максимальном радиусе — в группу."""
+    dispatch = DISPATCHES[order.order_id]
+    candidates: List[Tuple[int, Optional[float]]] = []
+    busy = await busy_users()
+    while dispatch.round < DISPATCH_ROUNDS and not candidates:
+        candidates = dispatch_candidates(order, dispatch, busy)
+        dispatch.round += 1
+        if not candidates:
+            dispatch.radius_km *= DISPATCH_RADIUS_FACTOR
+    if not candidates:
+        DISPATCHES.pop(order.order_id, None)
+        log.info("Заказ %s: свободных водителей рядом нет — в группу", order.order_id)
+        await post_order_to_group(context.bot, order, dispatch.title)
+        return
 
-    ORDERS_CACHE[order["order_id"]] = {
-        **order,
-        "status": "new",
-        "driver_id": None,
-        "driver_name": None,
-        "arrived_at": None,
-    }
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🟢 Взять заказ", callback_data=f"drv_take:{order.order_id}:{REPLICA_ID}")],
+        [InlineKeyboardButton("Отказаться", callback_data=f"drv_decline:{order.order_id}:{REPLICA_ID}")],
+    ])
+    offers = []
+    for driver_id, distance in candidates:
+        dispatch.offered.add(driver_id)
+        text = order_card(order, "🎯 Заказ для вас")
+        if distance is not None:
+            text += f"\n📏 До подачи ≈ {distance:.1f} км"
+        offers.append((f"предложение водителю {driver_id}", context.bot.send_message(
+            chat_id=driver_id, text=text, reply_markup=keyboard,
+            rate_limit_args=OUT_PRIO_URGENT if order.urgent else None,
+        )))
+    messages = await fan_out("offer", offers)
+    for (driver_id, _), message in zip(candidates, messages):
+        if message is None:
+            continue
+        dispatch.waiting.add(driver_id)
+        dispatch.messages.append((driver_id, message.message_id))
+    dispatch.radius_km *= DISPATCH_RADIUS_FACTOR
+    context.job_queue.run_once(dispatch_timeout, DISPATCH_OFFER_TIMEOUT,
+                               data=order.order_id, name=f"dispatch:{order.order_id}")
+
+
+async def close_offers(bot: Any, dispatch: Dispatch, text: str, keep: Optional[int] = None) -> None:
+    messages, dispatch.messages = dispatch.messages, []
+    dispatch.waiting.clear()
+    await asyncio.gather(*(
+        bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        for chat_id, message_id in messages if chat_id != keep
+    ), return_exceptions=True)
+
+
+async def next_dispatch_round(context: ContextTypes.DEFAULT_TYPE, order_id: str, reason: str) -> None:
+    dispatch = DISPATCHES.get(order_id)
+    if dispatch is None:
+        return
+    for job in context.job_queue.get_jobs_by_name(f"dispatch:{order_id}"):
+        job.schedule_removal()
+    await close_offers(context.bot, dispatch, reason)
+    order = await get_order(order_id)
+    if order is None or order.status not in ("new", None):
+        DISPATCHES.pop(order_id, None)  # взяли через другую реплику или группу
+        return
+    await dispatch_round(context, order)
 
-    await q.edit_message_text("Заказ принят. Как только назначим водителя — бот пришлёт уведомление.")
 
-    # отправляем в группу водителей
-    try:
-        admin_id = int(ADMIN_CHAT_ID) if ADMIN_CHAT_ID else None
-    except ValueError:
-        admin_id = ADMIN_CHAT_ID
-
-    if admin_id:
-        text_for_drivers = (
-            f"🆕 Новый заказ #{order['order_id']}\n"
-            f"📍 Откуда: {order.get('pickup')}\n"
-            f"🏁 Куда: {order.get('destination')}\n"
-            f"🚘 Класс: {order.get('car_class')}\n"
-            f"⏰ Время подачи: {order.get('time')}\n"
-            f"⏳ Аренда: {order.get('hours_text')}\n"
-            f"💰 {order.get('approx_price')}\n\n"
-            "Личные данные клиента скрыты."
-        )
-        keyboard = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🟢 Взять заказ", callback_data=f"drv_take:{order['order_id']}")]]
-        )
-        await context.bot.send_message(
-            chat_id=admin_id,
-            text=text_for_drivers,
-            reply_markup=keyboard,
-        )
+async def dispatch_timeout(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Предложения без ответа (JobQueue) — расширяем радиус."""
+    await next_dispatch_round(context, context.job.data, "⌛ Время на ответ истекло.")
 
-    context.user_data.clear()
-    return ConversationHandler.END
 
+async def finish_dispatch(context: ContextTypes.DEFAULT_TYPE, order_id: str, winner_id: int) -> None:
+    dispatch = DISPATCHES.pop(order_id, None)
+    if dispatch is None:
+        return
+    if context.job_queue:
+        for job in context.job_queue.get_jobs_by_name(f"dispatch:{order_id}"):
+            job.schedule_removal()
+    await close_offers(context.bot, dispatch, "Заказ уже принят другим водителем.", keep=winner_id)
 
-# ---------- СРОЧНЫЙ ЗАКАЗ ----------
 
-async def urgent_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    o = {
-        "order_id": uuid4().hex[:8],
-        "user_id": update.effective_user.id,
-        "username": f"@{update.effective_user.username}"
-        if update.effective_user.username
-        else update.effective_user.full_name,
-        "urgent": True,
-    }
-    context.user_data["order"] = o
-    kb = ReplyKeyboardMarkup(
-        [[KeyboardButton("Отправить мою геолокацию", request_location=True)], ["❌ Отмена"]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
-    await update.message.reply_text(
-        "Срочный заказ.\nОтправьте геолокацию точки подачи или введите адрес.",
-        reply_markup=kb,
-    )
-    return PICKUP
+def assign_time_stats() -> str:
+    if not ASSIGN_TIMES:
+        return "нет данных"
+    p50, p95, _ = percentiles(ASSIGN_TIMES)
+    return f"p50 {p50:.0f} с, p95 {p95:.0f} с ({len(ASSIGN_TIMES)} зак.)"
 
 
 # ---------- КНОПКИ ВОДИТЕЛЕЙ ----------
+# Апдейты обрабатываются параллельно (CONCURRENT_UPDATES), а реплик может быть
+# несколько, поэтому статус заказа меняется только через transition_order —
+# атомарное «проверить и записать» в хранилище. Иначе два водителя возьмут один заказ.
+
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "32"))
+TAP_DEDUP_SECONDS = float(os.environ.get("TAP_DEDUP_SECONDS", "2"))
+
+# (user_id, callback_data) недавних нажатий — повторный тап по той же кнопке игнорируем
+RECENT_TAPS = TTLCache(maxsize=10000, ttl=TAP_DEDUP_SECONDS)
+
+
+def is_duplicate_tap(user_id: int, data: str) -> bool:
+    key = (user_id, data)
+    if RECENT_TAPS.get(key):
+        return True
+    RECENT_TAPS.set(key, True)
+    return False
+
 
 async def driver_orders_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -884,10 +3474,13 @@ async def driver_orders_callback(update: Update, context: ContextTypes.DEFAULT_T
     data = query.data
     driver = query.from_user
 
+    if is_duplicate_tap(driver.id, data):
+        return
+
     # Взять заказ
     if data.startswith("drv_take:"):
-        order_id = data.split(":", 1)[1]
-        order = ORDERS_CACHE.get(order_id)
+        order_id = data.split(":")[1]  # в предложении после id — номер реплики
+        order = await get_order(order_id)
 
         if not order:
             await query.answer("Этот заказ уже не активен или не найден.", show_alert=True)
@@ -897,7 +3490,7 @@ async def driver_orders_callback(update: Update, context: ContextTypes.DEFAULT_T
                 pass
             return
 
-        if order.get("status") in ("assigned", "on_place", "finished"):
+        if order.status in ("assigned", "on_place", "finished"):
             await query.answer("Этот заказ уже забрал другой водитель.", show_alert=True)
             try:
                 await query.message.delete()
@@ -906,7 +3499,7 @@ async def driver_orders_callback(update: Update, context: ContextTypes.DEFAULT_T
             return
 
         # проверяем, зарегистрирован ли водитель
-        info = get_driver_info(driver.id)
+        info = await load_driver_info(driver.id)
         if not info:
             await query.answer(
                 "Вы ещё не зарегистрированы как водитель.\n"
@@ -916,7 +3509,7 @@ async def driver_orders_callback(update: Update, context: ContextTypes.DEFAULT_T
             return
 
         # проверяем класс авто
-        required_class = order.get("car_class")
+        required_class = order.car_class
         if info["car_class"] != required_class:
             await query.answer(
                 f"Этот заказ только для класса {required_class}. "
@@ -925,32 +3518,44 @@ async def driver_orders_callback(update: Update, context: ContextTypes.DEFAULT_T
             )
             return
 
-        # обновляем статус
-        order["status"] = "assigned"
-        order["driver_id"] = driver.id
-        order["driver_name"] = info["driver_name"] or driver.username or driver.full_name
-        ORDERS_CACHE[order_id] = order
+        # обновляем статус: пока грузили профиль, заказ мог уйти другому
+        order = await transition_order(
+            order_id,
+            {"status": ("new", None)},
+            status="assigned",
+            driver_id=driver.id,
+            driver_name=info["driver_name"] or driver.username or driver.full_name,
+            assign_seconds=seconds_since(order.created_at),
+        )
+        if order is None:
+            await query.answer("Этот заказ уже забрал другой водитель.", show_alert=True)
+            try:
+                await query.message.delete()
+            except Exception:
+                pass
+            return
         update_order_driver_and_status(
             order_id=order_id,
             status="assigned",
             driver_id=driver.id,
-            driver_name=order["driver_name"],
+            driver_name=order.driver_name,
         )
-
-        # удаляем сообщение из группы
-        try:
-            await query.message.delete()
-        except Exception:
-            pass
+        if order.assign_seconds is not None:
+            ASSIGN_TIMES.append(order.assign_seconds)
+        # удаляем сообщение из группы (или предложение в личке)
+        calls = [
+            ("удалить сообщение с заказом", query.message.delete()),
+            ("закрыть предложения другим водителям", finish_dispatch(context, order_id, driver.id)),
+        ]
 
         # DM водителю
         dm_text = (
             f"Вы приняли заказ #{order_id}\n\n"
-            f"📍 Откуда: {order.get('pickup')}\n"
-            f"🏁 Куда: {order.get('destination') or 'Не указано (срочный)'}\n"
-            f"🚘 Класс: {order.get('car_class')}\n"
-            f"⏰ Время подачи: {order.get('time')}\n"
-            f"⏳ Аренда: {order.get('hours_text')}\n\n"
+            f"📍 Откуда: {order.pickup}\n"
+            f"🏁 Куда: {order.destination or 'Не указано (срочный)'}\n"
+            f"🚘 Класс: {order.car_class}\n"
+            f"⏰ Время подачи: {order.time}\n"
+            f"⏳ Аренда: {order.hours_text}\n\n"
             "После прибытия нажмите «На месте», затем по окончании — «Завершить поездку»."
         )
         keyboard = InlineKeyboardMarkup(
@@ -959,135 +3564,130 @@ async def driver_orders_callback(update: Update, context: ContextTypes.DEFAULT_T
                 [InlineKeyboardButton("🔴 Отменить заказ", callback_data=f"drv_cancel:{order_id}")],
             ]
         )
-        try:
-            await context.bot.send_message(
-                chat_id=driver.id,
-                text=dm_text,
-                reply_markup=keyboard,
-            )
-        except Exception as e:
-            log.error("Не удалось отправить заказ в ЛС водителю: %s", e)
+        calls.append(("заказ в ЛС водителю", context.bot.send_message(
+            chat_id=driver.id,
+            text=dm_text,
+            reply_markup=keyboard,
+        )))
 
         # уведомление клиенту
-        client_id = order.get("user_id")
+        client_id = order.user_id
         if client_id:
+            eta_line = ""
+            if order.pickup_lat is not None:
+                eta = DRIVER_LOCATIONS.driver_eta(driver.id, order.pickup_lat, order.pickup_lon)
+                if eta is not None:
+                    eta_line = f"⏱ Подача примерно через {eta:.0f} мин\n"
             text_client = (
                 "Ваш заказ принят в работу.\n\n"
                 f"Ваш водитель:\n"
-                f"👨‍✈️ {order['driver_name']}\n"
+                f"👨‍✈️ {order.driver_name}\n"
                 f"🚘 {info['car_class']}\n"
-                f"🧾 Номер авто: {info['plate'] or '—'}\n\n"
+                f"🧾 Номер авто: {info['plate'] or '—'}\n"
+                f"{eta_line}\n"
                 "Как только водитель будет на месте — вы получите уведомление.\n"
                 "Фото машины можно запросить командой /carphoto или кнопкой «Фото машины»."
             )
-            try:
-                await context.bot.send_message(chat_id=int(client_id), text=text_client)
-            except Exception as e:
-                log.error("Не удалось отправить уведомление клиенту: %s", e)
+            calls.append(("уведомление клиенту",
+                          context.bot.send_message(chat_id=int(client_id), text=text_client)))
 
-        ACTIVE_CHATS[driver.id] = order_id
+        await fan_out("take", calls)
+
+        await link_chat(driver.id, order_id)
+        remember_user_order(driver.id, order_id)
         if client_id:
-            ACTIVE_CHATS[int(client_id)] = order_id
+            await link_chat(client_id, order_id)
+            remember_user_order(client_id, order_id)
 
     # Отмена заказа водителем
     elif data.startswith("drv_cancel:"):
         order_id = data.split(":", 1)[1]
-        order = ORDERS_CACHE.get(order_id)
+        order = await get_order(order_id)
         if not order:
             await query.answer("Заказ не найден.", show_alert=True)
             return
-        if order.get("driver_id") != driver.id:
+        order = await transition_order(
+            order_id,
+            {"driver_id": (driver.id,), "status": ("assigned", "on_place")},
+            status="new",
+            driver_id=None,
+            driver_name=None,
+        )
+        if order is None:
             await query.answer("Отменить может только водитель, принявший заказ.", show_alert=True)
             return
 
-        order["status"] = "new"
-        order["driver_id"] = None
-        order["driver_name"] = None
-        ORDERS_CACHE[order_id] = order
-
         update_order_driver_and_status(order_id, "new", None, None)
 
+        client_id = order.user_id
+        await unlink_chat(driver.id)
+        if client_id:
+            await unlink_chat(client_id)
+        mark_idle(driver.id)
+
+        # заново предлагаем другим водителям (отказавшемуся — нет)
+        await fan_out("cancel", [
+            ("ответ водителю", query.edit_message_text("Вы отменили заказ. Он возвращён в общий список.")),
+            ("повторное распределение",
+             start_dispatch(context, order, "🆕 Заказ снова доступен", exclude=(driver.id,))),
+        ])
+
+    # Отказ от предложения
+    elif data.startswith("drv_decline:"):
+        order_id = data.split(":")[1]
         try:
-            await query.edit_message_text("Вы отменили заказ. Он возвращён в общий список.")
+            await query.edit_message_text("Вы отказались от заказа.")
         except Exception:
             pass
-
-        try:
-            admin_id = int(ADMIN_CHAT_ID) if ADMIN_CHAT_ID else None
-        except ValueError:
-            admin_id = ADMIN_CHAT_ID
-
-        if admin_id:
-            text_for_drivers = (
-                f"🆕 Заказ снова доступен #{order_id}\n"
-                f"📍 Откуда: {order.get('pickup')}\n"
-                f"🏁 Куда: {order.get('destination') or 'Не указано (срочный)'}\n"
-                f"🚘 Класс: {order.get('car_class')}\n"
-                f"⏰ Время подачи: {order.get('time')}\n"
-                f"⏳ Аренда: {order.get('hours_text')}\n"
-                f"💰 {order.get('approx_price')}\n\n"
-                "Личные данные клиента скрыты."
-            )
-            keyboard = InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🟢 Взять заказ", callback_data=f"drv_take:{order_id}")]]
-            )
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=text_for_drivers,
-                    reply_markup=keyboard,
-                )
-            except Exception as e:
-                log.error("Не удалось вернуть заказ в группу водителей: %s", e)
-
-        client_id = order.get("user_id")
-        ACTIVE_CHATS.pop(driver.id, None)
-        if client_id:
-            ACTIVE_CHATS.pop(int(client_id), None)
+        dispatch = DISPATCHES.get(order_id)
+        if dispatch is not None and driver.id in dispatch.waiting:
+            dispatch.waiting.discard(driver.id)
+            dispatch.messages = [m for m in dispatch.messages if m[0] != driver.id]
+            if not dispatch.waiting:
+                # отказались все — не ждём таймера
+                await next_dispatch_round(context, order_id, "⌛ Предложение закрыто.")
 
     # На месте
     elif data.startswith("drv_arrived:"):
         order_id = data.split(":", 1)[1]
-        order = ORDERS_CACHE.get(order_id)
+        order = await get_order(order_id)
         if not order:
             await query.answer("Заказ не найден.", show_alert=True)
             return
-        if order.get("driver_id") != driver.id:
+        now = datetime.now()
+        order = await transition_order(
+            order_id,
+            {"driver_id": (driver.id,), "status": ("assigned",)},
+            status="on_place",
+            arrived_at=now,
+        )
+        if order is None:
             await query.answer(
                 "Отметить «на месте» может только водитель, принявший заказ.",
                 show_alert=True,
             )
             return
-
-        now = datetime.now()
-        order["status"] = "on_place"
-        order["arrived_at"] = now
-        ORDERS_CACHE[order_id] = order
         update_order_arrived(order_id, now)
 
+        calls = [("ответ водителю", query.edit_message_text(
+            "Отметили: вы на месте. Ожидаем клиента.",
+            reply_markup=InlineKeyboardMarkup(
+                [[InlineKeyboardButton("✅ Завершить поездку", callback_data=f"drv_finish:{order_id}")]]
+            ),
+        ))]
+
         # сообщение клиенту
-        client_id = order.get("user_id")
+        client_id = order.user_id
         if client_id:
-            try:
-                await context.bot.send_message(
-                    chat_id=int(client_id),
-                    text="🚗 Ваш водитель на месте. После окончания поездки можно нажать «Завершить поездку».",
-                    reply_markup=InlineKeyboardMarkup(
-                        [[InlineKeyboardButton("✅ Завершить поездку", callback_data=f"cli_finish:{order_id}")]]
-                    ),
-                )
-            except Exception as e:
-                log.error("Не смог отправить сообщение клиенту: %s", e)
-
-        try:
-            await query.edit_message_text(
-                "Отметили: вы на месте. Ожидаем клиента.",
+            calls.append(("сообщение клиенту", context.bot.send_message(
+                chat_id=int(client_id),
+                text="🚗 Ваш водитель на месте. После окончания поездки можно нажать «Завершить поездку».",
                 reply_markup=InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("✅ Завершить поездку", callback_data=f"drv_finish:{order_id}")]]
+                    [[InlineKeyboardButton("✅ Завершить поездку", callback_data=f"cli_finish:{order_id}")]]
                 ),
-            )
-        except Exception:
-            pass
+            )))
+
+        await fan_out("arrived", calls)
 
     # Завершить поездку (со стороны водителя)
     elif data.startswith("drv_finish:"):
@@ -1103,89 +3703,240 @@ async def driver_orders_callback(update: Update, context: ContextTypes.DEFAULT_T
 async def finish_ride(order_id: str, driver_side: bool,
                       update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    order = ORDERS_CACHE.get(order_id)
+    order = await get_order(order_id)
     if not order:
         await query.answer("Заказ не найден.", show_alert=True)
         return
 
     now = datetime.now()
-    arrived_at = order.get("arrived_at")
-    order["status"] = "finished"
-    ORDERS_CACHE[order_id] = order
+    order = await transition_order(
+        order_id,
+        {"status": ("new", "assigned", "on_place", None)},
+        status="finished",
+    )
+    if order is None:
+        # клиент и водитель нажали «Завершить» одновременно
+        try:
+            await query.edit_message_text("Поездка завершена.")
+        except Exception:
+            pass
+        return
+    arrived_at = order.arrived_at
     update_order_finished(order_id, arrived_at, now)
 
     duration_min = None
     if arrived_at:
         duration_min = int((now - arrived_at).total_seconds() // 60)
 
-    client_id = order.get("user_id")
-    driver_id = order.get("driver_id")
+    client_id = order.user_id
+    driver_id = order.driver_id
 
     text_common = "Спасибо за поездку!"
     if duration_min is not None:
         text_common += f"\nДлительность поездки: {duration_min} мин."
 
+    calls = [("ответ на кнопку", query.edit_message_text("Поездка завершена."))]
     if client_id:
-        try:
-            await context.bot.send_message(chat_id=int(client_id), text=text_common)
-        except Exception as e:
-            log.error("Не удалось отправить сообщение клиенту: %s", e)
-
+        await unlink_chat(client_id)
+        calls.append(("сообщение клиенту", context.bot.send_message(chat_id=int(client_id), text=text_common)))
     if driver_id:
-        try:
-            await context.bot.send_message(chat_id=int(driver_id), text=text_common)
-        except Exception as e:
-            log.error("Не удалось отправить сообщение водителю: %s", e)
+        await unlink_chat(driver_id)
+        mark_idle(int(driver_id))
+        calls.append(("сообщение водителю", context.bot.send_message(chat_id=int(driver_id), text=text_common)))
+
+    await fan_out("finish", calls)
+
+
+# ---------- ГЕОЛОКАЦИЯ ОТ ВОДИТЕЛЕЙ ----------
+
+async def driver_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Живая геолокация водителя (сообщение и его правки) → DRIVER_LOCATIONS."""
+    msg = update.effective_message
+    if not msg or not msg.location or not msg.location.live_period:
+        return  # обычная точка — это адрес подачи в заказе клиента
+    driver_id = msg.from_user.id
+    # таблицу здесь не читаем: правки идут каждые несколько секунд;
+    # водители, заведённые только в таблице, попадут в хранилище при первом заказе
+    info = DRIVER_CACHE.get(str(driver_id))
+    if info is None:
+        info = await store_call(STORE.get_driver, driver_id)
+        if info is None:
+            return
+        DRIVER_CACHE.set(str(driver_id), info)
+    DRIVER_LOCATIONS.update(driver_id, info["car_class"], msg.location.latitude, msg.location.longitude)
+
+
+def apply_shared_locations(rows: List[LocationRow]) -> int:
+    """Точки других реплик — в DRIVER_LOCATIONS, если они новее известных. Возвращает число принятых."""
+    applied = 0
+    for driver_id, car_class, lat, lon, ts, idle_since in rows:
+        driver_id = int(driver_id)
+        if idle_since > DRIVER_IDLE_SINCE.get(driver_id, 0.0):
+            DRIVER_IDLE_SINCE[driver_id] = idle_since
+        known = DRIVER_LOCATIONS.position(driver_id)
+        if known is None or ts > known[2]:
+            DRIVER_LOCATIONS.update(driver_id, car_class, lat, lon, ts, own=False)
+            applied += 1
+    return applied
+
+
+async def sync_driver_locations(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обмен геолокацией с другими репликами через общее хранилище (JobQueue)."""
+    unshared, DRIVER_LOCATIONS.unshared = DRIVER_LOCATIONS.unshared, set()
+    rows = [(driver_id, car_class, lat, lon, ts, DRIVER_IDLE_SINCE.get(driver_id, 0.0))
+            for driver_id, car_class, lat, lon, ts in DRIVER_LOCATIONS.export(unshared)]
+    started = time.time()
+    since = DRIVER_LOCATIONS.synced_at or started - LOCATION_MAX_AGE
+    try:
+        if rows:
+            await store_call(STORE.save_locations, rows)
+        pulled = await store_call(STORE.load_locations, since)
+    except Exception as e:
+        DRIVER_LOCATIONS.unshared |= unshared
+        log.warning("Не удалось обменяться геолокацией с другими репликами: %s", e)
+        return
+    DRIVER_LOCATIONS.synced_at = started - LOCATION_SYNC_OVERLAP
+    apply_shared_locations(pulled)
+
+
+# ---------- ЧАТ КЛИЕНТ ↔ ВОДИТЕЛЬ ----------
+# Пересылаем сообщения любого типа через copy_message: файл копирует сам
+# Telegram, бот ничего не скачивает и не загружает. Текст — как раньше,
+# с подписью «Сообщение от …», у фото/видео/документов/голосовых подпись
+# уходит в caption. Альбом собирается RELAY_ALBUM_WAIT секунд и уходит
+# одним copy_messages следом за строкой с подписью. Живая геолокация — одно сообщение у получателя,
+# которое двигается через edit_message_live_location.
+
+RELAY_ALBUM_WAIT = 1.0
+CAPTIONED_MEDIA = ("photo", "video", "document", "audio", "voice", "animation")
+
+RELAY_LATENCY: Deque[float] = deque(maxlen=1000)  # мс на пересылку одного сообщения (альбома)
+RELAY_LIVE = TTLCache(maxsize=10000, ttl=24 * 3600)  # (чат, сообщение) отправителя -> (чат, сообщение) у получателя
+RELAY_ALBUMS: Dict[Tuple[int, str], List[int]] = {}  # (чат, media_group_id) -> message_id частей альбома
+
+
+async def relay_target(user_id: int) -> Optional[Tuple[int, str]]:
+    """(кому пересылать, подпись), если у пользователя есть активный заказ со второй стороной."""
+    order_id = await chat_order(user_id)
+    if not order_id:
+        return None
+
+    order = await get_order(order_id)
+    if not order:
+        return None
+
+    client_id = order.user_id
+    driver_id = order.driver_id
+
+    if user_id == client_id and driver_id:
+        return int(driver_id), "Сообщение от клиента:"
+    if user_id == driver_id and client_id:
+        return int(client_id), "Сообщение от водителя:"
+    return None
 
-    if client_id:
-        ACTIVE_CHATS.pop(int(client_id), None)
-    if driver_id:
-        ACTIVE_CHATS.pop(int(driver_id), None)
 
+def note_relay_latency(started: float) -> None:
+    RELAY_LATENCY.append((time.perf_counter() - started) * 1000)
+
+
+def relay_latency_stats() -> str:
+    if not RELAY_LATENCY:
+        return "нет данных"
+    p50, p95, top = percentiles(RELAY_LATENCY)
+    return f"p50 {p50:.0f} мс, p95 {p95:.0f} мс, max {top:.0f} мс ({len(RELAY_LATENCY)} сообщ.)"
+
+
+async def relay_live_location(bot: Any, msg: Any, target_id: int) -> None:
+    """Первая точка — новое сообщение у получателя, следующие правки — его правки."""
+    location = msg.location
+    relayed = RELAY_LIVE.get((msg.chat_id, msg.message_id))
+    if relayed is None or relayed[0] != target_id:
+        sent = await bot.send_location(
+            chat_id=target_id,
+            latitude=location.latitude,
+            longitude=location.longitude,
+            live_period=location.live_period,
+            heading=location.heading,
+            horizontal_accuracy=location.horizontal_accuracy,
+        )
+        RELAY_LIVE.set((msg.chat_id, msg.message_id), (target_id, sent.message_id))
+        return
     try:
-        await query.edit_message_text("Поездка завершена.")
-    except Exception:
-        pass
+        await bot.edit_message_live_location(
+            chat_id=target_id,
+            message_id=relayed[1],
+            latitude=location.latitude,
+            longitude=location.longitude,
+            heading=location.heading,
+            horizontal_accuracy=location.horizontal_accuracy,
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
 
 
-# ---------- ЧАТ КЛИЕНТ ↔ ВОДИТЕЛЬ ----------
+async def relay_album(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Части альбома собраны (JobQueue) — копируем одним запросом, группировка сохраняется.
+    copy_messages не меняет подписи, поэтому «Сообщение от …» уходит строкой перед альбомом.
+    """
+    key, target_id, prefix = context.job.data
+    message_ids = RELAY_ALBUMS.pop(key, None)
+    if not message_ids:
+        return
+    started = time.perf_counter()
+    try:
+        await context.bot.send_message(chat_id=target_id, text=prefix)
+        await context.bot.copy_messages(chat_id=target_id, from_chat_id=key[0], message_ids=sorted(message_ids))
+    except Exception as e:
+        log.error("Ошибка пересылки альбома в чате: %s", e)
+        return
+    note_relay_latency(started)
+
 
 async def chat_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Если у пользователя есть активный заказ — пересылаем сообщение второй стороне."""
-    msg = update.message
+    msg = update.effective_message
     if not msg or msg.chat.type != ChatType.PRIVATE:
         return
     if msg.text and msg.text.startswith("/"):
         return  # команды отдельно
+    live = bool(msg.location and msg.location.live_period)
+    if update.edited_message is not None and not live:
+        return  # из правок пересылаем только движение живой геолокации
 
-    user_id = msg.from_user.id
-    order_id = ACTIVE_CHATS.get(user_id)
-    if not order_id:
-        return
-
-    order = ORDERS_CACHE.get(order_id)
-    if not order:
+    target = await relay_target(msg.from_user.id)
+    if target is None:
         return
+    target_id, prefix = target
 
-    client_id = order.get("user_id")
-    driver_id = order.get("driver_id")
-
-    if user_id == client_id and driver_id:
-        prefix = "Сообщение от клиента:"
-        target_id = driver_id
-    elif user_id == driver_id and client_id:
-        prefix = "Сообщение от водителя:"
-        target_id = client_id
-    else:
+    if msg.media_group_id and context.job_queue is not None:
+        key = (msg.chat_id, msg.media_group_id)
+        if key in RELAY_ALBUMS:
+            RELAY_ALBUMS[key].append(msg.message_id)
+        else:
+            RELAY_ALBUMS[key] = [msg.message_id]
+            context.job_queue.run_once(relay_album, RELAY_ALBUM_WAIT, data=(key, target_id, prefix),
+                                       name=f"album:{key[0]}:{key[1]}")
         return
 
+    started = time.perf_counter()
     try:
-        await context.bot.send_message(
-            chat_id=int(target_id),
-            text=f"{prefix}\n{msg.text or ''}",
-        )
+        if live:
+            await relay_live_location(context.bot, msg, target_id)
+        elif msg.text:
+            await context.bot.send_message(chat_id=target_id, text=f"{prefix}\n{msg.text}")
+        elif any(getattr(msg, kind) for kind in CAPTIONED_MEDIA):
+            caption = f"{prefix}\n{msg.caption}" if msg.caption else prefix
+            await context.bot.copy_message(chat_id=target_id, from_chat_id=msg.chat_id,
+                                           message_id=msg.message_id, caption=caption[:1024])
+        else:
+            # стикеры, точки, контакты, кружки — подписи у них нет
+            await context.bot.copy_message(chat_id=target_id, from_chat_id=msg.chat_id, message_id=msg.message_id)
     except Exception as e:
         log.error("Ошибка пересылки сообщения в чате: %s", e)
+        return
+    note_relay_latency(started)
 
 
 # ---------- /carphoto ----------
@@ -1193,41 +3944,31 @@ async def chat_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 async def carphoto_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
 
-    # ищем последний заказ клиента
-    try:
-        col_user = ORDERS_SHEET.col_values(2)  # user_id
-        col_order = ORDERS_SHEET.col_values(1)
-        last_order_id = None
-        for idx in range(len(col_user) - 1, 0, -1):
-            if col_user[idx] and str(col_user[idx]) == str(user_id):
-                last_order_id = col_order[idx]
-                break
-    except Exception as e:
-        log.error("Ошибка поиска заказа для carphoto: %s", e)
-        last_order_id = None
+    # последний заказ клиента: из памяти, таблицу читаем только при холодном промахе
+    known, last_order_id = last_user_order(user_id)
+    if not known:
+        last_order_id = await SHEETS.call(find_last_order_of_user, user_id, default=False)
+        if last_order_id is False:
+            last_order_id = None  # таблица недоступна — повторим в следующий раз
+        else:
+            remember_user_order(user_id, last_order_id)
 
     if not last_order_id:
         await update.message.reply_text("Информация о водителе временно недоступна. Попробуйте позже.")
         return
 
-    order = ORDERS_CACHE.get(last_order_id)
+    order = await get_order(last_order_id)
     driver_id: Optional[int] = None
     if order:
-        driver_id = order.get("driver_id")
+        driver_id = order.driver_id
     else:
-        try:
-            row_vals = ORDERS_SHEET.row_values(find_order_row(last_order_id))
-            if len(row_vals) >= 13 and row_vals[12]:
-                driver_id = int(row_vals[12])
-        except Exception as e:
-            log.error("Ошибка чтения строки заказа для carphoto: %s", e)
-            driver_id = None
+        driver_id = await SHEETS.call(get_order_driver_id, last_order_id)
 
     if not driver_id:
         await update.message.reply_text("Водитель ещё не назначен или информация недоступна.")
         return
 
-    info = get_driver_info(driver_id)
+    info = await load_driver_info(driver_id)
     if not info:
         await update.message.reply_text("Информация о водителе временно недоступна.")
         return
@@ -1257,10 +3998,504 @@ async def carphoto_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.message.reply_text(text)
 
 
+# ---------- СОХРАНЕНИЕ ДИАЛОГОВ ----------
+# Клиент на середине заказа (PICKUP → … → CONFIRM) не должен терять
+# введённое при рестарте: состояние ConversationHandler и user_data
+# пишутся в журнал. У каждой реплики свой файл — роутер закрепляет чат за ней.
+
+PERSISTENCE_PATH = os.environ.get("PERSISTENCE_PATH", f"vip_taxi_state_{REPLICA_ID}.jsonl")
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", "5"))
+PERSISTENCE_COMPACT_MIN = 1000  # строк журнала, раньше не сжимаем
+PERSISTENCE_COMPACT_RATIO = 4   # журнал длиннее живых записей в N раз → сжимаем
+
+
+class AppendLogPersistence(BasePersistence):
+    """
+    Состояние диалогов, user_data, chat_data и bot_data в журнале JSON Lines.
+    Дописываются только изменившиеся записи, поэтому сброс стоит столько же
+    при 10 и при 10 000 активных диалогов. Когда журнал разрастается, он
+    переписывается снимком живых записей (через временный файл и os.replace).
+    callback_data бот не использует — она не хранится.
+    """
+
+    def __init__(self, path: str, update_interval: float) -> None:
+        super().__init__(
+            store_data=PersistenceInput(callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        # JSON последней записанной версии: t ("u" — user_data, "h" — chat_data) -> id -> JSON
+        self._data: Dict[str, Dict[int, str]] = {"u": {}, "h": {}}
+        self._bot_data: Optional[str] = None
+        self._conversations: Dict[str, Dict[Tuple, Any]] = {}
+        self._file = None
+        self._lines = 0
+        self._load()
+        self._compact()
+
+    @staticmethod
+    def _dump(value: Any) -> str:
+        return json.dumps(value, ensure_ascii=False, sort_keys=True, default=_json_default)
+
+    def _load(self) -> None:
+        try:
+            log_file = open(self.path, encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with log_file:
+            for line in log_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # оборванная при падении последняя строка
+                if entry["t"] in self._data:
+                    if entry["d"] is None:
+                        self._data[entry["t"]].pop(entry["id"], None)
+                    else:
+                        self._data[entry["t"]][entry["id"]] = self._dump(entry["d"])
+                elif entry["t"] == "b":
+                    self._bot_data = None if entry["d"] is None else self._dump(entry["d"])
+                else:
+                    conversation = self._conversations.setdefault(entry["n"], {})
+                    if entry["s"] is None:
+                        conversation.pop(tuple(entry["k"]), None)
+                    else:
+                        conversation[tuple(entry["k"])] = entry["s"]
+        log.info("Диалоги восстановлены из %s: user_data %d, chat_data %d, диалогов %d", self.path,
+                 len(self._data["u"]), len(self._data["h"]), sum(map(len, self._conversations.values())))
+
+    @staticmethod
+    def _data_line(kind: str, data_id: int, raw: Optional[str]) -> str:
+        return f'{{"t": "{kind}", "id": {int(data_id)}, "d": {raw or "null"}}}\n'
+
+    @staticmethod
+    def _bot_line(raw: Optional[str]) -> str:
+        return f'{{"t": "b", "d": {raw or "null"}}}\n'
+
+    def _conversation_line(self, name: str, key: Tuple, state: Any) -> str:
+        return self._dump({"t": "c", "n": name, "k": list(key), "s": state}) + "\n"
+
+    def _live(self) -> int:
+        return (sum(map(len, self._data.values())) + sum(map(len, self._conversations.values()))
+                + (self._bot_data is not None))
+
+    def _append(self, line: str) -> None:
+        self._file.write(line)
+        self._file.flush()  # в ОС, без fsync: падение процесса не теряет запись
+        self._lines += 1
+        if self._lines > max(PERSISTENCE_COMPACT_MIN, self._live() * PERSISTENCE_COMPACT_RATIO):
+            self._compact()
+
+    def _compact(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as tmp:
+            for kind, data in self._data.items():
+                for data_id, raw in data.items():
+                    tmp.write(self._data_line(kind, data_id, raw))
+            if self._bot_data is not None:
+                tmp.write(self._bot_line(self._bot_data))
+            for name, conversation in self._conversations.items():
+                for key, state in conversation.items():
+                    tmp.write(self._conversation_line(name, key, state))
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        if self._file:
+            self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._lines = self._live()
+
+    def _update_data(self, kind: str, data_id: int, data: Dict[Any, Any]) -> None:
+        raw = self._dump(data) if data else None
+        stored = self._data[kind]
+        if raw == stored.get(data_id):
+            return
+        if raw is None:
+            stored.pop(data_id, None)
+        else:
+            stored[data_id] = raw
+        self._append(self._data_line(kind, data_id, raw))
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {user_id: json.loads(raw) for user_id, raw in self._data["u"].items()}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {chat_id: json.loads(raw) for chat_id, raw in self._data["h"].items()}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return json.loads(self._bot_data) if self._bot_data else {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple, Any]:
+        return dict(self._conversations.get(name, {}))
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        conversation = self._conversations.setdefault(name, {})
+        if new_state is None:
+            if conversation.pop(key, None) is None:
+                return
+        elif conversation.get(key) == new_state:
+            return
+        else:
+            conversation[key] = new_state
+        self._append(self._conversation_line(name, key, new_state))
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        self._update_data("u", user_id, data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._update_data("u", user_id, {})
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        self._update_data("h", chat_id, data)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._update_data("h", chat_id, {})
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        raw = self._dump(data) if data else None
+        if raw != self._bot_data:
+            self._bot_data = raw
+            self._append(self._bot_line(raw))
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+
+# ---------- ЗАПУСК / ОСТАНОВКА ----------
+
+BACKGROUND_TASKS: List[asyncio.Task] = []
+
+
+async def on_startup(app: Application) -> None:
+    # всё сетевое — в фоне, чтобы polling стартовал сразу
+    restore_state()
+    load_ai_cache()
+    CANNED_REPLIES.load(CANNED_REPLIES_PATH)
+    for writer in SHEET_WRITERS:
+        writer.load()
+        writer.start()
+    BACKGROUND_TASKS.append(asyncio.create_task(set_commands(app)))
+    BACKGROUND_TASKS.append(asyncio.create_task(warm_up_sheets()))
+    log.info("Старт за %.2f с", time.monotonic() - STARTED_AT)
+
+
+async def on_shutdown(app: Application) -> None:
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    for writer in SHEET_WRITERS:
+        await writer.stop()
+    SHEETS.shutdown()
+    STORE_OUTBOX_EXECUTOR.shutdown(wait=True)  # очередь зеркала дописываем до выхода
+    STORE_EXECUTOR.shutdown(wait=False)
+    await LLM.close()
+    save_ai_cache()
+
+
+# ---------- ПРИЁМ АПДЕЙТОВ ПО HTTP: ВЕБХУК, РОУТЕР И РЕПЛИКИ ----------
+# --mode webhook: Telegram шлёт апдейты прямо боту — без задержки long polling.
+# Несколько реплик: Telegram шлёт вебхук роутеру (--mode router), роутер
+# пересылает апдейт реплике по chat_id (--mode replica). Один чат всегда
+# попадает на одну реплику, поэтому диалоги ConversationHandler не рвутся,
+# а заказы и чаты лежат в общем хранилище (STATE_BACKEND=redis).
+# Везде проверяется X-Telegram-Bot-Api-Secret-Token; GET /health — проверка живости.
+
+HTTP_HOST = os.environ.get("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.environ.get("PORT", "8080"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # публичный адрес бота или роутера, https://…/telegram
+# по умолчанию выводим из токена — одинаковый у роутера и всех реплик
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+HEALTH_PATH = "/health"
+REPLICA_URLS = [url.strip() for url in os.environ.get("REPLICA_URLS", "").split(",") if url.strip()]
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_MAX_HEADERS = 100
+# медленный или молчащий клиент не держит соединение: заголовки, тело и ответ —
+# не дольше HTTP_READ_TIMEOUT, простой keep-alive между запросами — HTTP_IDLE_TIMEOUT
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "10"))
+HTTP_IDLE_TIMEOUT = float(os.environ.get("HTTP_IDLE_TIMEOUT", "75"))
+
+HttpHandler = Callable[[str, str, Dict[str, str], bytes], Any]
+
+
+class HttpServer:
+    """
+    Минимальный HTTP/1.1 сервер на asyncio (keep-alive, Content-Length):
+    апдейты Telegram — это один POST с JSON, веб-фреймворк ради этого не нужен.
+    handler(method, path, headers, body) -> (status, body).
+    Каждое чтение и запись ограничены по времени, иначе соединения,
+    присылающие запрос по байту, копились бы без предела (slowloris).
+    """
+
+    def __init__(self, handler: HttpHandler, host: str, port: int) -> None:
+        self._handler = handler
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        log.info("HTTP-сервер слушает %s:%d", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    @staticmethod
+    async def _read_headers(reader: asyncio.StreamReader) -> Dict[str, str]:
+        headers: Dict[str, str] = {}
+        for _ in range(HTTP_MAX_HEADERS):
+            header = await reader.readline()
+            if header in (b"\r\n", b"\n", b""):
+                return headers
+            name, _, value = header.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        raise ValueError("слишком много заголовков")
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+                if not line:
+                    break
+                method, path, _ = line.decode("latin-1").split(" ", 2)
+                headers = await asyncio.wait_for(self._read_headers(reader), HTTP_READ_TIMEOUT)
+                length = int(headers.get("content-length") or 0)
+                if length > HTTP_MAX_BODY:
+                    status, payload = 413, b""
+                    headers["connection"] = "close"
+                else:
+                    body = await asyncio.wait_for(reader.readexactly(length), HTTP_READ_TIMEOUT)
+                    try:
+                        status, payload = await self._handler(method, path.split("?", 1)[0], headers, body)
+                    except Exception:
+                        log.exception("Ошибка обработки HTTP-запроса %s %s", method, path)
+                        status, payload = 500, b""
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    "Content-Type: application/json\r\n\r\n".encode("latin-1") + payload
+                )
+                await asyncio.wait_for(writer.drain(), HTTP_READ_TIMEOUT)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+# задержка «апдейт принят по HTTP → начата обработка», мс
+UPDATE_RECEIVED: Dict[int, float] = {}
+UPDATE_LATENCY: Deque[float] = deque(maxlen=1000)
+
+
+def has_valid_secret(headers: Dict[str, str]) -> bool:
+    return hmac.compare_digest(headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET)
+
+
+async def note_update_latency(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Группа -1, до остальных хендлеров: замер задержки очереди."""
+    received = UPDATE_RECEIVED.pop(update.update_id, None)
+    if received is not None:
+        UPDATE_LATENCY.append((time.monotonic() - received) * 1000)
+
+
+def update_latency_stats() -> str:
+    if not UPDATE_LATENCY:
+        return "нет данных (polling или ещё не было апдейтов)"
+    p50, p95, top = percentiles(UPDATE_LATENCY)
+    return f"p50 {p50:.1f} мс, p95 {p95:.1f} мс, max {top:.1f} мс ({len(UPDATE_LATENCY)} апд.)"
+
+
+def json_response(status: int, payload: Dict[str, Any]) -> Tuple[int, bytes]:
+    return status, json.dumps(payload, ensure_ascii=False).encode()
+
+
+def update_chat_id(data: Dict[str, Any]) -> Optional[int]:
+    """chat_id апдейта (для колбэков — чат сообщения с кнопкой), иначе id отправителя."""
+    query = data.get("callback_query")
+    if query:
+        message = query.get("message")
+        return message["chat"]["id"] if message else query["from"]["id"]
+    for value in data.values():
+        if isinstance(value, dict):
+            if "chat" in value:
+                return value["chat"]["id"]
+            if "from" in value:
+                return value["from"]["id"]
+            if "user" in value:
+                return value["user"]["id"]
+    return None
+
+
+def update_replica(data: Dict[str, Any], replicas: int) -> int:
+    """
+    Номер реплики для апдейта: нажатия в предложениях заказа — реплике,
+    которая их разослала (номер в конце callback_data), остальное — chat_id % N.
+    """
+    query = data.get("callback_query")
+    if query:
+        parts = (query.get("data") or "").split(":")
+        if parts[0] in ("drv_take", "drv_decline") and len(parts) == 3 and parts[2].isdigit():
+            return int(parts[2]) % replicas
+    return (update_chat_id(data) or 0) % replicas
+
+
+class UpdateRouter:
+    """
+    Пересылает апдейт реплике replicas[update_replica(...)];
+    порядок REPLICA_URLS должен совпадать с REPLICA_ID реплик.
+    """
+
+    def __init__(self, replicas: List[str]) -> None:
+        assert replicas, "REPLICA_URLS is required for --mode router"
+        self.replicas = replicas
+        self._client = httpx.AsyncClient(timeout=10)
+        self._errors = httpx.HTTPError
+
+    def pick(self, data: Dict[str, Any]) -> str:
+        return self.replicas[update_replica(data, len(self.replicas))]
+
+    async def handle(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, bytes]:
+        if method == "GET" and path == HEALTH_PATH:
+            return json_response(200, {"status": "ok", "mode": "router", "replicas": len(self.replicas)})
+        if method != "POST" or path != WEBHOOK_PATH:
+            return 404, b""
+        if not has_valid_secret(headers):
+            return 403, b""
+        url = self.pick(json.loads(body))
+        try:
+            response = await self._client.post(url, content=body, headers={
+                "Content-Type": "application/json",
+                SECRET_HEADER: WEBHOOK_SECRET,
+            })
+        except self._errors as e:
+            log.error("Реплика %s недоступна: %s", url, e)
+            return 502, b""  # Telegram повторит доставку
+        return response.status_code, b""
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+async def wait_for_stop_signal() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+async def run_router() -> None:
+    router = UpdateRouter(REPLICA_URLS)
+    server = HttpServer(router.handle, HTTP_HOST, HTTP_PORT)
+    await server.start()
+    if WEBHOOK_URL:
+        from telegram import Bot
+
+        async with Bot(BOT_TOKEN) as bot:
+            await set_webhook(bot)
+    log.info("Роутер: %d реплик", len(REPLICA_URLS))
+    try:
+        await wait_for_stop_signal()
+    finally:
+        await server.stop()
+        await router.close()
+
+
+async def set_webhook(bot: Any) -> None:
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    log.info("Вебхук установлен: %s", WEBHOOK_URL)
+
+
+def webhook_handler(app: Application) -> HttpHandler:
+    """
+    Приём апдейтов: проверяем секрет и сразу кладём апдейт в очередь Application —
+    ответ Telegram не ждёт обработки. Соединения обслуживаются параллельно.
+    """
+
+    async def handle(method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, bytes]:
+        if method == "GET" and path == HEALTH_PATH:
+            ready = app.running
+            return json_response(200 if ready else 503, {
+                "status": "ok" if ready else "starting",
+                "sheets_ready": SHEETS_READY.is_set(),
+                "queue": app.update_queue.qsize(),
+                "uptime_s": round(time.monotonic() - STARTED_AT),
+            })
+        if method != "POST" or path != WEBHOOK_PATH:
+            return 404, b""
+        if not has_valid_secret(headers):
+            return 403, b""
+        update = Update.de_json(json.loads(body), app.bot)
+        UPDATE_RECEIVED[update.update_id] = time.monotonic()
+        await app.update_queue.put(update)
+        return 200, b""
+
+    return handle
+
+
+async def run_webhook(app: Application, own_webhook: bool) -> None:
+    """
+    --mode webhook (own_webhook=True): сами регистрируем вебхук в Telegram.
+    --mode replica: апдейты приходят от роутера, вебхук регистрирует он.
+    """
+    server = HttpServer(webhook_handler(app), HTTP_HOST, HTTP_PORT)
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    await server.start()
+    if own_webhook:
+        await set_webhook(app.bot)
+    try:
+        await wait_for_stop_signal()
+    finally:
+        await server.stop()
+        await app.stop()
+        await app.shutdown()
+        await on_shutdown(app)
+
+
 # ---------- РОУТИНГ ----------
 
 def build_app() -> Application:
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .persistence(AppendLogPersistence(PERSISTENCE_PATH, PERSISTENCE_INTERVAL))
+        .rate_limiter(OUTBOUND)
+        .build()
+    )
+
+    # замер задержки апдейтов (вебхук)
+    app.add_handler(TypeHandler(Update, note_update_latency), group=-1)
 
     # базовые команды
     app.add_handler(CommandHandler("start", start))
@@ -1271,6 +4506,7 @@ def build_app() -> Application:
     app.add_handler(CommandHandler("cancel", cancel_cmd))
     app.add_handler(CommandHandler("ai", ai_cmd))
     app.add_handler(CommandHandler("carphoto", carphoto_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
 
     # регистрация водителя
     drv_conv = ConversationHandler(
@@ -1288,7 +4524,10 @@ def build_app() -> Application:
         MessageHandler(filters.Regex("^❌ Отмена$"), cancel_cmd),
     ],
     allow_reentry=True,
-) 
+    name="drv_conv",
+    persistent=True,
+)
+    app.add_handler(drv_conv)
 
     # заказ (обычный + срочный)
     order_conv = ConversationHandler(
@@ -1323,6 +4562,8 @@ def build_app() -> Application:
             MessageHandler(filters.Regex("^❌ Отмена$"), cancel_cmd),
         ],
         allow_reentry=True,
+        name="order_conv",
+        persistent=True,
     )
     app.add_handler(order_conv)
 
@@ -1336,14 +4577,56 @@ def build_app() -> Application:
     app.add_handler(MessageHandler(filters.Regex("^📸 Фото машины$"), carphoto_cmd))
     app.add_handler(MessageHandler(filters.Regex("^❌ Отмена$"), cancel_cmd))
 
-    # чат клиент ↔ водитель
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat_router), group=20)
+    # живая геолокация водителей (в т.ч. edited_message)
+    app.add_handler(MessageHandler(filters.LOCATION & filters.ChatType.PRIVATE, driver_location), group=10)
+
+    # чат клиент ↔ водитель: сообщения любого типа и правки живой геолокации
+    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND, chat_router), group=20)
+
+    # архивация завершённых заказов (одна реплика) и чистка памяти
+    if app.job_queue:
+        if REPLICA_ID == 0:
+            app.job_queue.run_repeating(
+                archive_job, interval=ARCHIVE_INTERVAL_HOURS * 3600, first=600, name="archive"
+            )
+        app.job_queue.run_repeating(
+            evict_orders_job, interval=max(60.0, ORDER_FINISHED_TTL / 4), first=300, name="evict_orders"
+        )
+        app.job_queue.run_repeating(
+            driver_locations_job, interval=LOCATION_SHEET_INTERVAL, first=LOCATION_SHEET_INTERVAL,
+            name="driver_locations",
+        )
+        if STORE.shared:
+            app.job_queue.run_repeating(
+                sync_driver_locations, interval=LOCATION_SYNC_INTERVAL, first=1, name="sync_locations"
+            )
+        if AI_CACHE_PATH:
+            app.job_queue.run_repeating(
+                ai_cache_job, interval=AI_CACHE_SAVE_INTERVAL, first=AI_CACHE_SAVE_INTERVAL, name="ai_cache"
+            )
+    else:
+        log.warning("JobQueue недоступна (нужен python-telegram-bot[job-queue]) — архивация, чистка памяти и запись координат отключены")
 
-    app.post_init = set_commands
+    app.post_init = on_startup
+    app.post_shutdown = on_shutdown
     return app
 
 
 if __name__ == "__main__":
-    app = build_app()
-    log.info("Bot is starting…")
-    app.run_polling(close_loop=False)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=f"{BRAND_NAME} bot")
+    parser.add_argument("--mode", choices=("polling", "webhook", "router", "replica"),
+                        default=os.environ.get("BOT_MODE", "polling"))
+    args = parser.parse_args()
+    if args.mode == "webhook" and not WEBHOOK_URL:
+        log.warning("WEBHOOK_URL не задан — запускаемся в режиме polling")
+        args.mode = "polling"
+
+    if args.mode == "router":
+        asyncio.run(run_router())
+    else:
+        app = build_app()
+        log.info("Bot is starting… (%s)", args.mode)
+        if args.mode in ("webhook", "replica"):
+            asyncio.run(run_webhook(app, own_webhook=args.mode == "webhook"))
+        else:
+            app.run_polling(close_loop=False)
\ No newline at end of file
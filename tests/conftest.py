@@ -0,0 +1,86 @@
+import os
+import re
+import sys
+
+# bot.py читает настройки при импорте: ставим заглушки до него
+os.environ.setdefault("BOT_TOKEN", "123:TEST")
+os.environ.setdefault("SHEET_ID", "test-sheet")
+os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS_JSON", "{}")
+os.environ.setdefault("STATE_BACKEND", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import bot  # noqa: E402
+
+
+class FakeWorksheet:
+    """Лист в памяти с теми методами gspread, которые вызывает бот."""
+
+    def __init__(self, title, rows=None):
+        self.title = title
+        self.id = abs(hash(title)) % 100000
+        self.rows = [list(row) for row in (rows or [])]
+        self.calls = []
+
+    def col_values(self, col):
+        self.calls.append("col_values")
+        return [row[col - 1] if len(row) >= col else "" for row in self.rows]
+
+    def get_all_values(self):
+        self.calls.append("get_all_values")
+        return [list(row) for row in self.rows]
+
+    def append_rows(self, values, value_input_option=None):
+        self.calls.append("append_rows")
+        start = len(self.rows) + 1
+        self.rows += [[str(v) for v in row] for row in values]
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:Q{len(self.rows)}"}}
+
+    def append_row(self, values, value_input_option=None):
+        return self.append_rows([values], value_input_option)
+
+    def batch_update(self, data, value_input_option=None):
+        self.calls.append("batch_update")
+        for item in data:
+            m = re.match(r"([A-Z]+)(\d+)", item["range"])
+            col = sum((ord(ch) - 64) * 26 ** i for i, ch in enumerate(reversed(m.group(1))))
+            row = self.rows[int(m.group(2)) - 1]
+            row += [""] * (col - len(row))
+            row[col - 1] = str(item["values"][0][0])
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    """Свой SheetsGateway на тест: семафор и бакет привязываются к циклу теста."""
+    sheets = bot.SheetsGateway(max_workers=2, timeout=1.0)
+    monkeypatch.setattr(bot, "SHEETS", sheets)
+    yield sheets
+    sheets.shutdown()
+
+
+@pytest.fixture(params=["memory", "sqlite", "sqlite-shared", "redis"])
+def store(request, tmp_path, monkeypatch):
+    """
+    Чистое хранилище STORE и пустые кэши в памяти. sqlite-shared и redis —
+    blocking: вызовы идут через пул потоков, как у нескольких реплик.
+    """
+    if request.param == "memory":
+        state = bot.MemoryStore()
+    elif request.param == "redis":
+        fakeredis = pytest.importorskip("fakeredis")
+        redis = pytest.importorskip("redis")
+        server = fakeredis.FakeServer()
+        monkeypatch.setattr(redis.Redis, "from_url",
+                            lambda url, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+        state = bot.RedisStore("redis://test", "test:", 0)
+        state.shared = True
+    else:
+        state = bot.OrderStore(str(tmp_path / "orders.db"))
+        if request.param == "sqlite-shared":
+            state.shared = state.blocking = True
+    monkeypatch.setattr(bot, "STORE", state)
+    monkeypatch.setattr(bot, "ORDERS_CACHE", {})
+    monkeypatch.setattr(bot, "ACTIVE_CHATS", {})
+    monkeypatch.setattr(bot, "USER_ORDERS", {})
+    return state
@@ -0,0 +1,22 @@
+import bot
+
+
+def test_key_ignores_case_yo_and_punctuation():
+    assert bot.ai_cache_key("Клиент ждёт машину уже 10 минут!") == \
+        bot.ai_cache_key("  клиент ЖДЕТ машину, уже 10 минут")
+
+
+def test_key_keeps_exact_numbers():
+    # модель получает вопрос как есть, поэтому ответ про 7 минут не годится для 10
+    assert bot.ai_cache_key("водитель опаздывает на 7 минут") != \
+        bot.ai_cache_key("водитель опаздывает на 10 минут")
+    assert bot.ai_cache_key("скидка 1.5%") != bot.ai_cache_key("скидка 15%")
+
+
+def test_key_depends_on_model_and_prompt(monkeypatch):
+    key = bot.ai_cache_key("машина задерживается")
+    monkeypatch.setattr(bot, "MODEL_NAME", "other-model")
+    assert bot.ai_cache_key("машина задерживается") != key
+    monkeypatch.setattr(bot, "MODEL_NAME", key[0])
+    monkeypatch.setattr(bot, "AI_PROMPT_VERSION", "changed")
+    assert bot.ai_cache_key("машина задерживается") != key
@@ -0,0 +1,109 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import bot
+
+
+def event(chunk):
+    return f"data: {json.dumps({'choices': [{'delta': {'content': chunk}}]}, ensure_ascii=False)}\n\n".encode()
+
+
+def streaming_llm(chunks, pause=0.0, fail_after=None):
+    """LLMClient поверх httpx.MockTransport: SSE по фрагменту с паузами, при fail_after — обрыв."""
+    requests = []
+
+    async def body():
+        yield b": keep-alive\n\n"
+        for n, chunk in enumerate(chunks):
+            if fail_after is not None and n == fail_after:
+                raise httpx.ReadError("connection reset")
+            yield event(chunk)
+            await asyncio.sleep(pause)
+        yield b'data: {"choices": [{"delta": {}}]}\n\n'
+        yield b"data: [DONE]\n\n"
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, headers={"Content-Type": "text/event-stream"}, content=body())
+
+    llm = bot.LLMClient("http://llm.test/v1", "test-key", "test-model", 2)
+    llm._client = httpx.AsyncClient(base_url=llm.base_url, transport=httpx.MockTransport(handler))
+    llm.sent = requests
+    return llm
+
+
+@pytest.fixture
+def ai(monkeypatch):
+    monkeypatch.setattr(bot, "AI_EDIT_INTERVAL", 0.05)
+    monkeypatch.setattr(bot, "AI_CACHE", bot.TTLCache(100, 60))
+    monkeypatch.setattr(bot, "LLM", bot.LLM)
+
+
+async def stream_reply(question):
+    """ai_stream_reply — все тексты сообщения бота по порядку и итог для объединённых запросов."""
+    reply = SimpleNamespace(texts=[])
+
+    async def reply_text(text):
+        reply.texts.append(text)
+
+        async def edit_text(new_text):
+            reply.texts.append(new_text)
+
+        reply.edit_text = edit_text
+        return reply
+
+    update = SimpleNamespace(message=SimpleNamespace(reply_text=reply_text))
+    done = asyncio.get_running_loop().create_future()
+    key = bot.ai_cache_key(question)
+    await bot.ai_stream_reply(update, key, question, done)
+    await bot.LLM.close()
+    return reply.texts, done.result(), key
+
+
+def test_stream_yields_content_chunks_only():
+    llm = streaming_llm(["Машина ", "", "будет ", "через 10 минут."])
+
+    async def scenario():
+        chunks = [chunk async for chunk in llm.stream([{"role": "user", "content": "опоздание"}])]
+        await llm.close()
+        return chunks
+
+    assert asyncio.run(scenario()) == ["Машина ", "будет ", "через 10 минут."]
+    assert llm.sent[0]["stream"] is True and llm.sent[0]["model"] == "test-model"
+    assert (llm.requests, llm.errors, llm.breaker.state) == (1, 0, "closed")
+    assert len(llm.first_token) == 1 and len(llm.latency) == 1
+
+
+def test_reply_is_edited_while_streaming(ai):
+    bot.LLM = streaming_llm(["Машина ", "будет ", "через 10 минут."], pause=0.1)
+    texts, result, key = asyncio.run(stream_reply("машина опаздывает"))
+
+    assert texts[0] == "✍️ Пишу ответ…"
+    partial = texts[1:-1]
+    assert partial, "ответ не дописывался по ходу генерации"
+    assert all(text.endswith(" ▌") for text in partial)
+    assert [text[:-2] for text in partial] == sorted({text[:-2] for text in partial}, key=len)
+    assert texts[-1] == result == "Машина будет через 10 минут."
+    assert bot.AI_CACHE.get(key) == result
+
+
+def test_broken_stream_keeps_partial_answer_and_is_not_cached(ai):
+    bot.LLM = streaming_llm(["Машина ", "будет ", "через 10 минут."], pause=0.06, fail_after=2)
+    texts, result, key = asyncio.run(stream_reply("машина опаздывает"))
+
+    assert texts[-1] == result == "Машина будет"
+    assert bot.AI_CACHE.get(key) is None
+    assert (bot.LLM.errors, bot.LLM.breaker.failures) == (1, 1)
+
+
+def test_stream_broken_before_first_chunk_reports_failure(ai):
+    bot.LLM = streaming_llm(["Машина "], fail_after=0)
+    texts, result, key = asyncio.run(stream_reply("машина опаздывает"))
+
+    assert texts == ["✍️ Пишу ответ…", "Не удалось получить ответ от AI-диспетчера."]
+    assert result == "Не удалось получить ответ от AI-диспетчера."
+    assert bot.AI_CACHE.get(key) is None
@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import pytest
+
+import bot
+from conftest import FakeWorksheet
+
+HEADER = [f"col{i}" for i in range(17)]
+
+
+def order_row(order_id, status="finished", created="2024-03-01 10:00:00", finished="2024-03-01 11:00:00"):
+    row = [order_id, "555"] + [""] * 15
+    row[10], row[11], row[15] = created, status, finished
+    return row
+
+
+class FakeSpreadsheet:
+    def __init__(self, orders):
+        self.sheets = {"Лист1": orders}
+
+    def batch_update(self, body):
+        orders = self.sheets["Лист1"]
+        for request in body["requests"]:
+            rng = request["deleteDimension"]["range"]
+            del orders.rows[rng["startIndex"]:rng["endIndex"]]
+
+
+class FakeConnection:
+    def __init__(self, book):
+        self.book = book
+
+    def spreadsheet(self):
+        return self.book
+
+    def worksheet_or_none(self, title):
+        return self.book.sheets.get(title)
+
+    def ensure_worksheet(self, title, header):
+        if title not in self.book.sheets:
+            self.book.sheets[title] = FakeWorksheet(title, [header])
+        return self.book.sheets[title]
+
+
+@pytest.fixture
+def book(monkeypatch):
+    orders = FakeWorksheet("Лист1", [HEADER, order_row("A1"), order_row("A2", status="assigned"),
+                                     order_row("A3")])
+    book = FakeSpreadsheet(orders)
+    monkeypatch.setattr(bot, "SHEETS_CONN", FakeConnection(book))
+    monkeypatch.setattr(bot, "ORDERS_SHEET", orders)
+    monkeypatch.setattr(bot, "ORDERS_INDEX", bot.SheetRowIndex("Лист1", lambda: orders.col_values(1)))
+    monkeypatch.setattr(bot, "ARCHIVE_INDEX", bot.ArchiveIndex())
+    return book
+
+
+def ids(ws):
+    return [row[0] for row in ws.rows[1:]]
+
+
+def test_rerun_after_failure_does_not_duplicate_rows(book, monkeypatch):
+    manifest = FakeWorksheet(bot.ARCHIVE_MANIFEST, [bot.ARCHIVE_MANIFEST_HEADER])
+    book.sheets[bot.ARCHIVE_MANIFEST] = manifest
+    real_append = manifest.append_rows
+
+    def fail_after_write(values, value_input_option=None):
+        real_append(values, value_input_option)
+        raise OSError("connection reset")  # строки записаны, ответ потерян
+
+    monkeypatch.setattr(manifest, "append_rows", fail_after_write)
+    with pytest.raises(OSError):
+        bot.archive_finished_orders(after_days=7, max_rows=5000)
+    assert ids(book.sheets["Лист1"]) == ["A1", "A2", "A3"]  # до удаления не дошли
+
+    monkeypatch.setattr(manifest, "append_rows", real_append)
+    assert bot.archive_finished_orders(after_days=7, max_rows=5000) == {"orders_2024_03": 2}
+    assert ids(book.sheets["orders_2024_03"]) == ["A1", "A3"]
+    assert ids(manifest) == ["A1", "A3"]
+    assert ids(book.sheets["Лист1"]) == ["A2"]
+    assert bot.ARCHIVE_INDEX.sheet_of("A3") == "orders_2024_03"
+
+
+def test_archive_job_holds_writer_lock_until_thread_finishes(book, gateway, monkeypatch):
+    gateway.timeout = 0.05
+    writer = bot.SheetWriter("Лист1", lambda: book.sheets["Лист1"], bot.ORDERS_INDEX, 60)
+    monkeypatch.setattr(bot, "ORDER_WRITER", writer)
+    monkeypatch.setattr(bot, "SHEETS_CALL_TIMEOUT", 0.05)
+    bot.SHEETS_READY.set()
+    calls = []
+
+    def slow_archive(after_days, max_rows):
+        calls.append(after_days)
+        time.sleep(0.5)
+        raise OSError("connection reset")
+
+    monkeypatch.setattr(bot, "archive_finished_orders", slow_archive)
+
+    async def scenario():
+        job = asyncio.create_task(bot.archive_job(None))
+        await asyncio.sleep(0.3)  # таймаут вызова уже прошёл, поток ещё пишет
+        locked = writer.lock.locked()
+        await job
+        return locked
+
+    try:
+        assert asyncio.run(scenario()) is True
+    finally:
+        bot.SHEETS_READY.clear()
+    assert len(calls) == 1  # перенос целиком не повторяли
+    assert not writer.lock.locked()
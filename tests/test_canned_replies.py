@@ -0,0 +1,101 @@
+import pytest
+
+import bot
+
+# Размеченные вопросы диспетчеров: фрагмент правильного шаблона или None, если
+# ни один шаблон не подходит. По ним выбраны CANNED_THRESHOLD и CANNED_MARGIN:
+# ни одного неверного шаблона, а почти дословные формулировки — без модели.
+LABELLED = [
+    ("Машина задерживается", "дорожной ситуации"),
+    ("водитель опаздывает на 10 минут", "дорожной ситуации"),
+    ("водитель стоит в пробке!", "дорожной ситуации"),
+    ("машина опаздывает", "дорожной ситуации"),
+    ("Клиент просит скидку", "тарифы у нас фиксированные"),
+    ("можно ли дешевле?", "тарифы у нас фиксированные"),
+    ("клиент торгуется по цене", "тарифы у нас фиксированные"),
+    ("клиент спрашивает про детское кресло", "детское кресло"),
+    ("нужно автокресло для ребенка", "детское кресло"),
+    ("едем с ребёнком", "детское кресло"),
+    ("сколько водитель ждет?", "будет ожидать Вас"),
+    ("клиент спрашивает про бесплатное ожидание", "будет ожидать Вас"),
+    ("клиент опаздывает на 20 минут", "будет ожидать Вас"),
+    ("клиент хочет изменить время подачи", "удобное Вам время подачи"),
+    ("клиент хочет изменить адрес", "изменить адрес"),
+    ("клиент хочет поменять адрес подачи", "изменить адрес"),
+    ("где машина?", "найти автомобиль"),
+    ("клиент не видит водителя", "найти автомобиль"),
+    ("клиент забыл вещи в машине", "проверить салон"),
+    ("оставил вещи в салоне", "проверить салон"),
+    ("встретить с табличкой", "с табличкой"),
+    ("поместятся ли чемоданы?", "багажным отделением"),
+    ("можно ли с собакой?", "с питомцем"),
+    ("можно с котом?", "с питомцем"),
+    ("можно оплатить наличными?", "Оплата возможна"),
+    ("жалоба на водителя", "разберёмся в ситуации"),
+    ("нужен чек", "подготовим для Вас чек"),
+    ("все машины заняты", "все автомобили этого класса заняты"),
+    ("нет машин бизнес класса", "все автомобили этого класса заняты"),
+    ("клиент хочет курить", "курение не допускается"),
+    ("добавить остановку по пути", "остановку по пути"),
+    ("клиент хочет продлить поездку", "продлить аренду"),
+    ("спасибо за поездку!", "Будем рады видеть Вас снова"),
+    ("клиент хочет изменить заказ", None),
+    ("клиент хочет отменить заказ", None),
+    ("клиент не хочет отменять заказ", None),
+    ("клиент просит скидку 10%, мы можем дать 5%", None),
+    ("клиент не хочет детское кресло", None),
+    ("клиент не просит скидку, просит чек", None),
+    ("водитель не приехал", None),
+    ("клиент требует вернуть деньги", None),
+    ("как стать водителем", None),
+    ("клиент спрашивает цену до аэропорта", None),
+    ("клиент не может дозвониться водителю", None),
+    ("водитель пьяный", None),
+    ("клиент просит воду в машине", None),
+    ("рейс задержали на 2 часа", None),
+]
+
+
+@pytest.fixture
+def index():
+    canned = bot.CannedReplyIndex()
+    canned.load(bot.CANNED_REPLIES_PATH)
+    return canned
+
+
+def evaluate(index):
+    answered, wrong = 0, []
+    for question, expected in LABELLED:
+        reply = index.match(question)
+        if reply is None:
+            continue
+        answered += 1
+        if expected is None or expected not in reply:
+            wrong.append((question, reply))
+    return answered, wrong
+
+
+def test_no_wrong_template_on_labelled_questions(index):
+    answered, wrong = evaluate(index)
+    assert wrong == []
+    assert answered >= 25  # почти дословные формулировки по-прежнему без модели
+
+
+def test_previous_loose_threshold_gave_wrong_answers(index, monkeypatch):
+    monkeypatch.setattr(bot, "CANNED_THRESHOLD", 0.55)
+    monkeypatch.setattr(bot, "CANNED_MARGIN", 0.0)
+    assert evaluate(index)[1]
+
+
+def test_negation_must_agree():
+    index = bot.CannedReplyIndex()
+    index.build([{"situations": ["клиенту нужно детское кресло"], "reply": "Подготовим кресло."},
+                 {"situations": ["клиент не видит водителя"], "reply": "Поможем найти машину."}])
+    assert index.match("клиенту нужно детское кресло!") == "Подготовим кресло."
+    assert index.match("клиенту не нужно детское кресло") is None
+    assert index.match("клиент видит водителя") is None
+
+
+def test_templates_do_not_claim_done_actions(index):
+    for reply in index.replies:
+        assert not reply.startswith(("Мы отменили", "Мы уже")), reply
@@ -0,0 +1,175 @@
+import asyncio
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+class RecordingBot:
+    def __init__(self):
+        self.calls = []
+
+    async def send_message(self, **kwargs):
+        self.calls.append(("send_message", kwargs))
+
+    async def copy_messages(self, **kwargs):
+        self.calls.append(("copy_messages", kwargs))
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, data=None, name=None):
+        self.jobs.append((callback, data))
+
+
+def album_part(message_id):
+    return SimpleNamespace(
+        effective_message=SimpleNamespace(
+            chat=SimpleNamespace(type=bot.ChatType.PRIVATE), chat_id=100, message_id=message_id,
+            text=None, location=None, media_group_id="g1", from_user=SimpleNamespace(id=100)),
+        edited_message=None)
+
+
+def test_album_is_relayed_after_prefix_line(monkeypatch):
+    async def relay_target(user_id):
+        return 200, "Сообщение от клиента:"
+
+    monkeypatch.setattr(bot, "relay_target", relay_target)
+    monkeypatch.setattr(bot, "RELAY_ALBUMS", {})
+    fake_bot, jobs = RecordingBot(), FakeJobQueue()
+    context = SimpleNamespace(bot=fake_bot, job_queue=jobs)
+
+    async def scenario():
+        for message_id in (12, 11, 13):
+            await bot.chat_router(album_part(message_id), context)
+        assert len(jobs.jobs) == 1
+        callback, data = jobs.jobs[0]
+        await callback(SimpleNamespace(bot=fake_bot, job=SimpleNamespace(data=data)))
+
+    asyncio.run(scenario())
+    assert fake_bot.calls == [
+        ("send_message", {"chat_id": 200, "text": "Сообщение от клиента:"}),
+        ("copy_messages", {"chat_id": 200, "from_chat_id": 100, "message_ids": [11, 12, 13]}),
+    ]
+
+
+CLIENT_ID, DRIVER_ID = 1000, 7   # при двух репликах: клиент у реплики 0, водитель у реплики 1
+
+
+class Telegram(RecordingBot):
+    """Один Bot API на все реплики: пишет вызовы и выдаёт message_id отправленным точкам."""
+
+    async def send_message(self, **kwargs):
+        self.calls.append(("send_message", kwargs))
+
+    async def copy_message(self, **kwargs):
+        self.calls.append(("copy_message", kwargs))
+
+    async def send_location(self, **kwargs):
+        self.calls.append(("send_location", kwargs))
+        return SimpleNamespace(message_id=len(self.calls))
+
+    async def edit_message_live_location(self, **kwargs):
+        self.calls.append(("edit_message_live_location", kwargs))
+
+
+def message(chat_id, message_id, text=None, location=None, media_group_id=None, caption=None, **media):
+    fields = {kind: None for kind in bot.CAPTIONED_MEDIA}
+    fields.update(media)
+    return SimpleNamespace(
+        chat=SimpleNamespace(type=bot.ChatType.PRIVATE), chat_id=chat_id, message_id=message_id,
+        text=text, location=location, media_group_id=media_group_id, caption=caption,
+        from_user=SimpleNamespace(id=chat_id), **fields)
+
+
+def live(lat, lon):
+    return SimpleNamespace(latitude=lat, longitude=lon, live_period=900, heading=None, horizontal_accuracy=None)
+
+
+# переписка по заказу: ("new"|"edit", сообщение), "albums" — сработали таймеры альбомов, "done" — заказ закрыт
+CONVERSATION = [
+    ("new", message(CLIENT_ID, 1, text="Я у второго подъезда")),
+    ("new", message(DRIVER_ID, 1, text="Буду через 5 минут")),
+    ("new", message(DRIVER_ID, 2, location=live(55.700, 37.600))),
+    ("new", message(CLIENT_ID, 2, photo=["p"], caption="Вот здесь")),
+    ("edit", message(DRIVER_ID, 2, location=live(55.701, 37.601))),
+    ("new", message(CLIENT_ID, 3, media_group_id="a1", photo=["p"])),
+    ("new", message(DRIVER_ID, 3, voice="v")),
+    ("new", message(CLIENT_ID, 4, media_group_id="a1", photo=["p"])),
+    ("edit", message(DRIVER_ID, 2, location=live(55.702, 37.603))),
+    ("edit", message(DRIVER_ID, 1, text="Буду через 3 минуты")),   # правки текста не пересылаем
+    ("new", message(CLIENT_ID, 5, text="/status")),
+    "albums",
+    ("new", message(DRIVER_ID, 4, sticker="s")),
+    "done",
+    ("new", message(CLIENT_ID, 6, text="Спасибо!")),
+]
+
+
+async def relay_conversation(replicas):
+    telegram = Telegram()
+    states = [{"RELAY_LIVE": bot.TTLCache(100, 60), "RELAY_ALBUMS": {}, "ACTIVE_CHATS": {},
+               "ORDERS_CACHE": {}, "USER_ORDERS": {}} for _ in range(replicas)]
+    jobs = [FakeJobQueue() for _ in range(replicas)]
+    handled = [0] * replicas
+
+    @contextmanager
+    def replica(chat_id):
+        """Глобальное состояние bot той реплики, которой апдейт отдал бы роутер."""
+        number = bot.update_replica({"message": {"chat": {"id": chat_id}}}, replicas)
+        saved = {name: getattr(bot, name) for name in states[number]}
+        for name, value in states[number].items():
+            setattr(bot, name, value)
+        try:
+            yield SimpleNamespace(bot=telegram, job_queue=jobs[number])
+        finally:
+            for name, value in saved.items():
+                setattr(bot, name, value)
+        handled[number] += 1
+
+    # заказ берёт водитель: чат обеих сторон заводит его реплика
+    order = bot.Order(order_id="r1", user_id=CLIENT_ID, driver_id=DRIVER_ID, status="assigned")
+    with replica(DRIVER_ID):
+        await bot.save_order(order)
+        await bot.link_chat(CLIENT_ID, order.order_id)
+        await bot.link_chat(DRIVER_ID, order.order_id)
+
+    for step in CONVERSATION:
+        if step == "albums":
+            for number, queue in enumerate(jobs):
+                while queue.jobs:
+                    callback, data = queue.jobs.pop(0)
+                    with replica(data[0][0]) as context:
+                        await callback(SimpleNamespace(bot=context.bot, job=SimpleNamespace(data=data)))
+        elif step == "done":
+            for user_id in (CLIENT_ID, DRIVER_ID):
+                with replica(user_id):
+                    await bot.unlink_chat(user_id)
+        else:
+            kind, msg = step
+            update = SimpleNamespace(effective_message=msg, edited_message=msg if kind == "edit" else None)
+            with replica(msg.chat_id) as context:
+                await bot.chat_router(update, context)
+    return telegram.calls, handled
+
+
+def test_relay_with_two_replicas_matches_one_process(store, monkeypatch):
+    if not store.shared:
+        pytest.skip("реплики работают только с общим хранилищем")
+    monkeypatch.setattr(bot, "ORDER_WRITER", bot.SheetWriter("Лист1", lambda: None, None, 60))
+    one, _ = asyncio.run(relay_conversation(1))
+    two, handled = asyncio.run(relay_conversation(2))
+    assert all(handled)   # переписка действительно шла через обе реплики
+    assert two == one
+    assert [name for name, _ in one] == [
+        "send_message", "send_message", "send_location", "copy_message", "edit_message_live_location",
+        "copy_message", "edit_message_live_location", "send_message", "copy_messages", "copy_message",
+    ]
+    assert one[0] == ("send_message", {"chat_id": DRIVER_ID, "text": "Сообщение от клиента:\nЯ у второго подъезда"})
+    assert one[3][1]["caption"] == "Сообщение от клиента:\nВот здесь"
+    assert one[4][1]["message_id"] == 3   # правка двигает ту же точку у клиента
+    assert one[8][1] == {"chat_id": DRIVER_ID, "from_chat_id": CLIENT_ID, "message_ids": [3, 4]}
@@ -0,0 +1,59 @@
+import time
+
+import bot
+
+RESET = 0.05
+
+
+def test_opens_after_consecutive_failures_only():
+    breaker = bot.CircuitBreaker(max_failures=3, reset_timeout=RESET)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()  # успех сбрасывает счётчик
+    breaker.failure()
+    breaker.failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow() and not breaker.allow()
+    assert (breaker.opened, breaker.rejected) == (1, 2)
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = bot.CircuitBreaker(max_failures=1, reset_timeout=RESET)
+    breaker.failure()
+    time.sleep(RESET * 1.2)
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()  # пока проба не вернулась — остальные отклоняются
+
+
+def test_probe_success_closes():
+    breaker = bot.CircuitBreaker(max_failures=1, reset_timeout=RESET)
+    breaker.failure()
+    time.sleep(RESET * 1.2)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed"
+    assert all(breaker.allow() for _ in range(5))
+
+
+def test_probe_failure_reopens_for_full_timeout():
+    breaker = bot.CircuitBreaker(max_failures=3, reset_timeout=RESET)
+    for _ in range(3):
+        breaker.failure()
+    time.sleep(RESET * 1.2)
+    assert breaker.allow()
+    breaker.failure()  # одной ошибки пробы достаточно
+    assert breaker.state == "open" and breaker.opened == 2
+    assert not breaker.allow()
+
+
+def test_hung_probe_does_not_block_forever():
+    breaker = bot.CircuitBreaker(max_failures=1, reset_timeout=RESET)
+    breaker.failure()
+    time.sleep(RESET * 1.2)
+    assert breaker.allow()  # проба ушла и не вернулась
+    assert not breaker.allow()
+    time.sleep(RESET * 1.2)
+    assert breaker.allow()  # следующая проба через reset_timeout
@@ -0,0 +1,411 @@
+"""
+Распределение заказов на нескольких репликах в одном процессе.
+
+У каждой реплики своя память (DISPATCHES, DRIVER_LOCATIONS, кэши, REPLICA_ID),
+хранилище общее (SQLite-файл), апдейты раздаются как в UpdateRouter —
+через update_replica. Таймеры JobQueue срабатывают вручную.
+"""
+import asyncio
+import random
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+CLIENT_ID = 1000          # чётный: при двух репликах клиент у реплики 0
+PICKUP = (55.75, 37.62)
+GROUP_ID = -100
+
+
+def point_at(km):
+    """Точка в km к северу от подачи."""
+    return PICKUP[0] + km / bot.KM_PER_DEG_LAT, PICKUP[1]
+
+
+class FakeTelegram:
+    """Bot API в памяти: сообщения по message_id, их текст и кнопки."""
+
+    def __init__(self):
+        self.messages = {}
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        message_id = len(self.messages) + 1
+        self.messages[message_id] = SimpleNamespace(
+            chat_id=chat_id, text=text, buttons=buttons(reply_markup), deleted=False)
+        return SimpleNamespace(message_id=message_id)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        message = self.messages[message_id]
+        message.text, message.buttons = text, []
+
+    def offers(self, driver_id):
+        """Открытые предложения водителю: message_id -> callback_data «Взять»."""
+        return {message_id: message.buttons[0] for message_id, message in self.messages.items()
+                if message.chat_id == driver_id and not message.deleted
+                and message.buttons and message.buttons[0].startswith("drv_take:")}
+
+    def to(self, chat_id):
+        return [message for message in self.messages.values() if message.chat_id == chat_id]
+
+
+def buttons(markup):
+    if markup is None:
+        return []
+    return [button.callback_data for row in markup.inline_keyboard for button in row]
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, data=None, name=None):
+        job = SimpleNamespace(callback=callback, data=data, name=name, removed=False)
+        job.schedule_removal = lambda: setattr(job, "removed", True)
+        self.jobs.append(job)
+        return job
+
+    def get_jobs_by_name(self, name):
+        return [job for job in self.jobs if job.name == name and not job.removed]
+
+
+class Replica:
+    def __init__(self, replica_id, telegram):
+        self.state = {
+            "REPLICA_ID": replica_id,
+            "DISPATCHES": {},
+            "DRIVER_LOCATIONS": bot.DriverLocationIndex(bot.GEO_CELL_DEG),
+            "DRIVER_IDLE_SINCE": {},
+            "ORDERS_CACHE": {},
+            "ACTIVE_CHATS": {},
+            "USER_ORDERS": {},
+            "RECENT_TAPS": bot.TTLCache(10000, 60),
+            "DRIVER_CACHE": bot.TTLCache(1000, 60),
+        }
+        self.jobs = FakeJobQueue()
+        self.context = SimpleNamespace(bot=telegram, job_queue=self.jobs, job=None)
+
+    @contextmanager
+    def active(self):
+        """Глобальное состояние bot на время одного вызова — как в отдельном процессе."""
+        saved = {name: getattr(bot, name) for name in self.state}
+        for name, value in self.state.items():
+            setattr(bot, name, value)
+        try:
+            yield
+        finally:
+            for name, value in saved.items():
+                setattr(bot, name, value)
+
+
+class Cluster:
+    def __init__(self, size):
+        self.telegram = FakeTelegram()
+        self.replicas = [Replica(replica_id, self.telegram) for replica_id in range(size)]
+
+    def route(self, data):
+        return self.replicas[bot.update_replica(data, len(self.replicas))]
+
+    async def add_driver(self, driver_id, km, car_class="Business"):
+        await bot.store_call(bot.STORE.save_driver, {
+            "driver_id": str(driver_id), "driver_name": f"Driver {driver_id}", "car_class": car_class,
+            "plate": "A001AA", "car_photos": [],
+        })
+        lat, lon = point_at(km)
+        message = SimpleNamespace(location=SimpleNamespace(latitude=lat, longitude=lon, live_period=900),
+                                  from_user=SimpleNamespace(id=driver_id))
+        replica = self.route({"message": {"chat": {"id": driver_id}}})
+        with replica.active():
+            await bot.driver_location(SimpleNamespace(effective_message=message), replica.context)
+
+    async def sync(self):
+        """Два круга обмена геолокацией: каждая реплика видит точки всех."""
+        for _ in range(2):
+            for replica in self.replicas:
+                with replica.active():
+                    await bot.sync_driver_locations(replica.context)
+
+    async def new_order(self, order_id, car_class="Business"):
+        order = bot.Order(order_id=order_id, user_id=CLIENT_ID, pickup="Тверская, 1", car_class=car_class,
+                          pickup_lat=PICKUP[0], pickup_lon=PICKUP[1], status="new",
+                          created_at=bot.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        replica = self.route({"message": {"chat": {"id": CLIENT_ID}}})
+        with replica.active():
+            await bot.save_order(order)
+            await bot.start_dispatch(replica.context, order, "🆕 Новый заказ")
+
+    async def tap(self, driver_id, message_id, data):
+        message = self.telegram.messages[message_id]
+
+        async def answer(*args, **kwargs):
+            pass
+
+        async def delete():
+            message.deleted = True
+
+        async def edit_message_text(text, **kwargs):
+            await self.telegram.edit_message_text(text, chat_id=message.chat_id, message_id=message_id)
+
+        query = SimpleNamespace(
+            data=data, answer=answer, edit_message_text=edit_message_text,
+            message=SimpleNamespace(delete=delete, chat_id=message.chat_id, message_id=message_id),
+            from_user=SimpleNamespace(id=driver_id, username=f"d{driver_id}", full_name=f"Driver {driver_id}"),
+        )
+        replica = self.route({"callback_query": {"data": data, "from": {"id": driver_id},
+                                                 "message": {"chat": {"id": message.chat_id}}}})
+        with replica.active():
+            await bot.driver_orders_callback(SimpleNamespace(callback_query=query), replica.context)
+
+    async def take(self, driver_id, order_id):
+        message_id, data = self.offer(driver_id, order_id)
+        await self.tap(driver_id, message_id, data)
+
+    async def decline(self, driver_id, order_id):
+        message_id, data = self.offer(driver_id, order_id)
+        await self.tap(driver_id, message_id, data.replace("drv_take:", "drv_decline:"))
+
+    def offer(self, driver_id, order_id):
+        for message_id, data in self.telegram.offers(driver_id).items():
+            if data.split(":")[1] == order_id:
+                return message_id, data
+        raise AssertionError(f"водителю {driver_id} не предлагали заказ {order_id}")
+
+    async def expire(self, order_id):
+        """Сработать таймеру предложения — на той реплике, где он заведён."""
+        for replica in self.replicas:
+            for job in replica.jobs.get_jobs_by_name(f"dispatch:{order_id}"):
+                job.removed = True
+                with replica.active():
+                    context = SimpleNamespace(bot=self.telegram, job_queue=replica.jobs, job=job)
+                    await job.callback(context)
+
+    def timers(self, order_id):
+        return sum(len(replica.jobs.get_jobs_by_name(f"dispatch:{order_id}")) for replica in self.replicas)
+
+    def dispatching(self):
+        return {order_id for replica in self.replicas for order_id in replica.state["DISPATCHES"]}
+
+
+@pytest.fixture
+def shared_store(tmp_path, monkeypatch):
+    state = bot.OrderStore(str(tmp_path / "orders.db"))
+    state.shared = state.blocking = True
+    monkeypatch.setattr(bot, "STORE", state)
+    monkeypatch.setattr(bot, "ORDER_WRITER", bot.SheetWriter("Лист1", lambda: None, None, 60))
+    monkeypatch.setattr(bot, "ASSIGN_TIMES", bot.deque(maxlen=1000))
+    monkeypatch.setattr(bot, "ADMIN_CHAT_ID", str(GROUP_ID))
+    monkeypatch.setattr(bot, "DISPATCH_ENABLED", True)
+    monkeypatch.setattr(bot, "DISPATCH_RADIUS_KM", 5.0)
+    monkeypatch.setattr(bot, "DISPATCH_ROUNDS", 3)
+    return state
+
+
+@pytest.fixture(params=[1, 2], ids=["one-process", "two-replicas"])
+def cluster(request, shared_store):
+    return Cluster(request.param)
+
+
+def in_group(cluster, order_id):
+    return [message for message in cluster.telegram.to(GROUP_ID) if f"#{order_id}" in message.text]
+
+
+def test_router_sends_offer_buttons_to_the_dispatching_replica():
+    group_take = {"callback_query": {"data": "drv_take:ab12", "from": {"id": 7},
+                                     "message": {"chat": {"id": GROUP_ID}}}}
+    offer_take = {"callback_query": {"data": "drv_take:ab12:1", "from": {"id": 8},
+                                     "message": {"chat": {"id": 8}}}}
+    offer_decline = {"callback_query": {"data": "drv_decline:ab12:0", "from": {"id": 7},
+                                        "message": {"chat": {"id": 7}}}}
+    arrived = {"callback_query": {"data": "drv_arrived:ab12", "from": {"id": 7},
+                                  "message": {"chat": {"id": 7}}}}
+    assert bot.update_replica(group_take, 2) == GROUP_ID % 2
+    assert bot.update_replica(offer_take, 2) == 1
+    assert bot.update_replica(offer_decline, 2) == 0
+    assert bot.update_replica(arrived, 2) == 1
+    assert bot.update_replica({"message": {"chat": {"id": 7}}}, 2) == 1
+
+
+def test_store_returns_locations_written_since(store):
+    rows = [(1, "Business", 55.75, 37.62, 100.0, 0.0), (3, "Vito", 55.76, 37.63, 101.0, 50.0)]
+
+    async def scenario():
+        await bot.store_call(store.save_locations, rows)
+        assert sorted(await bot.store_call(store.load_locations, 0.0)) == rows
+        assert await bot.store_call(store.load_locations, bot.time.time() + 60) == []
+        await bot.store_call(store.save_locations, [(1, "Business", 55.8, 37.7, 200.0, 0.0)])
+        assert sorted(await bot.store_call(store.load_locations, 0.0))[0] == (1, "Business", 55.8, 37.7, 200.0, 0.0)
+
+    asyncio.run(scenario())
+
+
+def test_locations_are_shared_between_replicas(shared_store):
+    cluster = Cluster(2)
+
+    async def scenario():
+        await cluster.add_driver(1, 1.0)   # нечётные водители — у реплики 1
+        await cluster.add_driver(3, 2.0)
+        home = cluster.replicas[1].state["DRIVER_LOCATIONS"]
+        other = cluster.replicas[0].state["DRIVER_LOCATIONS"]
+        assert len(home) == 2 and len(other) == 0
+        await cluster.sync()
+        assert {driver_id for _, driver_id in other.nearest("Business", *PICKUP, k=5)} == {1, 3}
+        assert other.dirty == set()   # в таблицу пишет реплика водителя
+        assert other.unshared == set()
+
+        await cluster.add_driver(1, 4.0)  # водитель поехал дальше
+        await cluster.sync()
+        assert other.nearest("Business", *PICKUP, k=1)[0][1] == 3
+
+    asyncio.run(scenario())
+
+
+def test_radius_widens_until_a_driver_is_found(cluster, monkeypatch):
+    monkeypatch.setattr(bot, "DISPATCH_BATCH", 1)
+
+    async def scenario():
+        await cluster.add_driver(1, 3.0)
+        await cluster.add_driver(3, 8.0)
+        await cluster.add_driver(5, 30.0)
+        await cluster.sync()
+        await cluster.new_order("o1")
+        assert list(cluster.telegram.offers(1)) and not cluster.telegram.offers(3)
+
+        await cluster.expire("o1")            # 10 км
+        assert not cluster.telegram.offers(1)
+        assert cluster.telegram.to(1)[0].text == "⌛ Время на ответ истекло."
+        assert list(cluster.telegram.offers(3))
+
+        await cluster.expire("o1")            # 20 км — водитель 5 дальше
+        assert not cluster.telegram.offers(5)
+        assert len(in_group(cluster, "o1")) == 1
+        assert cluster.dispatching() == set() and cluster.timers("o1") == 0
+
+    asyncio.run(scenario())
+
+
+def test_empty_first_radius_goes_straight_to_wider_round(cluster):
+    async def scenario():
+        await cluster.add_driver(1, 8.0)
+        await cluster.sync()
+        await cluster.new_order("o1")
+        assert list(cluster.telegram.offers(1))
+        assert "≈ 8.0 км" in cluster.telegram.to(1)[0].text
+
+    asyncio.run(scenario())
+
+
+def test_all_declined_starts_next_round_without_waiting(cluster, monkeypatch):
+    monkeypatch.setattr(bot, "DISPATCH_BATCH", 2)
+
+    async def scenario():
+        await cluster.add_driver(1, 1.0)
+        await cluster.add_driver(3, 2.0)
+        await cluster.add_driver(5, 7.0)
+        await cluster.sync()
+        await cluster.new_order("o1")
+        assert cluster.timers("o1") == 1
+
+        await cluster.decline(1, "o1")
+        assert not cluster.telegram.offers(5)   # второй ещё думает
+        await cluster.decline(3, "o1")
+        assert list(cluster.telegram.offers(5))
+        assert cluster.timers("o1") == 1        # старый таймер снят, новый заведён
+        assert not cluster.telegram.offers(1) and not cluster.telegram.offers(3)
+
+    asyncio.run(scenario())
+
+
+def test_take_closes_other_offers(cluster, shared_store, monkeypatch):
+    monkeypatch.setattr(bot, "DISPATCH_BATCH", 3)
+
+    async def scenario():
+        for driver_id, km in ((1, 1.0), (3, 2.0), (5, 3.0)):
+            await cluster.add_driver(driver_id, km)
+        await cluster.sync()
+        await cluster.new_order("o1")
+        await cluster.take(3, "o1")
+
+        assert shared_store.get_order("o1").driver_id == 3
+        for driver_id in (1, 5):
+            assert not cluster.telegram.offers(driver_id)
+            assert cluster.telegram.to(driver_id)[0].text == "Заказ уже принят другим водителем."
+        assert any(m.text.startswith("Вы приняли заказ") for m in cluster.telegram.to(3))
+        assert any(m.text.startswith("Ваш заказ принят") for m in cluster.telegram.to(CLIENT_ID))
+        assert cluster.dispatching() == set() and cluster.timers("o1") == 0
+
+    asyncio.run(scenario())
+
+
+def test_busy_driver_and_other_class_are_not_offered(cluster, monkeypatch):
+    monkeypatch.setattr(bot, "DISPATCH_BATCH", 3)
+
+    async def scenario():
+        await cluster.add_driver(1, 1.0)
+        await cluster.add_driver(3, 1.5, car_class="Vito")
+        await cluster.add_driver(5, 2.0)
+        await cluster.sync()
+        await cluster.new_order("o1")
+        await cluster.take(1, "o1")
+        await cluster.new_order("o2")
+        assert set(cluster.telegram.offers(5)) and not cluster.telegram.offers(1)
+        assert not cluster.telegram.offers(3)
+
+    asyncio.run(scenario())
+
+
+def simulate(cluster, drivers, orders, seed):
+    """
+    Случайная смена: водители отказываются, молчат или берут заказ.
+    Возвращает (назначенные заказы, ушедшие в группу, раундов на заказ).
+    """
+    rng = random.Random(seed)
+
+    async def scenario():
+        for n in range(drivers):
+            await cluster.add_driver(2 * n + 1, rng.uniform(0, 25))
+        await cluster.sync()
+        assigned, grouped, rounds = {}, set(), []
+        for k in range(orders):
+            order_id = f"o{k}"
+            await cluster.new_order(order_id)
+            offered = set()
+            for round_no in range(1, bot.DISPATCH_ROUNDS + 1):
+                drivers_now = [driver_id for driver_id in range(1, 2 * drivers, 2)
+                               if any(d.split(":")[1] == order_id
+                                      for d in cluster.telegram.offers(driver_id).values())]
+                if not drivers_now:
+                    break
+                assert not offered & set(drivers_now), "одному водителю предложили дважды"
+                offered |= set(drivers_now)
+                choice = rng.random()
+                if choice < 0.4:
+                    await cluster.take(rng.choice(drivers_now), order_id)
+                    rounds.append(round_no)
+                    break
+                if choice < 0.7:
+                    for driver_id in drivers_now:
+                        await cluster.decline(driver_id, order_id)
+                else:
+                    await cluster.expire(order_id)
+            order = await bot.store_call(bot.STORE.get_order, order_id)
+            if order.status == "assigned":
+                assigned[order_id] = order.driver_id
+                assert order.driver_id in offered
+            if in_group(cluster, order_id):
+                grouped.add(order_id)
+            assert cluster.timers(order_id) == 0 and order_id not in cluster.dispatching()
+        return assigned, grouped, rounds
+
+    return asyncio.run(scenario())
+
+
+def test_simulated_shift_every_order_ends_assigned_or_in_group(cluster):
+    assigned, grouped, rounds = simulate(cluster, drivers=30, orders=25, seed=7)
+    assert assigned and grouped
+    assert set(assigned).isdisjoint(grouped)
+    assert len(assigned) + len(grouped) == 25
+    assert len(set(assigned.values())) == len(assigned)   # занятым не предлагаем
+    assert max(rounds) <= bot.DISPATCH_ROUNDS
+    for driver_id in range(1, 60, 2):
+        assert not cluster.telegram.offers(driver_id)
@@ -0,0 +1,81 @@
+import random
+import time
+
+import pytest
+
+import bot
+
+
+def brute_force(drivers, lat, lon, k, max_km=None, available=None):
+    found = sorted((bot.haversine_km(lat, lon, d_lat, d_lon), driver_id)
+                   for driver_id, (d_lat, d_lon) in drivers.items()
+                   if available is None or available(driver_id))
+    return [pair for pair in found if max_km is None or pair[0] <= max_km][:k]
+
+
+@pytest.mark.parametrize("count, spread", [(3, 0.5), (300, 0.05), (2000, 0.6)])
+def test_nearest_matches_brute_force(count, spread):
+    rng = random.Random(count)
+    index = bot.DriverLocationIndex(cell_deg=0.01)
+    drivers = {}
+    for driver_id in range(1, count + 1):
+        drivers[driver_id] = (55.75 + rng.uniform(-spread, spread), 37.62 + rng.uniform(-spread, spread))
+        index.update(driver_id, "Business", *drivers[driver_id])
+        index.update(10_000 + driver_id, "Vito", *drivers[driver_id])  # другой класс не мешает
+    for driver_id in range(1, count + 1, 7):  # часть водителей переехала
+        drivers[driver_id] = (55.75 + rng.uniform(-spread, spread), 37.62 + rng.uniform(-spread, spread))
+        index.update(driver_id, "Business", *drivers[driver_id])
+
+    for _ in range(30):
+        lat, lon = 55.75 + rng.uniform(-spread, spread), 37.62 + rng.uniform(-spread, spread)
+        k = rng.choice([1, 5, 20])
+        max_km = rng.choice([None, 0.5, 3.0])
+        busy = set(rng.sample(sorted(drivers), len(drivers) // 3))
+        available = rng.choice([None, lambda driver_id: driver_id not in busy])
+        assert index.nearest("Business", lat, lon, k=k, max_km=max_km, available=available) == \
+            brute_force(drivers, lat, lon, k, max_km, available)
+
+
+def test_nearest_skips_stale_and_removed_drivers():
+    index = bot.DriverLocationIndex(cell_deg=0.01)
+    index.update(1, "Business", 55.750, 37.620, ts=time.time() - bot.LOCATION_MAX_AGE - 1)
+    index.update(2, "Business", 55.760, 37.620)
+    index.update(3, "Business", 55.751, 37.620)
+    index.remove(3)
+    assert [driver_id for _, driver_id in index.nearest("Business", 55.750, 37.620)] == [2]
+    assert index.nearest("Vito", 55.750, 37.620) == []
+
+
+def brute_force_eta(drivers, car_class, lat, lon, available=None):
+    fresh_since = time.time() - bot.LOCATION_MAX_AGE
+    found = [(bot.eta_minutes(bot.haversine_km(lat, lon, d_lat, d_lon)), driver_id)
+             for driver_id, (d_class, d_lat, d_lon, ts) in drivers.items()
+             if d_class == car_class and ts >= fresh_since and (available is None or available(driver_id))]
+    return min(found, default=None)
+
+
+@pytest.mark.parametrize("count", [5, 40, 3000])
+def test_best_eta_matches_brute_force(count):
+    rng = random.Random(count)
+    index = bot.DriverLocationIndex(cell_deg=0.01)
+    drivers = {}
+    now = time.time()
+    for driver_id in range(1, count + 1):
+        car_class = rng.choice(["Business", "Business", "Vito"])
+        # каждый пятый давно не присылал точку
+        ts = now - bot.LOCATION_MAX_AGE - 60 if driver_id % 5 == 0 else now - rng.uniform(0, 300)
+        drivers[driver_id] = (car_class, 55.75 + rng.uniform(-0.3, 0.3), 37.62 + rng.uniform(-0.3, 0.3), ts)
+        index.update(driver_id, car_class, *drivers[driver_id][1:3], ts=ts)
+
+    for _ in range(40):
+        lat, lon = 55.75 + rng.uniform(-0.3, 0.3), 37.62 + rng.uniform(-0.3, 0.3)
+        share = rng.choice([0, 0.5, 0.97, 1])
+        busy = set(rng.sample(sorted(drivers), int(len(drivers) * share)))
+        available = rng.choice([None, lambda driver_id: driver_id not in busy])
+        for car_class in ("Business", "Vito", "Maybach W223"):
+            expected = brute_force_eta(drivers, car_class, lat, lon, available)
+            got = index.best_eta(car_class, lat, lon, available=available)
+            if expected is None:
+                assert got is None
+            else:
+                assert got[0] == expected[1] and got[1] == pytest.approx(expected[0])
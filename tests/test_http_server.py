@@ -0,0 +1,71 @@
+import asyncio
+
+import bot
+
+
+async def echo(method, path, headers, body):
+    return 200, body
+
+
+async def with_server(monkeypatch, scenario):
+    monkeypatch.setattr(bot, "HTTP_READ_TIMEOUT", 0.2)
+    monkeypatch.setattr(bot, "HTTP_IDLE_TIMEOUT", 0.4)
+    server = bot.HttpServer(echo, "127.0.0.1", 0)
+    await server.start()
+    port = server._server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        return await scenario(reader, writer)
+    finally:
+        await server.stop()
+
+
+def post(body):
+    return (f"POST /telegram HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n").encode() + body
+
+
+def test_keep_alive_serves_several_requests(monkeypatch):
+    async def scenario(reader, writer):
+        answers = []
+        for body in (b'{"a": 1}', b'{"b": 2}'):
+            writer.write(post(body))
+            assert (await reader.readline()).startswith(b"HTTP/1.1 200")
+            while await reader.readline() != b"\r\n":
+                pass
+            answers.append(await reader.readexactly(len(body)))
+        return answers
+
+    assert asyncio.run(with_server(monkeypatch, scenario)) == [b'{"a": 1}', b'{"b": 2}']
+
+
+def test_slow_headers_are_dropped(monkeypatch):
+    async def scenario(reader, writer):
+        writer.write(b"POST /telegram HTTP/1.1\r\n")
+        # по заголовку раз в 0.1 с: каждый укладывается в таймаут, а весь запрос — нет
+        for sent in range(10):
+            await asyncio.sleep(0.1)
+            if reader.at_eof():
+                return sent
+            writer.write(b"X-Slow: 1\r\n")
+        return None
+
+    sent = asyncio.run(with_server(monkeypatch, scenario))
+    assert sent is not None and sent < 6  # закрыли примерно через HTTP_READ_TIMEOUT
+
+
+def test_unfinished_body_is_dropped(monkeypatch):
+    async def scenario(reader, writer):
+        writer.write(post(b'{"a": 1}')[:-3])
+        return await asyncio.wait_for(reader.read(), 1)
+
+    assert asyncio.run(with_server(monkeypatch, scenario)) == b""
+
+
+def test_idle_keep_alive_is_closed(monkeypatch):
+    async def scenario(reader, writer):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert await asyncio.wait_for(reader.read(), 2) == b""
+        return loop.time() - started
+
+    assert asyncio.run(with_server(monkeypatch, scenario)) < 1
@@ -0,0 +1,119 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+ANSWER = "Машина будет через 10 минут, водитель уже в пути."
+
+
+def sse(*chunks):
+    lines = [f"data: {json.dumps({'choices': [{'delta': {'content': chunk}}]}, ensure_ascii=False)}"
+             for chunk in chunks]
+    return ("\n\n".join(lines + ["data: [DONE]"]) + "\n\n").encode()
+
+
+class StubLLM:
+    """
+    OpenAI-совместимый API на локальном HttpServer. modes — поведение
+    следующих запросов: ok, slow (дольше AI_TIMEOUT), error (500).
+    """
+
+    def __init__(self):
+        self.modes = []
+        self.delay = 0.0
+        self.requests = 0
+        self.server = bot.HttpServer(self.handle, "127.0.0.1", 0)
+
+    async def handle(self, method, path, headers, body):
+        self.requests += 1
+        mode = self.modes.pop(0) if self.modes else "ok"
+        if mode == "slow":
+            await asyncio.sleep(0.5)
+        if mode == "error":
+            return 500, b""
+        await asyncio.sleep(self.delay)
+        return 200, sse(ANSWER[:20], ANSWER[20:])
+
+    async def __aenter__(self):
+        await self.server.start()
+        port = self.server._server.sockets[0].getsockname()[1]
+        bot.LLM = bot.LLMClient(f"http://127.0.0.1:{port}", "test-key", "test-model", 4)
+        return self
+
+    async def __aexit__(self, *exc):
+        await bot.LLM.close()
+        await self.server.stop()
+
+
+@pytest.fixture
+def ai(monkeypatch):
+    monkeypatch.setattr(bot, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(bot, "AI_TIMEOUT", 0.2)
+    monkeypatch.setattr(bot, "AI_BREAKER_FAILURES", 2)
+    monkeypatch.setattr(bot, "AI_BREAKER_RESET", 0.3)
+    monkeypatch.setattr(bot, "AI_CACHE", bot.TTLCache(100, 60))
+    monkeypatch.setattr(bot, "AI_INFLIGHT", {})
+    monkeypatch.setattr(bot, "AI_COALESCED", 0)
+    monkeypatch.setattr(bot, "CANNED_REPLIES", SimpleNamespace(match=lambda question: None))
+    monkeypatch.setattr(bot, "LLM", bot.LLM)
+    return StubLLM()
+
+
+async def ask(question):
+    """/ai question — возвращает последний текст ответа бота."""
+    replies = []
+
+    async def reply_text(text):
+        reply = SimpleNamespace(texts=[text])
+
+        async def edit_text(new_text):
+            reply.texts.append(new_text)
+
+        reply.edit_text = edit_text
+        replies.append(reply)
+        return reply
+
+    update = SimpleNamespace(message=SimpleNamespace(reply_text=reply_text))
+    await bot.ai_cmd(update, SimpleNamespace(args=question.split()))
+    return replies[-1].texts[-1]
+
+
+def test_identical_questions_in_flight_share_one_request(ai):
+    ai.delay = 0.1
+    questions = ["Машина опоздает на 10 минут?", "машина опоздает на 10 минут",
+                 "МАШИНА опоздает на 10 минут!", "Машина опоздает на 10 минут", "машина  опоздает на 10 минут?"]
+
+    async def scenario():
+        async with ai:
+            return await asyncio.gather(*(ask(question) for question in questions))
+
+    answers = asyncio.run(scenario())
+    assert ai.requests == 1
+    assert bot.AI_COALESCED == 4
+    assert answers == [ANSWER] * 5
+    assert bot.AI_INFLIGHT == {}
+
+
+def test_breaker_opens_on_slow_and_failing_api_and_recovers(ai):
+    ai.modes = ["slow", "error"]
+
+    async def scenario():
+        async with ai:
+            assert await ask("вопрос один") == "Не удалось получить ответ от AI-диспетчера."    # таймаут
+            assert await ask("вопрос два") == "Не удалось получить ответ от AI-диспетчера."     # 500
+            assert bot.LLM.breaker.state == "open"
+            assert await ask("вопрос три") == bot.AI_UNAVAILABLE_TEXT   # API не трогаем
+            assert ai.requests == 2
+            await asyncio.sleep(0.35)
+            assert bot.LLM.breaker.state == "half-open"
+            assert await ask("вопрос четыре") == ANSWER                 # проба прошла
+            assert bot.LLM.breaker.state == "closed"
+            assert await ask("вопрос пять") == ANSWER
+
+    asyncio.run(scenario())
+    assert ai.requests == 4
+    assert (bot.LLM.breaker.opened, bot.LLM.breaker.rejected) == (1, 1)
+    assert bot.LLM.errors == 2
@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+import bot
+
+
+class FakeBotApi:
+    """
+    sendMessage с лимитами Telegram: в окне w секунд чат принимает не больше
+    burst + rate·w сообщений, бот в целом — global_rate·w + global_burst.
+    Сверх лимита — RetryAfter, как у настоящего API.
+    """
+
+    def __init__(self, chat_limits, global_limit):
+        self.chat_limits = chat_limits        # (rate, burst) для лички и для групп
+        self.global_limit = global_limit      # (rate, burst)
+        self.sent = []                        # (time, chat_id, text)
+        self.rejected = 0
+
+    @staticmethod
+    def fits(times, rate, burst):
+        return all(j - i + 1 <= burst + rate * (times[j] - times[i]) + 0.5
+                   for i in range(len(times)) for j in range(i, len(times)))
+
+    async def send_message(self, chat_id, text):
+        now = time.monotonic()
+        rate, burst = self.chat_limits["group" if str(chat_id).startswith("-") else "private"]
+        chat_times = [t for t, c, _ in self.sent if c == chat_id] + [now]
+        all_times = [t for t, _, _ in self.sent] + [now]
+        if not self.fits(chat_times, rate, burst) or not self.fits(all_times, *self.global_limit):
+            self.rejected += 1
+            raise RetryAfter(1)
+        self.sent.append((now, chat_id, text))
+        return text
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(bot, "OUT_CHAT_PER_SEC", 20.0)
+    monkeypatch.setattr(bot, "OUT_GROUP_PER_MIN", 603.0)   # 10 в секунду после всплеска
+    monkeypatch.setattr(bot, "OUT_GLOBAL_PER_SEC", 100.0)
+    api = FakeBotApi({"private": (20.0, bot.OUT_CHAT_BURST), "group": (10.0, bot.OUT_GROUP_BURST)},
+                     (100.0, 100.0))
+    return bot.OutboundRateLimiter(), api
+
+
+def send(limiter, api, chat_id, text, priority=None):
+    return limiter.process_request(api.send_message, (chat_id, text), {}, "sendMessage",
+                                   {"chat_id": chat_id, "text": text}, priority)
+
+
+def test_retry_after_is_waited_out_and_retried():
+    limiter = bot.OutboundRateLimiter()
+    calls = []
+
+    async def callback():
+        calls.append(time.monotonic())
+        if len(calls) <= 2:
+            raise RetryAfter(0.05)
+        return "ok"
+
+    result = asyncio.run(limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": 1}, None))
+    assert result == "ok"
+    assert calls[1] - calls[0] >= 0.05 and calls[2] - calls[1] >= 0.05
+    assert limiter.metrics["retry_after"] == 2
+    assert (limiter.metrics["sent"], limiter.metrics["dropped"], limiter.metrics["in_flight"]) == (1, 0, 0)
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(bot, "OUT_MAX_RETRIES", 2)
+    limiter = bot.OutboundRateLimiter()
+    calls = []
+
+    async def callback():
+        calls.append(1)
+        raise RetryAfter(0.01)
+
+    with pytest.raises(RetryAfter):
+        asyncio.run(limiter.process_request(callback, (), {}, "sendMessage", {"chat_id": -5}, None))
+    assert len(calls) == 3
+    assert limiter.metrics["retry_after"] == 3
+    assert (limiter.metrics["sent"], limiter.metrics["dropped"], limiter.metrics["in_flight"]) == (0, 1, 0)
+
+
+def test_requests_without_chat_bypass_the_limiter():
+    limiter = bot.OutboundRateLimiter()
+
+    async def callback():
+        return True
+
+    assert asyncio.run(limiter.process_request(callback, (), {}, "answerCallbackQuery", {}, None))
+    assert limiter.metrics["sent"] == 0
+
+
+def test_private_chat_burst_then_rate(limits):
+    limiter, api = limits
+
+    async def scenario():
+        started = time.monotonic()
+        await asyncio.gather(*(send(limiter, api, 7, f"m{n}") for n in range(13)))
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(scenario())
+    assert api.rejected == 0 and limiter.metrics["retry_after"] == 0
+    assert limiter.metrics["sent"] == 13
+    assert elapsed >= (13 - bot.OUT_CHAT_BURST) / 20 * 0.9
+    assert limiter.metrics["waited"] == 13 - bot.OUT_CHAT_BURST
+
+
+def test_group_limit_is_per_minute(limits):
+    limiter, api = limits
+
+    async def scenario():
+        started = time.monotonic()
+        await asyncio.gather(*(send(limiter, api, -100, f"g{n}") for n in range(8)))
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(scenario())
+    assert api.rejected == 0 and limiter.metrics["sent"] == 8
+    assert elapsed >= (8 - bot.OUT_GROUP_BURST) / 10 * 0.9
+
+
+def test_global_limit_across_chats(limits):
+    limiter, api = limits
+
+    async def scenario():
+        started = time.monotonic()
+        await asyncio.gather(*(send(limiter, api, chat_id, "hi") for chat_id in range(1, 151)))
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(scenario())
+    assert api.rejected == 0 and limiter.metrics["sent"] == 150
+    assert elapsed >= (150 - 100) / 100 * 0.9
+
+
+def test_urgent_offer_overtakes_queued_notices(limits):
+    limiter, api = limits
+
+    async def scenario():
+        notices = [asyncio.create_task(send(limiter, api, 7, f"notice{n}")) for n in range(8)]
+        await asyncio.sleep(0)
+        urgent = asyncio.create_task(send(limiter, api, 7, "urgent", bot.OUT_PRIO_URGENT))
+        await asyncio.gather(urgent, *notices)
+
+    asyncio.run(scenario())
+    texts = [text for _, _, text in api.sent]
+    assert texts.index("urgent") == bot.OUT_CHAT_BURST   # сразу после всплеска, раньше ждущих
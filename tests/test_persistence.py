@@ -0,0 +1,101 @@
+import asyncio
+
+import bot
+
+
+def reopen(path):
+    persistence = bot.AppendLogPersistence(str(path), 60)
+
+    async def read():
+        return (await persistence.get_user_data(), await persistence.get_chat_data(),
+                await persistence.get_bot_data(), await persistence.get_conversations("order"))
+
+    return persistence, asyncio.run(read())
+
+
+def lines(path):
+    return path.read_text(encoding="utf-8").splitlines()
+
+
+def test_round_trip_through_update_flush_reload(tmp_path):
+    path = tmp_path / "state.jsonl"
+    persistence = bot.AppendLogPersistence(str(path), 60)
+    draft = {"order": {"pickup": "Тверская, 1", "car_class": "Business", "pickup_lat": 55.75}}
+
+    async def write():
+        await persistence.update_user_data(1, draft)
+        await persistence.update_user_data(2, {"driver": {"photos": ["f1", "f2"]}})
+        await persistence.update_chat_data(-100, {"pinned": 42})
+        await persistence.update_bot_data({"orders_today": 17})
+        await persistence.update_conversation("order", (1, 1), bot.CONFIRM)
+        await persistence.update_conversation("order", (3, 3), bot.PICKUP)
+        await persistence.update_conversation("order", (3, 3), None)   # диалог закончен
+        await persistence.drop_user_data(2)
+        await persistence.flush()
+
+    asyncio.run(write())
+    _, (user_data, chat_data, bot_data, conversations) = reopen(path)
+    assert user_data == {1: draft}
+    assert chat_data == {-100: {"pinned": 42}}
+    assert bot_data == {"orders_today": 17}
+    assert conversations == {(1, 1): bot.CONFIRM}
+
+
+def test_unchanged_data_is_not_appended(tmp_path):
+    path = tmp_path / "state.jsonl"
+    persistence = bot.AppendLogPersistence(str(path), 60)
+
+    async def write():
+        for _ in range(3):
+            await persistence.update_user_data(1, {"order": {"pickup": "A"}})
+            await persistence.update_bot_data({})
+            await persistence.update_conversation("order", (1, 1), bot.DEST)
+        await persistence.flush()
+
+    asyncio.run(write())
+    assert len(lines(path)) == 2
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    path = tmp_path / "state.jsonl"
+    persistence = bot.AppendLogPersistence(str(path), 60)
+    asyncio.run(persistence.update_user_data(1, {"order": {"pickup": "A"}}))
+    with open(path, "a", encoding="utf-8") as log_file:
+        log_file.write('{"t": "u", "id": 2, "d": {"ord')   # процесс упал посреди записи
+    _, (user_data, *_) = reopen(path)
+    assert user_data == {1: {"order": {"pickup": "A"}}}
+
+
+def test_log_is_compacted_to_live_records(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "PERSISTENCE_COMPACT_MIN", 20)
+    path = tmp_path / "state.jsonl"
+    persistence = bot.AppendLogPersistence(str(path), 60)
+
+    async def write():
+        for n in range(500):
+            await persistence.update_user_data(n % 3, {"order": {"step": n}})
+            await persistence.update_conversation("order", (n % 3, n % 3), n % 7)
+        await persistence.flush()
+
+    asyncio.run(write())
+    assert len(lines(path)) <= 20 + 1
+    assert not (tmp_path / "state.jsonl.tmp").exists()
+    _, (user_data, _, _, conversations) = reopen(path)
+    assert user_data == {0: {"order": {"step": 498}}, 1: {"order": {"step": 499}}, 2: {"order": {"step": 497}}}
+    assert conversations == {(0, 0): 498 % 7, (1, 1): 499 % 7, (2, 2): 497 % 7}
+
+
+def test_reload_compacts_the_previous_log(tmp_path):
+    path = tmp_path / "state.jsonl"
+    persistence = bot.AppendLogPersistence(str(path), 60)
+
+    async def write():
+        for n in range(50):
+            await persistence.update_user_data(1, {"order": {"step": n}})
+        await persistence.drop_user_data(1)
+        await persistence.update_user_data(2, {"order": {"step": 0}})
+
+    asyncio.run(write())
+    assert len(lines(path)) == 52
+    reopen(path)
+    assert len(lines(path)) == 1
@@ -0,0 +1,234 @@
+import asyncio
+import threading
+import time
+
+import bot
+from conftest import FakeWorksheet
+
+
+def test_timeout_keeps_slot_until_thread_finishes(gateway):
+    gateway.timeout = 0.05
+    running = []
+    peak = []
+
+    def slow(tag):
+        running.append(tag)
+        peak.append(len(running))
+        time.sleep(0.3)
+        running.remove(tag)
+        return tag
+
+    async def scenario():
+        first = await asyncio.gather(*(gateway.call(slow, i, default="timeout") for i in range(2)))
+        # оба потока ещё работают: третий вызов ждёт слот, а не встаёт в очередь пула
+        started = time.monotonic()
+        third = await gateway.call(slow, 2, timeout=5)
+        return first, third, time.monotonic() - started
+
+    first, third, waited = asyncio.run(scenario())
+    assert first == ["timeout", "timeout"]
+    assert third == 2
+    assert max(peak) == 2
+    assert waited >= 0.5  # 0.25 до освобождения слота + 0.3 своя работа
+    assert gateway.metrics["timeouts"] == 2
+
+
+def test_wait_returns_real_result_after_timeout(gateway):
+    gateway.timeout = 0.05
+    done = threading.Event()
+
+    def write():
+        time.sleep(0.2)
+        done.set()
+        return True
+
+    result = asyncio.run(gateway.call(write, default=False, wait=True))
+    assert result is True and done.is_set()
+
+
+def test_writer_does_not_duplicate_row_after_ambiguous_append(gateway, monkeypatch):
+    ws = FakeWorksheet("orders", [["order_id", "status"]])
+    index = bot.SheetRowIndex("orders", lambda: ws.col_values(1))
+    index.rebuild()
+    append = ws.append_rows
+    failures = [OSError("connection reset after append")]
+
+    def append_then_fail(values, value_input_option=None):
+        response = append(values, value_input_option)
+        if failures:
+            raise failures.pop()
+        return response
+
+    monkeypatch.setattr(ws, "append_rows", append_then_fail)
+    writer = bot.SheetWriter("orders", lambda: ws, index, interval=0)
+
+    async def scenario():
+        writer.set_cells("o1", {1: "o1", 2: "new"})
+        await writer.flush()      # строка записана, но ответ потерян
+        writer.set_cells("o1", {2: "assigned"})
+        await writer.flush()
+
+    asyncio.run(scenario())
+    assert [row[0] for row in ws.rows] == ["order_id", "o1"]
+    assert ws.rows[1][1] == "assigned"
+
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status_code = status
+        self.ok = status < 400
+        self.text = "{}"
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": "fake", "status": "FAKE"}}
+
+
+class FakeSession:
+    """requests.Session, отвечающий заранее заданными статусами."""
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.sent = 0
+
+    def request(self, **kwargs):
+        self.sent += 1
+        return FakeResponse(self.statuses.pop(0) if self.statuses else 200)
+
+
+def fake_client(statuses):
+    client = bot.throttled_http_client()(auth=None, session=FakeSession(statuses))
+    return client, client.session
+
+
+def test_quota_is_charged_per_api_request(gateway):
+    gateway._bucket = bot.PriorityTokenBucket(rate=20, capacity=1)
+    client, session = fake_client([])
+
+    def rebuild_and_write():
+        # как запись с перестройкой индекса: один вызов — три запроса
+        for _ in range(3):
+            client.request("get", "https://sheets.test/values")
+        return "ok"
+
+    async def scenario():
+        started = time.monotonic()
+        result = await asyncio.gather(*(gateway.call(rebuild_and_write, timeout=5) for _ in range(2)))
+        return result, time.monotonic() - started
+
+    result, elapsed = asyncio.run(scenario())
+    assert result == ["ok", "ok"]
+    assert session.sent == 6
+    assert elapsed >= 5 / 20 - 0.01  # шесть запросов при запасе в один токен
+    assert gateway.metrics["throttled"] >= 5
+
+
+def test_429_retries_only_the_failed_request(gateway, monkeypatch):
+    monkeypatch.setattr(bot, "SHEETS_BACKOFF_BASE", 0.01)
+    client, session = fake_client([200, 429, 429, 200])
+    appended = []
+
+    def append_twice():
+        for row in ("a", "b"):
+            client.request("post", "https://sheets.test/values:append")
+            appended.append(row)
+        return appended
+
+    result = asyncio.run(gateway.call(append_twice, retry=False, default="failed"))
+    assert result == ["a", "b"]  # первая строка не ушла повторно
+    assert session.sent == 4
+    assert gateway.metrics["retried"] == 2
+    assert gateway.metrics["failed"] == 0
+
+
+def test_5xx_inside_non_idempotent_call_is_not_retried(gateway, monkeypatch):
+    monkeypatch.setattr(bot, "SHEETS_BACKOFF_BASE", 0.01)
+    client, session = fake_client([503])
+
+    def append():
+        client.request("post", "https://sheets.test/values:append")
+
+    assert asyncio.run(gateway.call(append, retry=False, default="failed")) == "failed"
+    assert session.sent == 1
+
+
+def test_update_for_row_appended_by_other_replica_waits_for_it(gateway, store, monkeypatch):
+    monkeypatch.setattr(bot, "SHEET_INDEX_MIN_REBUILD", 0)
+    ws = FakeWorksheet("orders", [["order_id"] + [""] * 12])
+    index_a = bot.SheetRowIndex("orders", lambda: ws.col_values(1))
+    index_b = bot.SheetRowIndex("orders", lambda: ws.col_values(1))
+    index_a.rebuild()
+    index_b.rebuild()
+    writer_a = bot.SheetWriter("orders-a", lambda: ws, index_a, interval=0)
+    writer_b = bot.SheetWriter("orders-b", lambda: ws, index_b, interval=0)
+
+    async def scenario():
+        writer_a.set_cells("o1", {1: "o1", 12: "new"})       # заказ у реплики клиента
+        writer_b.set_cells("o1", {12: "assigned", 13: "42"})  # взятие у реплики водителя
+        await writer_b.flush()    # строки ещё нет
+        assert writer_b._pending == {"o1": {12: "assigned", 13: "42"}}
+        assert await bot.store_call(bot.STORE.outbox_load, "orders-b", ordered=True) == {"o1": {12: "assigned", 13: "42"}}
+        await writer_a.flush()
+        await writer_b.flush()
+        assert writer_b._pending == {}
+        assert await bot.store_call(bot.STORE.outbox_load, "orders-b", ordered=True) == {}
+
+    asyncio.run(scenario())
+    assert len(ws.rows) == 2
+    assert ws.rows[1][11:13] == ["assigned", "42"]
+
+
+def test_update_for_missing_row_is_dropped_after_ttl(gateway, monkeypatch):
+    monkeypatch.setattr(bot, "SHEET_INDEX_MIN_REBUILD", 0)
+    monkeypatch.setattr(bot, "SHEET_MISSING_TTL", 0.05)
+    ws = FakeWorksheet("orders", [["order_id"]])
+    index = bot.SheetRowIndex("orders", lambda: ws.col_values(1))
+    writer = bot.SheetWriter("orders", lambda: ws, index, interval=0)
+
+    async def scenario():
+        writer.set_cells("gone", {12: "finished"})
+        await writer.flush()
+        assert "gone" in writer._pending
+        await asyncio.sleep(0.1)
+        await writer.flush()
+        assert writer._pending == {}
+
+    asyncio.run(scenario())
+    assert len(ws.rows) == 1
+
+
+def test_metrics_from_pool_threads_are_exact(monkeypatch):
+    monkeypatch.setattr(bot, "SHEETS_BACKOFF_BASE", 0)
+    monkeypatch.setattr(bot, "SHEETS_MAX_RETRIES", 1000)
+    gateway = bot.SheetsGateway(max_workers=8, timeout=5.0)
+    monkeypatch.setattr(bot, "SHEETS", gateway)
+    gateway._bucket = bot.PriorityTokenBucket(rate=1e6, capacity=1e6)
+    client, session = fake_client([429, 200] * 400)
+
+    def fetch():
+        for _ in range(50):
+            client.request("get", "https://sheets.test/values")
+
+    async def scenario():
+        await asyncio.gather(*(gateway.call(fetch, retry=False) for _ in range(8)))
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        gateway.shutdown()
+    assert session.sent == 800
+    assert gateway.metrics["retried"] == 400
+    assert gateway.metrics["calls"] == 8 and gateway.metrics["failed"] == 0
+
+
+def test_take_token_on_loop_thread_does_not_wait(gateway):
+    gateway._bucket = bot.PriorityTokenBucket(rate=0.001, capacity=1)
+    gateway._bucket._tokens = 0
+
+    async def scenario():
+        gateway._loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        gateway._take_token()   # из цикла ждать токен нельзя — иначе цикл встанет
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 0.1
+    assert gateway.metrics["throttled"] == 0
@@ -0,0 +1,75 @@
+import asyncio
+import multiprocessing
+import sqlite3
+import threading
+import time
+
+import bot
+
+ORDERS = 200
+PROCESSES = 4
+
+
+def take_all(path, driver_id, start, results):
+    store = bot.OrderStore(path)
+    start.wait()
+    won = [order_id for order_id in (f"P{i}" for i in range(ORDERS))
+           if store.transition_order(order_id, {"status": ("new",)},
+                                     {"status": "assigned", "driver_id": driver_id})]
+    results.put((driver_id, won))
+
+
+def test_two_processes_share_sqlite_one_winner_per_order(tmp_path):
+    path = str(tmp_path / "shared.db")
+    store = bot.OrderStore(path)
+    for i in range(ORDERS):
+        store.save_order(bot.Order(order_id=f"P{i}", status="new", car_class="Business"))
+
+    ctx = multiprocessing.get_context("spawn")
+    start, results = ctx.Event(), ctx.Queue()
+    workers = [ctx.Process(target=take_all, args=(path, driver_id, start, results))
+               for driver_id in range(1, PROCESSES + 1)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    won = dict(results.get(timeout=60) for _ in workers)
+    for worker in workers:
+        worker.join(timeout=10)
+
+    taken = [order_id for orders in won.values() for order_id in orders]
+    assert sorted(taken) == sorted(f"P{i}" for i in range(ORDERS))  # каждый заказ взят ровно раз
+    for driver_id, orders in won.items():
+        assert all(store.get_order(order_id).driver_id == driver_id for order_id in orders)
+
+
+def test_shared_sqlite_lock_wait_does_not_block_the_loop(tmp_path, monkeypatch):
+    path = str(tmp_path / "shared.db")
+    store = bot.OrderStore(path)
+    store.shared = store.blocking = True
+    monkeypatch.setattr(bot, "STORE", store)
+    monkeypatch.setattr(bot, "ORDERS_CACHE", {})
+    store.save_order(bot.Order(order_id="L1", status="new"))
+
+    other = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")  # другая реплика держит запись
+    threading.Timer(0.5, other.execute, ("COMMIT",)).start()
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.02)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        started = time.monotonic()
+        order = await bot.transition_order("L1", {"status": ("new",)}, status="assigned")
+        task.cancel()
+        return order, time.monotonic() - started, ticks
+
+    order, waited, ticks = asyncio.run(scenario())
+    assert order.status == "assigned"
+    assert waited >= 0.4
+    assert ticks >= 10  # цикл событий работал, пока транзакция ждала блокировку
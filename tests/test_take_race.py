@@ -0,0 +1,78 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+DRIVERS = 2000
+
+
+def new_order(order_id="T1"):
+    return bot.Order(order_id=order_id, user_id=777, pickup="Тверская, 1", car_class="Business",
+                     created_at="2024-03-01 10:00:00", status="new")
+
+
+def test_transition_applies_only_when_expected(store):
+    async def scenario():
+        await bot.save_order(new_order())
+        assert await bot.transition_order("T1", {"status": ("assigned",)}, status="finished") is None
+        assert await bot.transition_order("missing", {"status": ("new",)}, status="assigned") is None
+
+        order = await bot.transition_order("T1", {"status": ("new", None)}, status="assigned", driver_id=5)
+        assert (order.status, order.driver_id) == ("assigned", 5)
+        assert store.get_order("T1").driver_id == 5
+        assert await bot.transition_order("T1", {"status": ("new", None)},
+                                          status="assigned", driver_id=6) is None
+        assert store.get_order("T1").driver_id == 5
+
+    asyncio.run(scenario())
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0)
+        self.sent.append((chat_id, text))
+
+
+def tap(driver_id, data):
+    async def answer(*args, **kwargs):
+        await asyncio.sleep(0)  # как сетевой вызов: другие тапы успевают прочитать заказ
+
+    async def delete():
+        await asyncio.sleep(0)
+
+    query = SimpleNamespace(data=data, answer=answer, message=SimpleNamespace(delete=delete),
+                            from_user=SimpleNamespace(id=driver_id, username=f"d{driver_id}",
+                                                      full_name=f"Driver {driver_id}"))
+    return SimpleNamespace(callback_query=query)
+
+
+def test_thousands_of_takes_exactly_one_wins(store, monkeypatch):
+    monkeypatch.setattr(bot, "ORDER_WRITER", bot.SheetWriter("Лист1", lambda: None, None, 60))
+    monkeypatch.setattr(bot, "ASSIGN_TIMES", bot.deque(maxlen=10))
+    monkeypatch.setattr(bot, "RECENT_TAPS", bot.TTLCache(DRIVERS, 60))
+
+    async def load_driver_info(driver_id):
+        await asyncio.sleep(0)  # профиль из таблицы: пока грузится, заказ берут другие
+        return {"driver_id": driver_id, "driver_name": f"Driver {driver_id}",
+                "car_class": "Business", "plate": "A001AA"}
+
+    monkeypatch.setattr(bot, "load_driver_info", load_driver_info)
+    fake_bot = FakeBot()
+    context = SimpleNamespace(bot=fake_bot, job_queue=None)
+
+    async def scenario():
+        await bot.save_order(new_order())
+        await asyncio.gather(*(bot.driver_orders_callback(tap(driver_id, "drv_take:T1"), context)
+                               for driver_id in range(1, DRIVERS + 1)))
+
+    asyncio.run(scenario())
+    accepted = [chat_id for chat_id, text in fake_bot.sent if text.startswith("Вы приняли заказ")]
+    assert len(accepted) == 1
+    winner = accepted[0]
+    assert store.get_order("T1").driver_id == winner
+    assert [text for chat_id, text in fake_bot.sent if chat_id == 777][0].startswith("Ваш заказ принят")
+    assert len(bot.ASSIGN_TIMES) == 1
+    assert asyncio.run(bot.chat_order(winner)) == "T1"
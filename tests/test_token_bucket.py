@@ -0,0 +1,53 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import bot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_waiters_are_served_by_priority_then_fifo():
+    async def scenario():
+        bucket = bot.PriorityTokenBucket(rate=50, capacity=1)
+        assert await bucket.acquire() is False  # запас был
+        order = []
+
+        async def take(tag, priority):
+            await bucket.acquire(priority)
+            order.append(tag)
+
+        await asyncio.gather(take("group", 2), take("urgent-1", 0), take("notice", 1), take("urgent-2", 0))
+        return order
+
+    assert asyncio.run(scenario()) == ["urgent-1", "urgent-2", "notice", "group"]
+
+
+def test_refill_rate_bounds_throughput():
+    async def scenario():
+        bucket = bot.PriorityTokenBucket(rate=20, capacity=2)
+        started = time.monotonic()
+        waited = [await bucket.acquire() for _ in range(6)]
+        return waited, time.monotonic() - started
+
+    waited, elapsed = asyncio.run(scenario())
+    assert waited == [False, False, True, True, True, True]
+    assert elapsed >= 4 / 20 - 0.01
+
+
+@pytest.mark.parametrize("rate, capacity", [(0, 3), (-0.1, 3), (1, 0.5)])
+def test_bucket_rejects_settings_that_never_refill(rate, capacity):
+    with pytest.raises(ValueError):
+        bot.PriorityTokenBucket(rate, capacity)
+
+
+def test_group_limit_must_exceed_burst():
+    env = dict(os.environ, OUT_GROUP_PER_MIN=str(bot.OUT_GROUP_BURST))
+    result = subprocess.run([sys.executable, "-c", "import bot"], cwd=ROOT, env=env,
+                            capture_output=True, text=True)
+    assert result.returncode != 0
+    assert "OUT_GROUP_PER_MIN must be greater than" in result.stderr